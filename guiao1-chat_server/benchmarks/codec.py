@@ -0,0 +1,72 @@
+"""Benchmark the chat codec against the dict + json.dumps / if-chain codec it replaced.
+
+Run from the project root:
+    python -m benchmarks.codec
+"""
+import argparse
+import json
+import time
+
+from src.framing import frame_header
+from src.protocol import CDProto, JoinMessage, RegisterMessage, TextMessage
+
+messages = {
+    "register": CDProto.register("student"),
+    "join": CDProto.join("#cd"),
+    "message": CDProto.message("Valeu a pena? Tudo vale a pena se a alma não é pequena", "#cd"),
+}
+
+
+def legacy_encode(msg) -> bytes:
+    """Frame as the chat protocol used to build it."""
+    if type(msg) is RegisterMessage:
+        data = json.dumps({"command": "register", "user": msg.user, "version": msg.version})
+    elif type(msg) is JoinMessage:
+        data = json.dumps({"command": "join", "channel": msg.channel})
+    elif type(msg) is TextMessage:
+        data = json.dumps({"command": "message", "message": msg.message, "channel": msg.channel})
+    data = data.encode("utf-8")
+    return frame_header(len(data)) + data
+
+
+def legacy_decode(data: bytes):
+    """Message as the chat protocol used to parse it."""
+    msg = json.loads(data.decode("utf-8"))
+    cmd = msg["command"]
+    if cmd == "register":
+        return RegisterMessage("register", msg["user"], msg.get("version", 1))
+    elif cmd == "join":
+        return JoinMessage("join", msg["channel"])
+    elif cmd == "message":
+        if "channel" in msg:
+            return TextMessage("message", msg["message"], msg["channel"])
+        return TextMessage("message", msg["message"])
+
+
+def rate(function, arg, rounds: int) -> float:
+    """Calls of function(arg) per second."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function(arg)
+    return rounds / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", help="encodes/decodes per measure", type=int, default=200000)
+    parser.add_argument("--batch", help="messages per batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{'message':<9} {'legacy enc/s':>12} {'encode/s':>10} {'legacy dec/s':>12} {'decode/s':>10}")
+    for name, msg in messages.items():
+        payload = msg.encode()
+        print(f"{name:<9} {rate(legacy_encode, msg, args.rounds):>12.0f} {rate(CDProto.encode, msg, args.rounds):>10.0f} "
+              f"{rate(legacy_decode, payload, args.rounds):>12.0f} {rate(CDProto.decode, payload, args.rounds):>10.0f}")
+
+    batch = [messages["message"]] * args.batch
+    rounds = max(args.rounds // args.batch, 1)
+    frames = CDProto.encode_many(batch)
+    encode = rate(CDProto.encode_many, batch, rounds) * args.batch
+    decode = rate(CDProto.decode_many, frames, rounds) * args.batch
+    legacy = rate(lambda msgs: b"".join(legacy_encode(m) for m in msgs), batch, rounds) * args.batch
+    print(f"{'batch':<9} {legacy:>12.0f} {encode:>10.0f} {'':>12} {decode:>10.0f}  (messages/s, {args.batch} per batch)")
@@ -0,0 +1,342 @@
+"""Load generator for the chat server: throughput, fan-out latency, CPU and memory.
+
+Simulates thousands of headless clients, all asyncio streams of this process,
+speaking CDProto: each registers, joins channels following a join pattern and
+then sends messages at a fixed rate to one of its channels. Every message
+carries its send time, so receivers measure the latency of each delivery.
+The server runs as `python server.py` (or is an already running one, with
+--external), sampled for CPU time and resident memory.
+
+Run from the project root (the port must be free):
+    python -m benchmarks.load --clients 2000 --channels 50 --output load.json
+    python -m benchmarks.load --engine asyncio --pattern zipf --output new.json --compare load.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from src.framing import EXTENDED
+from src.protocol import CDProto, CDProtoBadFormat
+
+PATTERNS = ["uniform", "zipf", "single"]
+
+
+def rss(pid: int) -> int:
+    """Resident memory of process pid, in bytes (0 if unknown)."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def cpu_time(pid: int) -> float:
+    """User + system CPU seconds used by process pid (nan if unknown)."""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return float("nan")
+
+
+def percentile(ordered, p: float) -> float:
+    """Nearest rank percentile of an ordered list."""
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p * len(ordered)) - 1))]
+
+
+def raise_fd_limit():
+    """Allow as many open sockets as the hard limit does."""
+    try:
+        import resource
+    except ImportError:     # not POSIX
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def wait_port(host: str, port: int, timeout: float = 10):
+    """Wait until something listens on port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"chat server not listening on port {port}")
+
+
+def start_server(engine: str, port: int):
+    """Start `python server.py`, returns (pid, stop function)."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen(
+        [sys.executable, "server.py", "--engine", engine, "--port", str(port)],
+        cwd=root,
+        stdout=subprocess.DEVNULL,
+    )
+    wait_port("localhost", port)
+    return process.pid, lambda: (process.terminate(), process.wait())
+
+
+def memberships(clients: int, channels: int, joins: int, pattern: str, rng: random.Random):
+    """Channels each client joins."""
+    names = [f"#load{n}" for n in range(channels)]
+    if pattern == "single":
+        return [[names[0]] for _ in range(clients)]
+    weights = [1 / (rank + 1) for rank in range(channels)] if pattern == "zipf" else None
+    joined = []
+    for _ in range(clients):
+        picks = set()
+        while len(picks) < min(joins, channels):
+            picks.add(rng.choices(names, weights)[0])
+        joined.append(sorted(picks))
+    return joined
+
+
+class LoadClient:
+    """Simulated chat client: registers, joins its channels, sends and times deliveries."""
+
+    def __init__(self, name: str, channels, run: str):
+        self.name = name
+        self.channels = channels
+        self.run = run
+        self.latencies = []         # ns from send to delivery, of this run's messages
+        self.window = 0             # deliveries received while the load was on
+        self.sent = 0
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, host: str, port: int):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        frames = [CDProto.register(self.name)] + [CDProto.join(channel) for channel in self.channels]
+        self.writer.write(CDProto.encode_many(frames))
+        await self.writer.drain()
+
+    async def receive(self, state):
+        """Read deliveries until the connection closes."""
+        prefix = self.run + " "
+        reader = self.reader
+        try:
+            while True:
+                size = int.from_bytes(await reader.readexactly(2), "big")
+                if size == EXTENDED:
+                    size = int.from_bytes(await reader.readexactly(4), "big")
+                payload = await reader.readexactly(size)
+                now = time.perf_counter_ns()
+                try:
+                    msg = CDProto.decode(payload)
+                except CDProtoBadFormat:
+                    state["bad_frames"] += 1
+                    continue
+                if msg.command != "message" or not msg.message.startswith(prefix):
+                    continue        # register echo, or history of other runs
+                self.latencies.append(now - int(msg.message.split(" ", 2)[1]))
+                if state["sending"]:
+                    self.window += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def send(self, rate: float, start: float, duration: float, padding: str, rng: random.Random, sends):
+        """Send rate messages/sec to random channels of this client until start + duration."""
+        loop = asyncio.get_running_loop()
+        offset = rng.random() / rate        # spread the clients over the first interval
+        while True:
+            due = start + offset + self.sent / rate
+            if due >= start + duration:
+                return
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            channel = rng.choice(self.channels)
+            msg = CDProto.message(f"{self.run} {time.perf_counter_ns()} {padding}", channel)
+            self.writer.write(CDProto.encode(msg))
+            sends[channel] = sends.get(channel, 0) + 1
+            self.sent += 1
+            if self.writer.transport.get_write_buffer_size() > 2**16:
+                await self.writer.drain()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def sample(pid: int, state, interval: float = 0.2):
+    """Track the peak resident memory of the server."""
+    while True:
+        state["server_rss_peak"] = max(state["server_rss_peak"], rss(pid))
+        await asyncio.sleep(interval)
+
+
+async def run(host: str, port: int, pid: int, clients: int, channels: int, joins: int, pattern: str, senders: int,
+              rate: float, payload: int, duration: float, drain: float, connect_rate: int, seed: int):
+    """Run one load scenario against the server on host:port, returns its results."""
+    rng = random.Random(seed)
+    run_id = f"r{time.monotonic_ns()}"
+    joined = memberships(clients, channels, joins, pattern, rng)
+    members = {}
+    for client_channels in joined:
+        for channel in client_channels:
+            members[channel] = members.get(channel, 0) + 1
+    load = [LoadClient(f"load{n}", client_channels, run_id) for n, client_channels in enumerate(joined)]
+    state = {"sending": False, "bad_frames": 0, "server_rss_peak": 0}
+    sampler = asyncio.ensure_future(sample(pid, state)) if pid else None
+
+    # connect in waves, so the listen backlog doesn't overflow
+    connecting = time.perf_counter()
+    errors = 0
+    for first in range(0, clients, connect_rate):
+        wave = load[first:first + connect_rate]
+        results = await asyncio.gather(*(client.connect(host, port) for client in wave), return_exceptions=True)
+        errors += sum(isinstance(result, Exception) for result in results)
+    connected = [client for client in load if client.writer is not None]
+    connect_seconds = time.perf_counter() - connecting
+    receivers = [asyncio.ensure_future(client.receive(state)) for client in connected]
+    await asyncio.sleep(0.5)        # let the joins (and their history replays) through
+
+    loop = asyncio.get_running_loop()
+    padding = "x" * payload
+    sends = {}
+    rss_before = rss(pid) if pid else 0
+    cpu_before = cpu_time(pid) if pid else float("nan")
+    start = loop.time() + 0.1
+    state["sending"] = True
+    await asyncio.gather(*(client.send(rate, start, duration, padding, random.Random(rng.random()), sends)
+                           for client in connected[:senders]))
+    await asyncio.sleep(max(start + duration - loop.time(), 0))
+    window = loop.time() - start
+    state["sending"] = False
+    cpu_used = (cpu_time(pid) if pid else float("nan")) - cpu_before
+    await asyncio.sleep(drain)      # deliveries still in flight
+
+    for client in connected:
+        client.close()
+    for task in receivers + ([sampler] if sampler else []):
+        task.cancel()
+    await asyncio.gather(*receivers, *([sampler] if sampler else []), return_exceptions=True)
+
+    ordered = sorted(latency for client in connected for latency in client.latencies)
+    sent = sum(client.sent for client in connected)
+    expected = sum(count * members[channel] for channel, count in sends.items())
+    return {
+        "clients": clients,
+        "connected": len(connected),
+        "connect_errors": errors,
+        "connect_seconds": connect_seconds,
+        "channels": channels,
+        "joins": joins,
+        "pattern": pattern,
+        "senders": min(senders, len(connected)),
+        "rate": rate,
+        "payload": payload,
+        "duration": window,
+        "sent": sent,
+        "sent_per_sec": sent / window,
+        "expected_deliveries": expected,
+        "deliveries": len(ordered),
+        "lost": expected - len(ordered),
+        "delivered_per_sec": sum(client.window for client in connected) / window,
+        "bad_frames": state["bad_frames"],
+        "p50_ms": percentile(ordered, 0.50) / 1e6,
+        "p90_ms": percentile(ordered, 0.90) / 1e6,
+        "p99_ms": percentile(ordered, 0.99) / 1e6,
+        "p999_ms": percentile(ordered, 0.999) / 1e6,
+        "max_ms": ordered[-1] / 1e6 if ordered else float("nan"),
+        "server_cpu_seconds": cpu_used,
+        "server_cpu_percent": 100 * cpu_used / window,
+        "server_rss_before": rss_before,
+        "server_rss_peak": max(state["server_rss_peak"], rss(pid) if pid else 0),
+    }
+
+
+def key(result) -> tuple:
+    return tuple(result[field] for field in ("clients", "channels", "joins", "pattern", "senders", "rate", "payload"))
+
+
+def compare(result, baseline_path: str):
+    """Print the change of the scenario against the results in baseline_path."""
+    with open(baseline_path) as baseline_file:
+        baseline = {key(old): old for old in json.load(baseline_file)["results"]}
+    old = baseline.get(key(result))
+    if old is None:
+        print(f"No matching scenario in {baseline_path}")
+        return
+    for field in ("delivered_per_sec", "p50_ms", "p99_ms", "server_cpu_percent", "server_rss_peak"):
+        change = result[field] / old[field] - 1 if old[field] else float("nan")
+        print(f"{field:<20} {old[field]:>12.2f} -> {result[field]:>12.2f} {change:>+8.1%}")
+
+
+def commit() -> str:
+    """Current git commit, if any."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", help="simulated clients", type=int, default=1000)
+    parser.add_argument("--channels", help="channels the clients spread over", type=int, default=20)
+    parser.add_argument("--joins", help="channels each client joins", type=int, default=1)
+    parser.add_argument("--pattern", help="how clients pick their channels", choices=PATTERNS, default="uniform")
+    parser.add_argument("--senders", help="clients sending messages (default all)", type=int)
+    parser.add_argument("--rate", help="messages/sec each sender sends", type=float, default=1)
+    parser.add_argument("--payload", help="bytes of padding in every message", type=int, default=64)
+    parser.add_argument("--duration", help="seconds of load", type=float, default=10)
+    parser.add_argument("--drain", help="seconds to wait for deliveries after the load", type=float, default=2)
+    parser.add_argument("--connect-rate", help="clients connecting at once", type=int, default=100)
+    parser.add_argument("--seed", help="seed of the channels and sends picked", type=int, default=0)
+    parser.add_argument("--engine", help="server implementation", choices=["selectors", "asyncio"], default="selectors")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--external", help="load an already running server, don't start one", action="store_true")
+    parser.add_argument("--pid", help="pid of the external server, to sample its CPU and memory", type=int)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results to compare with")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    if args.external:
+        pid, stop = args.pid or 0, lambda: None
+    else:
+        pid, stop = start_server(args.engine, args.port)
+    try:
+        result = asyncio.run(run(args.host, args.port, pid, args.clients, args.channels, args.joins, args.pattern,
+                                 args.clients if args.senders is None else args.senders, args.rate, args.payload,
+                                 args.duration, args.drain, args.connect_rate, args.seed))
+    finally:
+        stop()
+
+    print(f"{result['connected']}/{args.clients} clients connected in {result['connect_seconds']:.2f}s, "
+          f"{result['sent_per_sec']:.0f} sent/s, {result['delivered_per_sec']:.0f} delivered/s, "
+          f"{result['lost']} lost")
+    print(f"fan-out latency ms: p50 {result['p50_ms']:.2f}  p90 {result['p90_ms']:.2f}  "
+          f"p99 {result['p99_ms']:.2f}  p999 {result['p999_ms']:.2f}  max {result['max_ms']:.2f}")
+    print(f"server: {result['server_cpu_percent']:.0f}% cpu, {result['server_rss_peak'] / 2**20:.1f} MB rss peak")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "commit": commit(),
+                "python": platform.python_version(),
+                "engine": "external" if args.external else args.engine,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": [result],
+            }, output, indent=2)
+    if args.compare:
+        compare(result, args.compare)
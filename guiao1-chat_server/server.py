@@ -1,6 +1,39 @@
+import argparse
+
 from src.server import Server
+from src.async_server import AsyncServer
+
+engines = {
+    "selectors": Server,
+    "asyncio": AsyncServer,
+}
 
 if __name__ == "__main__":
-    s = Server()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--engine",
+        help="server implementation",
+        choices=list(engines.keys()),
+        default=list(engines.keys())[0],
+    )
+    parser.add_argument("--port", help="port to listen on", type=int, default=1234)
+    parser.add_argument("--history-messages", help="messages kept per channel, replayed on join", type=int, default=100)
+    parser.add_argument("--history-bytes", help="bytes kept per channel", type=int, default=2**16)
+    parser.add_argument("--history-budget", help="bytes kept over all channels", type=int, default=2**26)
+    parser.add_argument("--replay-seconds", help="only replay the messages of the last seconds", type=float)
+    parser.add_argument("--max-pending", help="bytes buffered for a client before it is disconnected", type=int,
+                        default=2**20)
+    parser.add_argument("--max-frame", help="largest message a client may send, in bytes", type=int, default=2**23)
+    args = parser.parse_args()
+
+    s = engines[args.engine](
+        port=args.port,
+        history_messages=args.history_messages,
+        history_bytes=args.history_bytes,
+        history_budget=args.history_budget,
+        replay_seconds=args.replay_seconds,
+        max_pending=args.max_pending,
+        max_frame=args.max_frame,
+    )
 
     s.loop()
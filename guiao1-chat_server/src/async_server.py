@@ -0,0 +1,134 @@
+"""CD Chat server running on asyncio."""
+import asyncio
+import logging
+
+from src.framing import EXTENDED
+from src.protocol import CDProto, CDProtoBadFormat
+from src.server import Server
+
+
+class Connection:
+    """Client connection writing into the StreamWriter buffer.
+
+    Above high bytes buffered the connection is congested: the clients writing
+    to it wait for it to drain before they are read again.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, high: int):
+        self.reader = reader
+        self.writer = writer
+        self.high = high
+        writer.transport.set_write_buffer_limits(high=high)
+
+    @property
+    def buffered(self) -> int:
+        """Number of bytes waiting to be written."""
+        return self.writer.transport.get_write_buffer_size()
+
+    @property
+    def congested(self) -> bool:
+        return self.buffered > self.high
+
+    def close(self):
+        self.writer.close()
+
+    def __repr__(self):
+        return f"Connection({self.writer.get_extra_info('peername')})"
+
+
+class AsyncServer(Server):
+    """Chat server on asyncio streams, wire compatible with Server.
+
+    Every frame is appended to the StreamWriter buffer of its receiver. A
+    client is only read again once the receivers it wrote to are below their
+    high-water mark; a receiver that doesn't drain within drain_timeout
+    seconds is disconnected, so it can't stall the clients writing to it.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 1234, high: int = 2**16, drain_timeout: float = 5,
+                 **history_options):
+        self.high = high
+        self.drain_timeout = drain_timeout
+        self._congested = set()     # connections congested by the message being handled
+        super().__init__(host, port, **history_options)
+
+    def listen(self):
+        """The socket is created by the event loop in loop."""
+        self.server = None
+
+    async def _recv(self, conn: Connection):
+        """Read the next message from conn, None when the connection is closed."""
+        try:
+            header = int.from_bytes(await conn.reader.readexactly(2), "big")
+            if header == EXTENDED:
+                header = int.from_bytes(await conn.reader.readexactly(4), "big")
+            if header > self.maxFrame:
+                logging.warning("Disconnecting %s: frame of %d bytes, the limit is %d", conn, header, self.maxFrame)
+                return None
+            return CDProto.decode(await conn.reader.readexactly(header))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def _client(self, reader, writer):
+        """Serve a client until it closes."""
+        conn = Connection(reader, writer, self.high)
+        self.connected(conn)
+        try:
+            while True:
+                try:
+                    data = await self._recv(conn)
+                except CDProtoBadFormat:
+                    logging.warning("Bad message format from %s", conn)
+                    continue
+                if data is None:
+                    break
+                self._congested = set()
+                self.handle(conn, data)
+                congested, self._congested = self._congested, set()
+
+                # backpressure: stop reading this client while a receiver it wrote to is congested
+                if congested:
+                    await asyncio.gather(*(self._drain(receiver) for receiver in congested))
+        finally:
+            self.disconnect(conn)
+
+    async def _drain(self, conn: Connection):
+        """Wait for conn to drain, disconnecting it if it takes too long."""
+        try:
+            await asyncio.wait_for(conn.writer.drain(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Disconnecting slow client %s: %d bytes pending", conn, conn.buffered)
+            self.disconnect(conn)
+        except ConnectionError:
+            pass
+
+    def write(self, conn, frame: bytes):
+        """Append frame to the write buffer of conn."""
+        if conn not in self.dic or conn.writer.is_closing():
+            return
+        conn.writer.write(frame)
+        if conn.congested:
+            self._congested.add(conn)
+
+    def disconnect(self, conn):
+        """Forget a closed connection."""
+        if conn not in self.dic:
+            return
+        logging.debug("Closing: %s", conn)
+        self.forget(conn)
+        self._congested.discard(conn)
+        conn.close()
+
+    async def serve(self):
+        """Accept clients until cancelled."""
+        self.server = await asyncio.start_server(self._client, self.host, self.port, reuse_address=True,
+                                                 backlog=1024)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def loop(self):
+        """Loop indefinetely."""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Caught keyboard interrupt, exiting")
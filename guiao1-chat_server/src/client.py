@@ -7,6 +7,7 @@ import fcntl
 import os
 import json
 
+from .framing import FrameDecoder, send_pending
 from .protocol import CDProto, CDProtoBadFormat
 
 logging.basicConfig(filename=f"{sys.argv[0]}.log", level=logging.DEBUG)
@@ -21,7 +22,8 @@ class Client:
         self.canal = None
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sel = selectors.DefaultSelector()
-        
+        self.decoder = FrameDecoder()
+        self.outgoing = bytearray()     # what the socket didn't take yet, sent once it is writable
 
     def connect(self):
         """Connect to chat server and setup stdin flags."""
@@ -47,22 +49,43 @@ class Client:
         else:
             msg = CDProto.message(data_cmd, self.canal)
         
-        CDProto.send_msg(self.client, msg)
+        self.send(msg)
+
+    def send(self, msg):
+        """Send msg, queueing what the socket doesn't take until it is writable."""
+        CDProto.send_msg(self.client, msg, outgoing=self.outgoing)
+        if self.outgoing:
+            self.sel.modify(self.client, selectors.EVENT_READ | selectors.EVENT_WRITE, self.receive_msg)
+
+    def flush(self):
+        """Send the queued bytes the socket takes."""
+        if not send_pending(self.client, self.outgoing):
+            self.sel.modify(self.client, selectors.EVENT_READ, self.receive_msg)
     
     def receive_msg(self):
         """Receive message from server."""
-        data = CDProto.recv_msg(self.client)
-        if data:
-            print(data)
+        data = CDProto.recv_msg(self.client, self.decoder)
+        while data or self.decoder.has_frame():
+            if data:
+                print(data)
+            data = CDProto.recv_msg(self.client, self.decoder)
+        if self.decoder.closed:
+            print("Server closed the connection")
+            self.sel.unregister(self.client)
+            self.client.close()
+            sys.exit()
 
     def loop(self):
         """Loop indefinetely."""
         registro = CDProto.register(self.name)
-        CDProto.send_msg(self.client, registro)
+        self.send(registro)
 
         while True:
             events = self.sel.select()
             for key, mask in events:
-                callback = key.data
-                callback()
+                if mask & selectors.EVENT_WRITE:
+                    self.flush()
+                if mask & selectors.EVENT_READ:
+                    callback = key.data
+                    callback()
 
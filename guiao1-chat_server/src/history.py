@@ -0,0 +1,42 @@
+"""Bounded history of the frames sent on a chat channel."""
+import time
+from collections import deque
+from typing import List, Optional
+
+
+class History:
+    """Ring buffer of encoded frames, bounded by count and bytes.
+
+    The frames are kept as sent, so replaying them costs a join and a write.
+    """
+
+    __slots__ = ("max_messages", "max_bytes", "frames", "bytes")
+
+    def __init__(self, max_messages: int = 100, max_bytes: int = 2**16):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.frames = deque()       # (time sent, frame), oldest first
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def append(self, frame: bytes, now: Optional[float] = None):
+        """Keep frame, dropping the oldest ones past the bounds."""
+        if len(frame) > self.max_bytes:
+            return
+        self.frames.append((time.monotonic() if now is None else now, frame))
+        self.bytes += len(frame)
+        while len(self.frames) > self.max_messages or self.bytes > self.max_bytes:
+            self.bytes -= len(self.frames.popleft()[1])
+
+    def last(self, count: Optional[int] = None, seconds: Optional[float] = None,
+             now: Optional[float] = None) -> List[bytes]:
+        """The last count frames, or those sent in the last seconds (both limits if given)."""
+        frames = list(self.frames)
+        if count is not None:
+            frames = frames[-count:] if count > 0 else []
+        if seconds is not None:
+            since = (time.monotonic() if now is None else now) - seconds
+            frames = [entry for entry in frames if entry[0] >= since]
+        return [frame for _, frame in frames]
@@ -1,33 +1,61 @@
 """Protocol for chat server - Computação Distribuida Assignment 1."""
 import json
-from datetime import datetime
+import time
+from json.encoder import encode_basestring_ascii as _quote
 from socket import socket
+from typing import Iterable, List
+
+from .framing import EXTENDED, PROTOCOL_VERSION, FrameDecoder, frame_header, recv_exactly, recv_payload, send_frame
+
+# JSON of each message, up to its fields: the same bytes json.dumps gives
+_REGISTER = '{"command": "register", "user": '
+_JOIN = '{"command": "join", "channel": '
+_MESSAGE = '{"command": "message", "message": '
+
+_scan = json.JSONDecoder().scan_once    # parses one JSON value, without json.loads' checks
 
 
 class Message:
     """Message Type."""
+
+    __slots__ = ("command",)
+
     def __init__(self, command):
         self.command = command
     
 class JoinMessage(Message):
     """Message to join a chat channel."""
+
+    __slots__ = ("channel",)
+
     def __init__(self,command,channel):
         super().__init__("join")
         self.channel = channel
     def __str__(self):
         return f'{{"command": "{self.command}", "channel": "{self.channel}"}}'
+    def encode(self) -> bytes:
+        return f'{_JOIN}{_quote(self.channel)}}}'.encode("ascii")
 
 class RegisterMessage(Message):
     """Message to register username in the server."""
-    def __init__(self,commad, user):
+
+    __slots__ = ("user", "version")
+
+    def __init__(self,commad, user, version = PROTOCOL_VERSION):
         super().__init__("register")
         self.user = user
+        self.version = version
     def __str__(self):
         return f'{{"command": "{self.command}", "user": "{self.user}"}}'
+    def encode(self) -> bytes:
+        return f'{_REGISTER}{_quote(self.user)}, "version": {int(self.version)}}}'.encode("ascii")
 
     
 class TextMessage(Message):
     """Message to chat with other clients."""
+
+    __slots__ = ("message", "channel")
+
     def __init__(self,command, message,channel = None):
         super(TextMessage, self).__init__(command)
         self.message = message
@@ -35,9 +63,48 @@ class TextMessage(Message):
 
     def __str__(self):
         if self.channel == None:
-            return f'{{"command": "{self.command}", "message": "{self.message}", "ts": {int(datetime.utcnow().timestamp())}}}'
+            return f'{{"command": "{self.command}", "message": "{self.message}", "ts": {int(time.time())}}}'
         else:
-            return f'{{"command": "{self.command}", "message": "{self.message}", "channel": "{self.channel}", "ts": {int(datetime.utcnow().timestamp())}}}'
+            return f'{{"command": "{self.command}", "message": "{self.message}", "channel": "{self.channel}", "ts": {int(time.time())}}}'
+
+    def encode(self) -> bytes:
+        channel = "null" if self.channel is None else _quote(self.channel)
+        return f'{_MESSAGE}{_quote(self.message)}, "channel": {channel}}}'.encode("ascii")
+
+
+def _register(msg: dict) -> RegisterMessage:
+    register = RegisterMessage.__new__(RegisterMessage)
+    register.command = "register"
+    register.user = msg["user"]
+    register.version = msg.get("version", 1)
+    return register
+
+def _join(msg: dict) -> JoinMessage:
+    join = JoinMessage.__new__(JoinMessage)
+    join.command = "join"
+    join.channel = msg["channel"]
+    return join
+
+def _message(msg: dict) -> TextMessage:
+    text = TextMessage.__new__(TextMessage)
+    text.command = "message"
+    text.message = msg["message"]
+    text.channel = msg.get("channel")
+    return text
+
+# command -> builds the message from its JSON object
+_DECODERS = {
+    "register": _register,
+    "join": _join,
+    "message": _message,
+}
+
+def _parse(text: str) -> Message:
+    text = text.strip(" \t\n\r")     # whitespace JSON allows around a value
+    msg, end = _scan(text, 0)
+    if end != len(text):
+        raise ValueError(f"Extra data after the JSON object: {text[end:]!r}")
+    return _DECODERS[msg["command"]](msg)
 
 
 class CDProto:
@@ -63,44 +130,81 @@ class CDProto:
         return TextMessage(command, message, channel)
 
     @classmethod
-    def send_msg(cls, connection: socket, msg: Message):
-        """Sends through a connection a Message object."""
-        if type(msg) is RegisterMessage:
-            data = json.dumps({"command": "register", "user": msg.user})
-        elif type(msg) is JoinMessage:
-            data = json.dumps({"command": "join", "channel": msg.channel})
-        elif type(msg) is TextMessage:
-            data = json.dumps({"command": "message", "message": msg.message, "channel": msg.channel})
-        
-        msg_header = len(data).to_bytes(2, "big")
-        connection.send(msg_header + data.encode("utf-8"))
+    def send_msg(cls, connection: socket, msg: Message, version: int = PROTOCOL_VERSION, outgoing: bytearray = None):
+        """Sends through a connection a Message object.
+
+        Messages of 64 KiB or more need protocol version 2 (OverflowError otherwise).
+        On a non-blocking connection, what it doesn't take is queued in outgoing
+        (see send_frame).
+        """
+        data = msg.encode()
+        send_frame(connection, frame_header(len(data), version), data, outgoing=outgoing)
+
+    @classmethod
+    def encode(cls, msg: Message, version: int = PROTOCOL_VERSION) -> bytes:
+        """Encodes a Message object into a frame: header + JSON."""
+        data = msg.encode()
+        return frame_header(len(data), version) + data
+
+    @classmethod
+    def encode_many(cls, msgs: Iterable[Message], version: int = PROTOCOL_VERSION) -> bytes:
+        """Encodes several Message objects into consecutive frames, to be sent at once."""
+        frames = []
+        for msg in msgs:
+            data = msg.encode()
+            frames.append(frame_header(len(data), version))
+            frames.append(data)
+        return b"".join(frames)
+
+    @classmethod
+    def decode(cls, data: bytes) -> Message:
+        """Decodes the JSON payload of a frame into a Message object."""
+        try:
+            return _parse(str(data, "utf-8"))
+        except Exception:
+            raise CDProtoBadFormat(bytes(data))
+
+    @classmethod
+    def decode_many(cls, data: bytes) -> List[Message]:
+        """Decodes consecutive complete frames into Message objects."""
+        msgs = []
+        offset = 0
+        while offset < len(data):
+            size = (data[offset] << 8) | data[offset + 1]
+            offset += 2
+            if size == EXTENDED:
+                size = int.from_bytes(data[offset:offset + 4], "big")
+                offset += 4
+            msgs.append(cls.decode(data[offset:offset + size]))
+            offset += size
+        return msgs
 
     @classmethod
-    def recv_msg(cls, connection: socket) -> Message:
-        """Receives through a connection a Message object."""
-        msg_header = connection.recv(2)
-        if msg_header:
-            msg_header = int.from_bytes(msg_header, "big")
-            msg = connection.recv(msg_header).decode("utf-8")
-            try:
-                msg = json.loads(msg)
-            except :
-                raise CDProtoBadFormat(msg)
-
-            cmd = msg["command"]
-            if cmd == "register":
-                return RegisterMessage("register",msg["user"])
-            elif cmd == "join":
-                return JoinMessage("join",msg["channel"])
-            elif cmd == "message":
-                if "channel" in msg:
-                    return TextMessage("message",msg["message"], msg["channel"])
-                else:
-                    return TextMessage("message",msg["message"])
-            else:
-                raise CDProtoBadFormat(msg)
+    def recv_msg(cls, connection: socket, decoder: FrameDecoder = None) -> Message:
+        """Receives through a connection a Message object.
+
+        With a decoder, only reads what the connection has available and returns
+        None while the next frame is incomplete (decoder.closed tells EOF). A
+        frame above the limit of the decoder raises CDProtoBadFormat, and closes it.
+        """
+        if decoder is not None:
+            if not decoder.has_frame():
+                decoder.feed_from(connection)
+            if decoder.rejected is not None:
+                raise CDProtoBadFormat(f"Frame of {decoder.rejected} bytes, the limit is {decoder.max_frame}".encode("utf-8"))
+            frame = decoder.next_frame()
+            if frame is None:
+                return None
+            msg = frame[1]
         else:
-            return None
+            msg_header = connection.recv(2)
+            if not msg_header:
+                return None
+            if len(msg_header) < 2:
+                msg_header += recv_exactly(connection, 1)
+            msg = recv_payload(connection, msg_header)
+
+        return cls.decode(msg)
                       
 class CDProtoBadFormat(Exception):
     """Exception when source message is not CDProto."""
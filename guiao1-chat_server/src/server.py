@@ -2,63 +2,236 @@
 import logging
 import selectors
 import socket
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from src.framing import EXTENDED, MAX_FRAME, FrameDecoder
+from src.history import History
 from src.protocol import CDProto, CDProtoBadFormat
 
 logging.basicConfig(filename="server.log", level=logging.DEBUG)
 
 
 class Server:
-    """Chat Server process."""
-    def __init__(self):
+    """Chat Server process.
+
+    Each channel keeps its last history_messages frames (up to history_bytes),
+    replayed to clients joining it; replay_seconds limits the replay to the
+    recent ones. Past history_budget bytes over all channels, the histories of
+    the channels quiet for the longest are dropped.
+
+    A client that doesn't read is disconnected once more than max_pending
+    bytes wait for it (a single frame is always buffered), and a client
+    announcing a frame above max_frame bytes as soon as it does.
+    """
+    def __init__(self, host: str = "localhost", port: int = 1234, history_messages: int = 100,
+                 history_bytes: int = 2**16, history_budget: int = 2**26, replay_seconds: Optional[float] = None,
+                 max_pending: int = 2**20, max_frame: int = MAX_FRAME):
+        self.host = host
+        self.port = port
+        self.maxPending = max_pending
+        self.maxFrame = max_frame
+        self.historyMessages = history_messages
+        self.historyBytes = history_bytes
+        self.historyBudget = history_budget
+        self.replaySeconds = replay_seconds
+        self.history = OrderedDict()    # channel -> History, least recently written first
+        self.historySize = 0            # bytes in every history
+        self.clients = {}
+        self.dic = {}
+        self.decoders = {}
+        self.versions = {}      # protocol version each client registered with
+        self.channels = {}      # channel -> connections in it (None is the default channel)
+        self.outgoing = {}      # connection -> bytes waiting for it to be writable
+        self.listen()
+        print("Server has started")
+
+    def listen(self):
+        """Bind the server socket and register it in the selector."""
         self.sel = selectors.DefaultSelector()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind((("localhost", 1234)))
+        self.sock.bind(((self.host, self.port)))
         self.sock.listen(110)
         self.sel.register(self.sock, selectors.EVENT_READ, self.accept)
-        print("Server has started")
-        self.clients = {}
-        self.dic = {}
-        #misses the rest of the code
     
     def accept(self,sock, mask):
         conn, addr = sock.accept()
         print("New connection accepted from %s", addr)
         conn.setblocking(False)
         self.sel.register(conn, selectors.EVENT_READ, self.read)
+        self.connected(conn)
+        self.decoders[conn] = FrameDecoder(max_frame=self.maxFrame)
+        self.outgoing[conn] = bytearray()
+
+    def connected(self, conn):
+        """Put a new connection in the default channel."""
         self.dic[conn] = [None]
+        self.channels.setdefault(None, set()).add(conn)
 
     def read(self, conn, mask):
+        decoder = self.decoders[conn]
+        data = self.recv(conn, decoder)
+        # handle every complete message received, a partial one waits for more data
+        while data or decoder.has_frame():
+            if data:
+                self.handle(conn, data)
+            if conn not in self.decoders:   # disconnected while handling
+                return
+            data = self.recv(conn, decoder)
+
+        if decoder.closed:
+            self.disconnect(conn)
+
+    def disconnect(self, conn):
+        """Forget a closed connection."""
+        if conn not in self.decoders:
+            return
+        print("Closing connection")
+        logging.debug("Closing: %s",conn)
+        self.sel.unregister(conn)
+        conn.close()
+        self.forget(conn)
+
+    def forget(self, conn):
+        """Remove a closed connection from its channels."""
+        for channel in self.dic.pop(conn, ()):
+            members = self.channels.get(channel)
+            if members is not None:
+                members.discard(conn)
+                if not members:
+                    del self.channels[channel]
+        self.decoders.pop(conn, None)
+        self.versions.pop(conn, None)
+        self.outgoing.pop(conn, None)
+
+    def recv(self, conn, decoder):
+        """Receive the next buffered message from conn, if complete."""
         try:
-            data = CDProto.recv_msg(conn)
+            return CDProto.recv_msg(conn, decoder)
         except CDProtoBadFormat:
             print("Bad message format")
+            return None
+
+    def handle(self, conn, data):
+        """Process a message received from conn."""
+        logging.debug("Received %s from %s", data, conn)
+
+        if data.command == "register":
+            self.versions[conn] = data.version
+            self.send(conn, data)
+        elif data.command == "message":
+            self.broadcast(data)
+        elif data.command == "join":
+            if self.dic[conn] == None:
+                self.dic[conn].remove(None)
+            if data.channel not in self.dic[conn]:
+                self.dic[conn].append(data.channel)
+                self.channels.setdefault(data.channel, set()).add(conn)
+                self.replay(conn, data.channel)
 
-        if data:
-            print('echoing', data, 'to', conn)
-            logging.debug(data)
-
-            if data.command == "register":
-                CDProto.send_msg(conn, data)
-            elif data.command == "message":
-                for key,value in self.dic.items():
-                        if data.channel in value:
-                            CDProto.send_msg(key, data)
-            elif data.command == "join":
-                if self.dic[conn] == None:
-                    self.dic[conn].remove(None)
-                if data.channel not in self.dic[conn]:
-                    self.dic[conn].append(data.channel)
-                
-        else:
-            print("Closing connection")
-            logging.debug("Closing: %s",conn)
-            self.sel.unregister(conn)
-            conn.close()
-            self.dic.pop(conn)
-
-        
         #function needs to follow the protocol and see if the message is a command or a message
 
+    def broadcast(self, msg):
+        """Send msg to the members of its channel, encoding it once."""
+        members = self.channels.get(msg.channel)
+        if not members:
+            return
+        frame = CDProto.encode(msg)
+        extended = int.from_bytes(frame[:2], "big") == EXTENDED
+        for conn in list(members):
+            if extended and self.versions.get(conn, 1) < 2:
+                logging.warning("Not sent to %s: frame of %d bytes needs protocol version 2", conn, len(frame))
+                continue
+            self.write(conn, frame)
+        self.remember(msg.channel, frame)
+
+    def remember(self, channel, frame: bytes):
+        """Add frame to the history of channel, within the memory budget."""
+        if channel is None or not self.historyMessages:
+            return
+        history = self.history.get(channel)
+        if history is None:
+            history = self.history[channel] = History(self.historyMessages, self.historyBytes)
+        self.history.move_to_end(channel)
+        self.historySize -= history.bytes
+        history.append(frame)
+        self.historySize += history.bytes
+        while self.historySize > self.historyBudget and len(self.history) > 1:
+            _, dropped = self.history.popitem(last=False)
+            self.historySize -= dropped.bytes
+
+    def replay(self, conn, channel):
+        """Send conn the history of channel, in a single write."""
+        history = self.history.get(channel)
+        if history is None:
+            return
+        frames = history.last(seconds=self.replaySeconds)
+        if self.versions.get(conn, 1) < 2:
+            frames = [frame for frame in frames if int.from_bytes(frame[:2], "big") != EXTENDED]
+        if frames:
+            self.write(conn, b"".join(frames))
+
+    def history_stats(self) -> Dict[str, Any]:
+        """Memory used by the channel histories."""
+        return {
+            "channels": {channel: {"messages": len(h), "bytes": h.bytes} for channel, h in self.history.items()},
+            "bytes": self.historySize,
+            "budget": self.historyBudget,
+        }
+
+    def send(self, conn, msg):
+        """Send msg to conn, unless it is too large for the protocol version of conn."""
+        try:
+            self.write(conn, CDProto.encode(msg, self.versions.get(conn, 1)))
+        except OverflowError as err:
+            logging.warning("Not sent to %s: %s", conn, err)
+
+    def write(self, conn, frame: bytes):
+        """Send frame to conn, buffering what the socket doesn't take right away."""
+        pending = self.outgoing.get(conn)
+        if pending is None:
+            return
+        if pending:
+            if len(pending) + len(frame) > self.maxPending:
+                logging.warning("Disconnecting slow client %s: %d bytes pending", conn, len(pending))
+                self.disconnect(conn)
+                return
+            pending += frame        # behind earlier frames, sent once writable
+            return
+        try:
+            sent = conn.send(frame)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect(conn)
+            return
+        if sent < len(frame):
+            pending += frame[sent:]
+            self.sel.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, self.ready)
+
+    def ready(self, conn, mask):
+        """Handle a connection with buffered frames."""
+        if mask & selectors.EVENT_WRITE:
+            self.flush(conn)
+        if mask & selectors.EVENT_READ and conn in self.decoders:
+            self.read(conn, mask)
+
+    def flush(self, conn):
+        """Send the buffered frames of conn, until it would block."""
+        pending = self.outgoing.get(conn)
+        if pending is None:
+            return
+        try:
+            sent = conn.send(pending)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect(conn)
+            return
+        del pending[:sent]
+        if not pending:
+            self.sel.modify(conn, selectors.EVENT_READ, self.read)
+
     def loop(self):
         """Loop indefinetely."""
         try:
@@ -0,0 +1,26 @@
+"""Tests for the channel history."""
+from src.history import History
+
+
+def test_bounds():
+    history = History(max_messages=3, max_bytes=10)
+    for n in range(5):
+        history.append(b"%d" % n)
+    assert history.last() == [b"2", b"3", b"4"] and history.bytes == 3
+
+    history.append(b"x" * 8)
+    assert history.last() == [b"3", b"4", b"x" * 8] and history.bytes == 10
+    history.append(b"y")
+    assert history.last() == [b"4", b"x" * 8, b"y"] and history.bytes == 10
+    history.append(b"z" * 11)                   # larger than the whole history
+    assert len(history) == 3
+
+
+def test_last():
+    history = History()
+    for n in range(5):
+        history.append(b"%d" % n, now=100 + n)
+    assert history.last(2) == [b"3", b"4"]
+    assert history.last(seconds=1.5, now=104) == [b"3", b"4"]
+    assert history.last(1, seconds=10, now=104) == [b"4"]
+    assert history.last(0) == []
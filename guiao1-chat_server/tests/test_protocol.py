@@ -1,4 +1,6 @@
 """Tests for the chat protocol."""
+from pathlib import Path
+
 import pytest
 from src.protocol import (
     CDProto,
@@ -59,3 +61,139 @@ def test_recv():
 
     with pytest.raises(CDProtoBadFormat):
         CDProto.recv_msg(mock_socket(b"Hello World"))
+
+
+def test_recv_partial():
+    import socket
+    from src.framing import FrameDecoder
+
+    a, b = socket.socketpair()
+    b.setblocking(False)
+    decoder = FrameDecoder()
+
+    CDProto.send_msg(a, CDProto.join("#cd"))
+    CDProto.send_msg(a, CDProto.message("Hello World", "#cd"))
+    stream = b.recv(1024)
+
+    a2, b2 = socket.socketpair()
+    b2.setblocking(False)
+    a2.sendall(stream[:5])
+    assert CDProto.recv_msg(b2, decoder) is None
+    assert not decoder.closed
+
+    a2.sendall(stream[5:])
+    assert isinstance(CDProto.recv_msg(b2, decoder), JoinMessage)
+    assert decoder.has_frame()
+    assert CDProto.recv_msg(b2, decoder).message == "Hello World"
+
+    a2.close()
+    assert CDProto.recv_msg(b2, decoder) is None
+    assert decoder.closed
+
+    for s in (a, b, b2):
+        s.close()
+
+
+def test_large_message():
+    import socket
+    import threading
+    from src.framing import FrameDecoder
+
+    text = "Olá " * 30000
+    with pytest.raises(OverflowError):
+        CDProto.send_msg(socket.socket(), CDProto.message(text, "#cd"), version=1)
+
+    a, b = socket.socketpair()
+    b.setblocking(False)
+    decoder = FrameDecoder(size=64)
+    sender = threading.Thread(target=CDProto.send_msg, args=(a, CDProto.message(text, "#cd")))
+    sender.start()
+    msg = None
+    while msg is None:
+        msg = CDProto.recv_msg(b, decoder)
+    sender.join()
+    assert msg.message == text
+
+    CDProto.send_msg(a, CDProto.register("student"))
+    b.setblocking(True)
+    assert CDProto.recv_msg(b).version == 2
+
+    for s in (a, b):
+        s.close()
+
+
+def test_codec():
+    import json
+
+    msgs = [
+        CDProto.register("student"),
+        CDProto.join("#cd"),
+        CDProto.message('Olá "Mundo"\n', "#cd"),
+        CDProto.message("Hello World"),
+    ]
+    # the same bytes json.dumps gives
+    assert msgs[0].encode() == json.dumps({"command": "register", "user": "student", "version": 2}).encode()
+    assert msgs[2].encode() == json.dumps({"command": "message", "message": 'Olá "Mundo"\n', "channel": "#cd"}).encode()
+
+    decoded = CDProto.decode_many(CDProto.encode_many(msgs))
+    assert [type(msg) for msg in decoded] == [RegisterMessage, JoinMessage, TextMessage, TextMessage]
+    assert decoded[0].user == "student" and decoded[1].channel == "#cd"
+    assert decoded[2].message == 'Olá "Mundo"\n' and decoded[3].channel is None
+
+    with pytest.raises(CDProtoBadFormat):
+        CDProto.decode(b'{"command": "shout"}')
+
+
+def test_decode_whitespace_and_trailing_data():
+    # any JSON json.loads takes is decoded, whitespace around it included
+    for text in [' {"command": "join", "channel": "#cd"}', '\n\t{"command": "join", "channel": "#cd"} \r\n']:
+        assert CDProto.decode(text.encode()).channel == "#cd"
+
+    for text in ['{"command": "join", "channel": "#cd"}}', '{"command": "join", "channel": "#cd"} x', '', ' ']:
+        with pytest.raises(CDProtoBadFormat):
+            CDProto.decode(text.encode())
+
+
+def test_send_non_blocking():
+    import socket
+    import threading
+    from src.framing import FrameDecoder, send_pending
+
+    text = "Olá " * 500000     # 2 MB, far more than the socket buffers hold
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    b.setblocking(False)
+    decoder = FrameDecoder()
+
+    # the rest is queued, to be sent once the socket is writable
+    outgoing = bytearray()
+    CDProto.send_msg(a, CDProto.message(text, "#cd"), outgoing=outgoing)
+    assert outgoing
+    CDProto.send_msg(a, CDProto.join("#cd"), outgoing=outgoing)
+    msgs = []
+    while len(msgs) < 2:
+        send_pending(a, outgoing)
+        msg = CDProto.recv_msg(b, decoder)
+        if msg is not None:
+            msgs.append(msg)
+    assert msgs[0].message == text and msgs[1].channel == "#cd"
+
+    # without a queue, it waits for the socket to be writable
+    sender = threading.Thread(target=CDProto.send_msg, args=(a, CDProto.message(text, "#cd")))
+    sender.start()
+    msg = None
+    while msg is None:
+        msg = CDProto.recv_msg(b, decoder)
+    sender.join()
+    assert msg.message == text
+    a.close()
+    b.close()
+
+
+def test_framing_copies_in_sync():
+    """The message broker ships the same framing module."""
+    root = Path(__file__).resolve().parents[2]
+    other = root / "guiao3-Message_Broker" / "src" / "framing.py"
+    if not other.exists():
+        pytest.skip("message broker isn't checked out")
+    assert (root / "guiao1-chat_server" / "src" / "framing.py").read_bytes() == other.read_bytes()
@@ -31,3 +31,234 @@ def test_server():
 
             with pytest.raises(CDProtoException):
                 s.loop()
+
+
+def test_channels():
+    """Messages go to the members of their channel only."""
+    import socket as sockets
+    import threading
+    import time
+    from src.protocol import CDProto
+
+    server = Server(port=0)
+    threading.Thread(target=server.loop, daemon=True).start()
+    port = server.sock.getsockname()[1]
+
+    clients = []
+    for name in ["a", "b", "c"]:
+        client = sockets.create_connection(("localhost", port))
+        client.settimeout(2)
+        CDProto.send_msg(client, CDProto.register(name))
+        assert CDProto.recv_msg(client).user == name
+        clients.append(client)
+    a, b, c = clients
+    CDProto.send_msg(a, CDProto.join("#cd"))
+    CDProto.send_msg(b, CDProto.join("#cd"))
+    time.sleep(0.1)
+    assert len(server.channels["#cd"]) == 2 and len(server.channels[None]) == 3
+
+    CDProto.send_msg(a, CDProto.message("Olá", "#cd"))
+    assert CDProto.recv_msg(a).message == "Olá"
+    assert CDProto.recv_msg(b).message == "Olá"
+    CDProto.send_msg(c, CDProto.message("Anyone?"))
+    assert CDProto.recv_msg(c).message == "Anyone?"
+    with pytest.raises(sockets.timeout):
+        c.settimeout(0.2)
+        CDProto.recv_msg(c)
+
+    b.close()
+    time.sleep(0.1)
+    assert len(server.channels["#cd"]) == 1 and len(server.channels[None]) == 2
+    for client in (a, c):
+        client.close()
+
+
+def test_async_server():
+    """The asyncio server speaks the same protocol, and drops clients that don't read."""
+    import socket as sockets
+    import threading
+    import time
+    from src.async_server import AsyncServer
+    from src.protocol import CDProto
+
+    server = AsyncServer(port=0, high=1024, drain_timeout=0.5)
+    threading.Thread(target=server.loop, daemon=True).start()
+    while server.server is None or not server.server.sockets:
+        time.sleep(0.01)
+    port = server.server.sockets[0].getsockname()[1]
+
+    clients = []
+    for name in ["a", "b", "stuck"]:
+        client = sockets.socket()
+        client.setsockopt(sockets.SOL_SOCKET, sockets.SO_RCVBUF, 4096)
+        client.connect(("localhost", port))
+        client.settimeout(2)
+        CDProto.send_msg(client, CDProto.register(name))
+        assert CDProto.recv_msg(client).user == name
+        CDProto.send_msg(client, CDProto.join("#cd"))
+        clients.append(client)
+    a, b, stuck = clients
+    time.sleep(0.1)
+
+    text = "x" * 10000
+    received = []
+
+    def read():
+        while len(received) < 1000:
+            received.append(CDProto.recv_msg(b).message)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for n in range(1000):
+        CDProto.send_msg(a, CDProto.message(f"{n} {text}", "#cd"))
+        assert CDProto.recv_msg(a).message.startswith(f"{n} ")
+    reader.join(5)
+    assert len(received) == 1000 and received[-1].startswith("999 ")
+
+    time.sleep(0.2)
+    assert len(server.channels["#cd"]) == 2     # the stuck client was disconnected
+    for client in clients:
+        client.close()
+
+
+def test_history():
+    """Joining a channel replays its last messages, within the memory budget."""
+    import socket as sockets
+    import threading
+    import time
+    from src.protocol import CDProto
+
+    server = Server(port=0, history_messages=3, history_budget=200)
+    threading.Thread(target=server.loop, daemon=True).start()
+    port = server.sock.getsockname()[1]
+
+    a = sockets.create_connection(("localhost", port))
+    a.settimeout(2)
+    CDProto.send_msg(a, CDProto.join("#old"))
+    CDProto.send_msg(a, CDProto.message("forgotten", "#old"))
+    CDProto.send_msg(a, CDProto.join("#cd"))
+    for n in range(5):
+        CDProto.send_msg(a, CDProto.message(f"{n}", "#cd"))
+    assert [CDProto.recv_msg(a).message for _ in range(6)] == ["forgotten", "0", "1", "2", "3", "4"]
+
+    b = sockets.create_connection(("localhost", port))
+    b.settimeout(2)
+    CDProto.send_msg(b, CDProto.join("#cd"))
+    assert [CDProto.recv_msg(b).message for _ in range(3)] == ["2", "3", "4"]
+    CDProto.send_msg(a, CDProto.message("live", "#cd"))
+    assert CDProto.recv_msg(b).message == "live"
+
+    stats = server.history_stats()
+    assert stats["channels"]["#cd"]["messages"] == 3
+    assert "#old" not in stats["channels"] and stats["bytes"] <= 200     # least recent dropped first
+    for client in (a, b):
+        client.close()
+
+
+def test_max_pending():
+    """A client that doesn't read is disconnected past max_pending bytes buffered for it."""
+    import socket as sockets
+    import threading
+    import time
+    from src.protocol import CDProto
+
+    server = Server(port=0, max_pending=2**16)
+    threading.Thread(target=server.loop, daemon=True).start()
+    port = server.sock.getsockname()[1]
+
+    clients = []
+    for name in ["a", "stuck"]:
+        client = sockets.socket()
+        client.setsockopt(sockets.SOL_SOCKET, sockets.SO_RCVBUF, 4096)
+        client.connect(("localhost", port))
+        client.settimeout(2)
+        CDProto.send_msg(client, CDProto.register(name))
+        assert CDProto.recv_msg(client).user == name
+        CDProto.send_msg(client, CDProto.join("#cd"))
+        clients.append(client)
+    a, stuck = clients
+    time.sleep(0.1)
+
+    text = "x" * 10000
+    for n in range(1000):
+        CDProto.send_msg(a, CDProto.message(f"{n} {text}", "#cd"))
+        assert CDProto.recv_msg(a).message.startswith(f"{n} ")
+        assert all(len(pending) <= 2**16 for pending in list(server.outgoing.values()))
+
+    time.sleep(0.1)
+    assert len(server.channels["#cd"]) == 1     # the stuck client was disconnected
+    assert len(server.outgoing) == 1
+    for client in clients:
+        client.close()
+
+
+@pytest.mark.parametrize("engine", ["selectors", "asyncio"])
+def test_max_frame(engine):
+    """A client announcing a frame above max_frame is disconnected before the frame is read."""
+    import socket as sockets
+    import threading
+    import time
+    from src.async_server import AsyncServer
+    from src.protocol import CDProto
+
+    server = (Server if engine == "selectors" else AsyncServer)(port=0, max_frame=2**16)
+    threading.Thread(target=server.loop, daemon=True).start()
+    if engine == "selectors":
+        port = server.sock.getsockname()[1]
+    else:
+        while server.server is None or not server.server.sockets:
+            time.sleep(0.01)
+        port = server.server.sockets[0].getsockname()[1]
+
+    clients = []
+    for name in ["a", "b"]:
+        client = sockets.create_connection(("localhost", port))
+        client.settimeout(2)
+        CDProto.send_msg(client, CDProto.register(name))
+        assert CDProto.recv_msg(client).user == name
+        clients.append(client)
+    a, b = clients
+
+    a.sendall(b"\xff\xff" + (2**32 - 1).to_bytes(4, "big"))     # 4 GiB announced
+    assert a.recv(1) == b""
+    CDProto.send_msg(b, CDProto.message("still here"))
+    assert CDProto.recv_msg(b).message == "still here"
+    for client in clients:
+        client.close()
+
+
+def test_async_backpressure():
+    """A client waits for the receivers it wrote to, not for those congested by other clients."""
+    import socket as sockets
+    import threading
+    import time
+    from src.async_server import AsyncServer
+    from src.protocol import CDProto
+
+    server = AsyncServer(port=0, high=1024, drain_timeout=2)
+    threading.Thread(target=server.loop, daemon=True).start()
+    while server.server is None or not server.server.sockets:
+        time.sleep(0.01)
+    port = server.server.sockets[0].getsockname()[1]
+
+    clients = {}
+    for name, channel in [("a", "#cd"), ("stuck1", "#cd"), ("stuck2", "#cd"), ("c", "#other")]:
+        client = sockets.socket()
+        client.setsockopt(sockets.SOL_SOCKET, sockets.SO_RCVBUF, 4096)
+        client.connect(("localhost", port))
+        client.settimeout(5)
+        CDProto.send_msg(client, CDProto.register(name))
+        assert CDProto.recv_msg(client).user == name
+        CDProto.send_msg(client, CDProto.join(channel))
+        clients[name] = client
+    time.sleep(0.1)
+
+    CDProto.send_msg(clients["a"], CDProto.message("x" * 6 * 2**20, "#cd"))     # congests both stuck clients
+    time.sleep(0.2)
+    start = time.monotonic()
+    for n in range(2):
+        CDProto.send_msg(clients["c"], CDProto.message(f"{n}", "#other"))
+        assert CDProto.recv_msg(clients["c"]).message == f"{n}"
+    assert time.monotonic() - start < 1
+    for client in clients.values():
+        client.close()
@@ -0,0 +1,260 @@
+""" Pipelined DHT client on asyncio. """
+import argparse
+import asyncio
+import bisect
+import itertools
+import logging
+import pickle
+import socket
+import time
+
+from DHTClient import DHTClient
+from utils import HASHES, contains, default_hashing
+
+
+def _expire(future):
+    if not future.done():
+        future.set_exception(asyncio.TimeoutError())
+
+
+class _Replies(asyncio.DatagramProtocol):
+    """Hands every reply to the request waiting for it."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.reply(data)
+
+    def error_received(self, exc):
+        self.client.logger.debug("Socket error: %s", exc)
+
+
+class OwnerCache:
+    """Nodes responsible for hash ranges, as learned from their replies.
+
+    A range (begin, end] is kept sorted by its end, so the owner of a hash is
+    found with a binary search. A range learned later drops the ranges it
+    overlaps, being the newer view of the ring.
+    """
+
+    def __init__(self, ring_size=2**10):
+        self.ring_size = ring_size
+        self.ends = []          # sorted
+        self.ranges = {}        # end -> (begin, addr)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def find(self, key_hash):
+        """End of the cached range holding key_hash, None if there is none."""
+        if not self.ends:
+            return None
+        end = self.ends[bisect.bisect_left(self.ends, key_hash) % len(self.ends)]
+        return end if contains(self.ranges[end][0], end, key_hash) else None
+
+    def lookup(self, key_hash):
+        """Address of the node responsible for key_hash, None if unknown."""
+        end = self.find(key_hash)
+        return None if end is None else self.ranges[end][1]
+
+    def update(self, begin, end, addr):
+        """Record node addr as responsible for (begin, end]."""
+        if begin is None:       # the node doesn't know its range yet
+            return
+        for other in [e for e in self.ends if e == end or contains(begin, end, e)
+                      or contains(begin, end, (self.ranges[e][0] + 1) % self.ring_size)]:
+            self.remove(other)
+        bisect.insort(self.ends, end)
+        self.ranges[end] = (begin, addr)
+
+    def invalidate(self, key_hash):
+        """Forget the owner cached for key_hash."""
+        end = self.find(key_hash)
+        if end is not None:
+            self.remove(end)
+
+    def remove(self, end):
+        self.ends.remove(end)
+        del self.ranges[end]
+
+
+class AsyncDHTClient:
+    """DHT client keeping many requests in flight over a single UDP socket.
+
+    Every request carries an id, echoed by the node that answers it, so replies
+    are matched to their request whatever order they arrive in. A request not
+    answered within timeout seconds is sent again, up to retries times (the
+    timeout doubling each time); at most window requests are in flight.
+
+    With cache, the owners learned from the replies are kept by hash range and
+    the following requests for their keys go straight to them, skipping the
+    routing. A node that no longer owns a key answers NACK (moved) and its
+    entry is dropped, as is the entry of a node that doesn't answer. The cache
+    hashes keys as the ring does: m_bits and hashing must match its nodes'.
+    """
+
+    def __init__(self, address, timeout=1.0, retries=3, window=64, cache=True, m_bits=10, hashing=None):
+        """ Initialize client, call connect before using it."""
+        self.dht_addr = address
+        self.timeout = timeout
+        self.retries = retries
+        self.window = asyncio.Semaphore(window)
+        self.transport = None
+        self.pending = {}               # request id -> future of its reply
+        self.ids = itertools.count(1)
+        self.m_bits = m_bits
+        self.owners = OwnerCache(2**m_bits) if cache else None
+        self.hash = HASHES[hashing or default_hashing(m_bits)]
+        self.stats = {"direct": 0, "routed": 0, "moved": 0, "hops": 0}
+        self.logger = logging.getLogger("AsyncDHTClient")
+
+    @classmethod
+    async def connect(cls, address, **options):
+        """Create a client with its socket open."""
+        client = cls(address, **options)
+        loop = asyncio.get_running_loop()
+        client.transport, _ = await loop.create_datagram_endpoint(lambda: _Replies(client), family=socket.AF_INET)
+        return client
+
+    def reply(self, data):
+        """Resolve the request a reply is for."""
+        try:
+            msg = pickle.loads(data)
+            future = self.pending.pop(msg.get("request"), None)
+        except Exception:
+            self.logger.error("Invalid reply: %s", data[:64])
+            return
+        if future is not None and not future.done():
+            future.set_result(msg)
+        # otherwise a late reply to a request already answered or given up on
+
+    async def request(self, method, args, address=None, retries=None):
+        """Send a request (to the DHT entry node by default), returns its reply (None if it was never answered)."""
+        request = next(self.ids)
+        payload = pickle.dumps({"method": method, "request": request, "args": args})
+        address = self.dht_addr if address is None else address
+        async with self.window:
+            loop = asyncio.get_running_loop()
+            timeout = self.timeout
+            for attempt in range((self.retries if retries is None else retries) + 1):
+                future = self.pending[request] = loop.create_future()
+                timer = loop.call_later(timeout, _expire, future)
+                self.transport.sendto(payload, address)
+                try:
+                    return await future
+                except asyncio.TimeoutError:
+                    self.logger.debug("Request %d timed out (attempt %d)", request, attempt + 1)
+                    timeout *= 2
+                finally:
+                    timer.cancel()
+                    self.pending.pop(request, None)
+        self.logger.error("No reply to %s %s", method, args.get("key"))
+        return None
+
+    def learn(self, out):
+        """Cache the owner a reply comes from."""
+        owner = out.get("owner")
+        if owner is not None and self.owners is not None:
+            self.owners.update(owner["begin"], owner["id"], tuple(owner["addr"]))
+
+    async def lookup(self, method, args):
+        """Send a request straight to the owner of its key when cached, routed through the DHT otherwise."""
+        key_hash = self.hash(args["key"], maximum=2**self.m_bits)
+        addr = self.owners.lookup(key_hash) if self.owners is not None else None
+        if addr is not None:
+            out = await self.request(method, dict(args, direct=True), addr, retries=1)
+            if out is not None and not out.get("moved"):
+                self.stats["direct"] += 1
+                self.learn(out)
+                return out
+            self.stats["moved"] += 1
+            self.owners.invalidate(key_hash)
+        out = await self.request(method, args)
+        if out is not None:
+            self.stats["routed"] += 1
+            self.stats["hops"] += out.get("hops", 0)
+            self.learn(out)
+        return out
+
+    async def find_owner(self, key):
+        """Node responsible for key: dict with its id, addr, the range (begin, id] it owns and the hops taken."""
+        out = await self.request("FIND_OWNER", {"key": key})
+        if out is None or out["method"] != "OWNER":
+            return None
+        self.learn(out)
+        owner = dict(out["owner"], hops=out.get("hops", 0))
+        owner["addr"] = tuple(owner["addr"])
+        return owner
+
+    async def put(self, key, value):
+        """ Store value to key in the DHT."""
+        out = await self.lookup("PUT", {"key": key, "value": value})
+        if out is None:
+            return False
+        if out["method"] != "ACK":
+            self.logger.error("Invalid msg: %s", out)
+            return False
+        return True
+
+    async def get(self, key):
+        """ Retrieve key from DHT (None if it isn't stored)."""
+        out = await self.lookup("GET", {"key": key})
+        if out is None or out["method"] != "ACK":
+            return None
+        return out["args"]
+
+    async def put_many(self, items):
+        """Store every (key, value) of items, pipelined; returns whether each was stored."""
+        return await asyncio.gather(*(self.put(key, value) for key, value in items))
+
+    async def get_many(self, keys):
+        """Retrieve every key of keys, pipelined; returns their values in order."""
+        return await asyncio.gather(*(self.get(key) for key in keys))
+
+    def close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def bench(address, keys, window, cache):
+    """Time put_many and get_many of keys, returns operations/sec of each."""
+    client = await AsyncDHTClient.connect(address, window=window, cache=cache)
+    try:
+        start = time.perf_counter()
+        stored = await client.put_many((key, key) for key in keys)
+        puts = len(keys) / (time.perf_counter() - start)
+        start = time.perf_counter()
+        values = await client.get_many(keys)
+        gets = len(keys) / (time.perf_counter() - start)
+    finally:
+        client.close()
+    if not all(stored) or values != keys:
+        print(f"{stored.count(False)} puts failed, {sum(v != k for v, k in zip(values, keys))} gets wrong")
+    return puts, gets
+
+
+if __name__ == "__main__":
+    # compare with the blocking client, against a running DHT (python3 DHT.py)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--keys", type=int, default=2000)
+    parser.add_argument("--window", help="requests in flight", type=int, default=64)
+    parser.add_argument("--no-cache", help="route every request through the DHT", action="store_true")
+    args = parser.parse_args()
+
+    address = ("localhost", args.port)
+    keys = [f"key{n}" for n in range(args.keys)]
+
+    client = DHTClient(address)
+    start = time.perf_counter()
+    for key in keys[:200]:
+        client.put(key, key)
+    print(f"DHTClient.put:            {200 / (time.perf_counter() - start):>8.0f} ops/s")
+
+    puts, gets = asyncio.run(bench(address, keys, args.window, not args.no_cache))
+    print(f"AsyncDHTClient.put_many:  {puts:>8.0f} ops/s")
+    print(f"AsyncDHTClient.get_many:  {gets:>8.0f} ops/s")
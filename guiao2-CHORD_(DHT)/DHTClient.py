@@ -2,6 +2,8 @@ import socket
 import pickle
 import logging
 
+from utils import DATAGRAM_SIZE
+
 
 class DHTClient:
     def __init__(self, address):
@@ -15,7 +17,7 @@ class DHTClient:
         msg = {"method": "PUT", "args": {"key": key, "value": value}}
         pickled_msg = pickle.dumps(msg)
         self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
+        pickled_msg, addr = self.socket.recvfrom(DATAGRAM_SIZE)
         out = pickle.loads(pickled_msg)
         if out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
@@ -27,7 +29,7 @@ class DHTClient:
         msg = {"method": "GET", "args": {"key": key}}
         pickled_msg = pickle.dumps(msg)
         self.socket.sendto(pickled_msg, self.dht_addr)
-        pickled_msg, addr = self.socket.recvfrom(1024)
+        pickled_msg, addr = self.socket.recvfrom(DATAGRAM_SIZE)
         out = pickle.loads(pickled_msg)
         if out["method"] != "ACK":
             self.logger.error("Invalid msg: %s", out)
@@ -3,56 +3,105 @@ import socket
 import threading
 import logging
 import pickle
-from utils import dht_hash, contains
+import time
+from bisect import bisect_left
+from collections import deque
+from functools import partial
+from utils import DATAGRAM_SIZE, HASHES, contains, default_hashing, hash_many
+from transfer import TransferServer, send_keys
 import sys
 
+MAX_M_BITS = 160    # SHA-1 sized rings
+MAX_DEFERRED = 1024     # requests held by a node that doesn't know its hash range yet
+FIX_FINGERS = 4         # finger table entries refreshed by each stabilize round
+
+
 class FingerTable:
-    """Finger Table."""
+    """Finger Table.
+
+    Entry i (1-based) points to the successor of start i = node_id + 2**(i-1).
+    The starts, and the start -> index dict, are computed once; the entries
+    live in preallocated lists along with their distance to node_id. While
+    those distances grow with the index, as they do in a stable ring, find
+    binary searches them; otherwise it falls back to a linear scan.
+    """
 
     def __init__(self, node_id, node_addr, m_bits=10):
         """ Initialize Finger Table."""
+        if not 0 < m_bits <= MAX_M_BITS:
+            raise ValueError(f"m_bits must be between 1 and {MAX_M_BITS}")
         self.node_id = node_id
         self.node_addr = node_addr
         self.m_bits = m_bits
-        self.finger_table = []
-        self.indexTable = []
-
-        for i in range(self.m_bits):
-            self.finger_table.append((node_id, node_addr))
-            self.indexTable.append((i+1, (self.node_id + 2**(i)) % 2**self.m_bits))
+        self.size = 2**m_bits
+        self.starts = [(node_id + 2**i) % self.size for i in range(m_bits)]
+        self.indexTable = {start: i + 1 for i, start in enumerate(self.starts)}
+        self.ids = [node_id] * m_bits
+        self.addrs = [node_addr] * m_bits
+        self.distances = [0] * m_bits       # (ids[i] - node_id) % size, ascending in a stable ring
+        self.inversions = 0                 # entries whose distance is above the next one's
+        self.next_refresh = 0               # index of the entry fix_fingers starts from
 
     def fill(self, node_id, node_addr):
         """ Fill all entries of finger_table with node_id, node_addr."""
-        for i in range(self.m_bits):
-            self.finger_table[i] = ((node_id, node_addr))
+        self.ids[:] = [node_id] * self.m_bits
+        self.addrs[:] = [node_addr] * self.m_bits
+        self.distances[:] = [(node_id - self.node_id) % self.size] * self.m_bits
+        self.inversions = 0
 
     def update(self, index, node_id, node_addr):
         """Update index of table with node_id and node_addr."""
-        # if self.node_id==770 and node_addr == ('localhost',5000):
-        #     sys.exit()
-        if (len(self.finger_table) > index - 1):
-            self.finger_table.pop(index - 1)
-        self.finger_table.insert(index - 1, (node_id, node_addr))
+        if index is None or not 0 < index <= self.m_bits:
+            return
+        i = index - 1
+        self.ids[i] = node_id
+        self.addrs[i] = node_addr
+        distances = self.distances
+        distance = (node_id - self.node_id) % self.size
+        old = distances[i]
+        if distance != old:
+            if i > 0:
+                self.inversions += (distances[i - 1] > distance) - (distances[i - 1] > old)
+            if i < self.m_bits - 1:
+                self.inversions += (distance > distances[i + 1]) - (old > distances[i + 1])
+            distances[i] = distance
 
     def find(self, identification):
         """ Get node address of closest preceding node (in finger table) of identification. """
-        for i in range(self.m_bits-1, -1, -1):
-            if (identification != self.finger_table[i][0] and contains(self.node_id, identification, self.finger_table[i][0])):
-                return self.finger_table[i][1]
-        return self.finger_table[0][1]  
+        # the last entry strictly between node_id and identification
+        distance = (identification - self.node_id) % self.size
+        if self.inversions:
+            for i in range(self.m_bits - 1, -1, -1):
+                if 0 < self.distances[i] < distance:
+                    return self.addrs[i]
+            return self.addrs[0]
+        i = bisect_left(self.distances, distance) - 1
+        if i >= 0 and self.distances[i] > 0:
+            return self.addrs[i]
+        return self.addrs[0]
+
+    def replace(self, node_id, new_id, new_addr):
+        """Point the entries of node_id (a node that left) to new_id, new_addr."""
+        for i, entry_id in enumerate(self.ids):
+            if entry_id == node_id:
+                self.update(i + 1, new_id, new_addr)
 
     def refresh(self):
         """ Retrieve finger table entries requiring refresh."""
-        finger_tableRefresh = []
-        for i in range(len(self.finger_table)):
-            finger_tableRefresh.append((i+1 , (self.node_id + 2**(i)) % (2**self.m_bits), self.finger_table[i][1]))
-        return finger_tableRefresh
+        return list(zip(range(1, self.m_bits + 1), self.starts, self.addrs))
+
+    def fix_fingers(self, count=FIX_FINGERS):
+        """ Retrieve the next count entries requiring refresh, going round the table over the calls."""
+        entries = []
+        for _ in range(min(count, self.m_bits)):
+            i = self.next_refresh
+            entries.append((i + 1, self.starts[i], self.addrs[i]))
+            self.next_refresh = (i + 1) % self.m_bits
+        return entries
 
     def getIdxFromId(self, id):
         """ Get index of finger table entry with id."""
-        for i in self.indexTable:
-            if (i[1] == id):
-                return i[0]
+        return self.indexTable.get(id)
 
     def __repr__(self):
         return str(self.as_list)
@@ -62,24 +111,28 @@ class FingerTable:
         """return the finger table as a list of tuples: (identifier, (host, port)).
         NOTE: list index 0 corresponds to finger_table index 1
         """
-        indexList = []
-        [indexList.append(i) for i in self.finger_table]
-        return indexList
+        return list(zip(self.ids, self.addrs))
 
 class DHTNode(threading.Thread):
     """ DHT Node Agent. """
 
-    def __init__(self, address, dht_address=None, timeout=3):
+    def __init__(self, address, dht_address=None, timeout=3, m_bits=10, hashing=None):
         """Constructor
 
         Parameters:
             address: self's address
             dht_address: address of a node in the DHT
             timeout: impacts how often stabilize algorithm is carried out
+            m_bits: the ring has 2**m_bits ids (every node of a ring must agree)
+            hashing: function placing nodes and keys in the ring, "fnv" (up to 64 bits) or "sha1"
+                (default: the one of default_hashing)
         """
         threading.Thread.__init__(self)
         self.done = False
-        self.identification = dht_hash(address.__str__())
+        self.m_bits = m_bits
+        self.hashing = hashing or default_hashing(m_bits)
+        self.hash = HASHES[self.hashing]
+        self.identification = self.key_hash(address.__str__())
         self.addr = address  # My address
         self.dht_address = dht_address  # Address of the initial Node
         if dht_address is None:
@@ -96,13 +149,25 @@ class DHTNode(threading.Thread):
             self.predecessor_id = None
             self.predecessor_addr = None
 
-        self.finger_table = FingerTable(self.identification, self.addr)    #TODO create finger_table
+        self.finger_table = FingerTable(self.identification, self.addr, m_bits)    #TODO create finger_table
 
         self.keystore = {}  # Where all data is stored
+        self.keystore_lock = threading.Lock()  # the keystore is also changed by the transfer threads
+        self.leaving = False  # handing the keys over to the successor, see leave
+        self.migrating = False  # a transfer to the predecessor is running, see migrate
+        self.unmigrated = False  # keys of the predecessor's range may still be here
+        self.handover_addr = None  # node that may still hold keys of this node's range, see get
+        self.transfers = []  # stats of the keys sent to other nodes
+        self.deferred = deque()  # (retry, msg) of the requests waiting for a predecessor, see route
+        self.dropped = 0  # deferred requests answered NACK as more kept coming
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.settimeout(timeout)
         self.logger = logging.getLogger("Node {}".format(self.identification))
 
+    def key_hash(self, key):
+        """Id of key in the ring."""
+        return self.hash(key, maximum=2**self.m_bits)
+
     def send(self, address, msg):
         """ Send msg to address. """
         payload = pickle.dumps(msg)
@@ -111,7 +176,7 @@ class DHTNode(threading.Thread):
     def recv(self):
         """ Retrieve msg payload and from address."""
         try:
-            payload, addr = self.socket.recvfrom(1024)
+            payload, addr = self.socket.recvfrom(DATAGRAM_SIZE)
         except socket.timeout:
             return None, None
 
@@ -127,6 +192,13 @@ class DHTNode(threading.Thread):
         """
 
         self.logger.debug("Node join: %s", args)
+        if self.leaving:
+            self.send(self.successor_addr, {"method": "JOIN_REQ", "args": args})
+            return
+        m_bits = args.get("m_bits", 10)
+        if (m_bits, args.get("hashing", default_hashing(m_bits))) != (self.m_bits, self.hashing):
+            self.logger.error("Node %s uses another ring: %s", args["addr"], args)
+            return
         addr = args["addr"]
         identification = args["id"]
         if self.identification == self.successor_id:  # I'm the only node in the DHT
@@ -164,7 +236,7 @@ class DHTNode(threading.Thread):
         if contains(self.identification, self.successor_id, arg_id):
             arguments = {"req_id": arg_id, "successor_id": self.successor_id, "successor_addr": self.successor_addr,"msg":1}
             self.send(address, {"method": "SUCCESSOR_REP", "args": arguments})
-        elif self.predecessor_id is None or contains(self.predecessor_id, self.identification, arg_id):
+        elif not self.leaving and (self.predecessor_id is None or contains(self.predecessor_id, self.identification, arg_id)):
             arguments = {"req_id": arg_id, "successor_id": self.identification, "successor_addr": self.addr,"msg":2}
             self.send(address, {"method": "SUCCESSOR_REP", "args": arguments})
         else:
@@ -180,13 +252,157 @@ class DHTNode(threading.Thread):
         """
 
         self.logger.debug("Notify: %s", args)
-        if self.predecessor_id is None or contains(
+        if self.predecessor_id in (None, self.identification) or contains(
             self.predecessor_id, self.identification, args["predecessor_id"]
         ):
             self.predecessor_id = args["predecessor_id"]
             self.predecessor_addr = args["predecessor_addr"]
+            self.unmigrated = True
+            self.migrate()
+            deferred, self.deferred = self.deferred, deque()
+            for retry, _ in deferred:
+                retry()
         self.logger.info(self)
 
+    def node_leave(self, args):
+        """Process LEAVE message.
+            Takes the node that left out of the ring, passing the message on
+            until it reaches the predecessor of that node.
+
+        Parameters:
+            args (dict): id and addr of the node leaving, its predecessor and successor
+        """
+
+        self.logger.debug("Node leave: %s", args)
+        if args["id"] == self.identification or (args["hops"] and args["successor_id"] == self.identification):
+            return      # around the whole ring
+        if self.predecessor_id == args["id"]:
+            self.predecessor_id = args["predecessor_id"]
+            self.predecessor_addr = args["predecessor_addr"]
+            if self.predecessor_id == self.identification:  # I'm the only node left in the DHT
+                self.predecessor_id = self.predecessor_addr = None
+        self.finger_table.replace(args["id"], args["successor_id"], args["successor_addr"])
+        if self.successor_id == args["id"]:
+            self.successor_id = args["successor_id"]
+            self.successor_addr = args["successor_addr"]
+        else:
+            args["hops"] += 1
+            self.send(self.successor_addr, {"method": "LEAVE", "args": args})
+        self.logger.info(self)
+
+    def receive_keys(self, batch):
+        """Store a batch of the keys another node hands over.
+            Values put here since this node owns a key are newer, so they stay;
+            keys not owned yet (copied ahead of a leave) are replaced.
+        """
+        hashes = hash_many([key for key, _ in batch], maximum=2**self.m_bits, method=self.hashing)
+        with self.keystore_lock:
+            for (key, value), key_hash in zip(batch, hashes):
+                if self.owns(key_hash):
+                    self.keystore.setdefault(key, value)
+                else:
+                    self.keystore[key] = value
+
+    def received_all(self):
+        """A transfer to this node went through: the keys of its range are all here."""
+        self.handover_addr = None
+
+    def transfer(self, address, items, reason):
+        """Send items to the node at address, then drop the ones still holding the value sent.
+            Nothing is dropped unless the node confirms it received every item.
+        """
+        try:
+            stats = send_keys(address, items)
+        except (OSError, ConnectionError) as err:
+            self.logger.error("Transfer of %d keys to %s failed: %s", len(items), address, err)
+            return None
+        with self.keystore_lock:
+            for key, value in items:
+                if self.keystore.get(key) is value:
+                    del self.keystore[key]
+        stats["reason"] = reason
+        self.transfers.append(stats)
+        self.logger.info("Sent %d keys to %s in %.3fs (%.0f keys/s)", stats["keys"], address, stats["seconds"],
+                         stats["keys_per_sec"])
+        return stats
+
+    def migrate(self):
+        """Hand the keys the new predecessor is now responsible for over to it, without blocking.
+            A failed transfer is tried again on the next stabilize rounds.
+        """
+        if self.migrating or self.leaving or self.predecessor_id in (None, self.identification):
+            return
+        with self.keystore_lock:
+            snapshot = list(self.keystore.items())
+        hashes = hash_many([key for key, _ in snapshot], maximum=2**self.m_bits, method=self.hashing)
+        items = [item for item, key_hash in zip(snapshot, hashes)
+                 if not contains(self.predecessor_id, self.identification, key_hash)]
+        self.unmigrated = False
+        self.migrating = True     # even with no items: the predecessor stops asking this node, see get
+        threading.Thread(target=self.hand_over, args=(self.predecessor_addr, items), daemon=True).start()
+
+    def hand_over(self, address, items):
+        """Transfer items to the predecessor, flagging them to be sent again if it fails."""
+        try:
+            if self.transfer(address, items, "join") is None:
+                self.unmigrated = True
+        finally:
+            self.migrating = False
+
+    def leave(self, retries=3):
+        """Leave the DHT gracefully, handing all keys over to the successor.
+
+        The keys are copied to the successor before the LEAVE goes around the
+        ring, and the ones put meanwhile after it. The node stays in the ring
+        (or keeps running, holding the keys of the second copy) unless the
+        successor confirms it got every key within retries attempts; leave can
+        be called again.
+
+        Returns the stats of the first copy (None if the node didn't leave).
+        """
+        if self.successor_id == self.identification:
+            if self.keystore:
+                self.logger.warning("Last node leaving, %d keys lost", len(self.keystore))
+            self.done = True
+            return None
+        with self.keystore_lock:
+            items = list(self.keystore.items())
+        stats = self.transfer_retrying(self.successor_addr, items, retries)
+        if stats is None:
+            self.logger.error("Successor didn't take the keys, not leaving")
+            return None
+
+        if not self.leaving:
+            self.leaving = True
+            args = {
+                "id": self.identification,
+                "addr": self.addr,
+                "predecessor_id": self.predecessor_id,
+                "predecessor_addr": self.predecessor_addr,
+                "successor_id": self.successor_id,
+                "successor_addr": self.successor_addr,
+                "hops": 0,
+            }
+            self.send(self.successor_addr, {"method": "LEAVE", "args": args})
+        sent = dict(items)
+        with self.keystore_lock:
+            changed = [(key, value) for key, value in self.keystore.items() if sent.get(key) is not value]
+        if changed and self.transfer_retrying(self.successor_addr, changed, retries) is None:
+            self.logger.error("Successor didn't take %d keys, still holding them", len(changed))
+            return None
+        self.done = True
+        return stats
+
+    def transfer_retrying(self, address, items, retries):
+        """transfer, tried up to retries times a stabilize timeout apart."""
+        for attempt in range(retries):
+            if attempt:
+                time.sleep(self.socket.gettimeout())
+            stats = self.transfer(address, items, "leave")
+            if stats is not None:
+                return stats
+        return None
+
     def stabilize(self, from_id, addr):
         """Process STABILIZE protocol.
             Updates all successor pointers.
@@ -210,63 +426,145 @@ class DHTNode(threading.Thread):
         args = {"predecessor_id": self.identification, "predecessor_addr": self.addr}
         self.send(self.successor_addr, {"method": "NOTIFY", "args": args})
 
-        # TODO refresh finger_table
-        fgtrefresh = self.finger_table.refresh()
+        if self.unmigrated:     # the last transfer to the predecessor failed
+            self.migrate()
+
+        # refresh a few entries of the finger table each round, not all m_bits of them
+        fgtrefresh = self.finger_table.fix_fingers()
         for node in  fgtrefresh:
             args =  {"id": node[1], "from": self.addr}
             self.send(node[2], {"method": "SUCCESSOR", "args": args})
 
-    def put(self, key, value, address):
+    def owner(self):
+        """Hash range this node is responsible for, (begin, id], and its address."""
+        return {"begin": self.predecessor_id, "id": self.identification, "addr": self.addr}
+
+    def owns(self, key_hash):
+        """Check this node is responsible for key_hash."""
+        if self.leaving:
+            return False
+        if self.successor_id == self.identification:
+            return True     # alone in the DHT
+        if self.predecessor_id is None or self.predecessor_id == self.identification:
+            return False    # range unknown until the predecessor notifies this node
+        return contains(self.predecessor_id, self.identification, key_hash)
+
+    def route(self, key_hash, msg, retry):
+        """Forward msg towards the node responsible for key_hash.
+            Until its predecessor is known, the node only knows its successor owns
+            (self, successor]: other requests are held, and retried once notified.
+            Past MAX_DEFERRED held requests, the oldest is answered NACK.
+        """
+        if (not self.leaving and self.predecessor_id in (None, self.identification)
+                and not contains(self.identification, self.successor_id, key_hash)):
+            if len(self.deferred) >= MAX_DEFERRED:
+                _, dropped = self.deferred.popleft()
+                self.dropped += 1
+                self.logger.warning("Too many requests held, dropped %s (%d so far)", dropped, self.dropped)
+                self.send(dropped["args"]["from"], {"method": "NACK", "request": dropped.get("request"),
+                                                    "hops": dropped["args"].get("hops", 0), "dropped": True})
+            self.deferred.append((retry, msg))
+        else:
+            self.forward(key_hash, msg)
+
+    def forward(self, key_hash, msg):
+        """Send msg one hop closer to the node responsible for key_hash."""
+        msg["args"]["hops"] = msg["args"].get("hops", 0) + 1
+        if self.leaving or contains(self.identification, self.successor_id, key_hash):
+            self.send(self.successor_addr, msg)
+        else:
+            self.send(self.finger_table.find(key_hash), msg)
+
+    def moved(self, address, request):
+        """Answer a request sent straight to this node for a key it isn't responsible for."""
+        self.send(address, {"method": "NACK", "request": request, "moved": True})
+
+    def put(self, key, value, address, request=None, hops=0, direct=False):
         """Store value in DHT.
 
         Parameters:
         key: key of the data
         value: data to be stored
         address: address where to send ack/nack
+        request: id of the client request, echoed in the reply
+        hops: nodes the request went through
+        direct: sent straight to this node, as its owner, by the client
         """
-        key_hash = dht_hash(key)
+        key_hash = self.key_hash(key)
         self.logger.debug("Put: %s %s", key, key_hash)
 
-        #TODO Replace next code:
-        if (contains(self.predecessor_id, self.identification, key_hash)):
-            self.keystore[key] = value
-            self.send(address, {"method": "ACK"})
-        elif (contains(self.identification, self.successor_id, key_hash)):
-            self.send(self.successor_addr, {"method": "PUT", "args": {"key": key, "value": value, "from": address,"succ":1}})
+        if self.owns(key_hash):
+            with self.keystore_lock:
+                self.keystore[key] = value
+            self.send(address, {"method": "ACK", "request": request, "hops": hops, "owner": self.owner()})
+        elif direct:
+            self.moved(address, request)
         else:
-            self.send(self.finger_table.find(key_hash), {"method": "PUT", "args": {"key": key, "value": value, "from": address,"finger":1}})
-        #confirmar se é esta a sintax ou existe mais alguma coisa
-        
-
+            self.route(key_hash, {"method": "PUT", "request": request, "args": {"key": key, "value": value, "from": address, "hops": hops}},
+                       partial(self.put, key, value, address, request, hops))
 
-    def get(self, key, address):
+    def get(self, key, address, request=None, hops=0, direct=False, handover=False):
         """Retrieve value from DHT.
 
+        Until a joining node gets the keys of its range from its successor, it
+        asks the successor for the keys it doesn't have yet.
+
         Parameters:
         key: key of the data
         address: address where to send ack/nack
+        request: id of the client request, echoed in the reply
+        hops: nodes the request went through
+        direct: sent straight to this node, as its owner, by the client
+        handover: sent by the owner, asking for a key it hasn't received from this node yet
         """
-        key_hash = dht_hash(key)
+        key_hash = self.key_hash(key)
         self.logger.debug("Get: %s %s", key, key_hash)
 
-        #TODO Replace next code:
-        if contains(self.predecessor_id, self.identification, key_hash):
-            self.send(address, {"method": "ACK", "args": self.keystore[key]})
-        elif contains(self.identification, self.successor_id, key_hash):
-            self.send(self.successor_addr, {"method": "GET", "args": {"key": key, "from": address}})
+        if self.owns(key_hash) or handover:
+            with self.keystore_lock:
+                found, value = key in self.keystore, self.keystore.get(key)
+            owner = self.owner() if not handover else None
+            if found:
+                self.send(address, {"method": "ACK", "request": request, "args": value, "hops": hops, "owner": owner})
+            elif self.handover_addr is not None and not handover:
+                self.send(self.handover_addr, {"method": "GET", "request": request,
+                                               "args": {"key": key, "from": address, "hops": hops + 1, "handover": True}})
+            else:
+                self.send(address, {"method": "NACK", "request": request, "hops": hops, "owner": owner})
+        elif direct:
+            self.moved(address, request)
         else:
-            self.send(self.finger_table.find(key_hash), {"method": "GET", "args": {"key": key, "from": address}})
+            self.route(key_hash, {"method": "GET", "request": request, "args": {"key": key, "from": address, "hops": hops}},
+                       partial(self.get, key, address, request, hops))
+
+    def find_owner(self, key, address, request=None, hops=0):
+        """Reply with the node responsible for key.
+
+        Parameters:
+        key: key of the data
+        address: address where to send the OWNER reply
+        request: id of the client request, echoed in the reply
+        hops: nodes the request went through
+        """
+        key_hash = self.key_hash(key)
+        self.logger.debug("Find owner: %s %s", key, key_hash)
 
-        #confirmar se é esta a sintax ou existe mais alguma coisa
+        if self.owns(key_hash):
+            self.send(address, {"method": "OWNER", "request": request, "hops": hops, "owner": self.owner()})
+        else:
+            self.route(key_hash, {"method": "FIND_OWNER", "request": request, "args": {"key": key, "from": address, "hops": hops}},
+                       partial(self.find_owner, key, address, request, hops))
 
     def run(self):
         self.socket.bind(self.addr)
+        transfer_server = TransferServer(self.addr, self.receive_keys, self.received_all)
+        transfer_server.start()
 
         # Loop untiln joining the DHT
         while not self.inside_dht:
             join_msg = {
                 "method": "JOIN_REQ",
-                "args": {"addr": self.addr, "id": self.identification},
+                "args": {"addr": self.addr, "id": self.identification, "m_bits": self.m_bits, "hashing": self.hashing},
             }
             self.send(self.dht_address, join_msg)
             payload, addr = self.recv()
@@ -279,9 +577,11 @@ class DHTNode(threading.Thread):
                     self.successor_addr = args["successor_addr"]
                     #TODO fill finger table
                     self.finger_table.fill(self.successor_id, self.successor_addr)
+                    self.handover_addr = self.successor_addr     # until it hands this node its keys
                     self.inside_dht = True
                     self.logger.info(self)
 
+        stabilized = time.monotonic()
         while not self.done:
             payload, addr = self.recv()
             if payload is not None:
@@ -289,16 +589,27 @@ class DHTNode(threading.Thread):
                 self.logger.info("O: %s", output)
                 if output["method"] == "JOIN_REQ":
                     self.node_join(output["args"])
+                elif output["method"] == "LEAVE":
+                    self.node_leave(output["args"])
                 elif output["method"] == "NOTIFY":
                     self.notify(output["args"])
                 elif output["method"] == "PUT":
+                    args = output["args"]
                     self.put(
-                        output["args"]["key"],
-                        output["args"]["value"],
-                        output["args"].get("from", addr),
+                        args["key"],
+                        args["value"],
+                        args.get("from", addr),
+                        output.get("request"),
+                        args.get("hops", 0),
+                        args.get("direct", False),
                     )
                 elif output["method"] == "GET":
-                    self.get(output["args"]["key"], output["args"].get("from", addr))
+                    args = output["args"]
+                    self.get(args["key"], args.get("from", addr), output.get("request"), args.get("hops", 0),
+                             args.get("direct", False), args.get("handover", False))
+                elif output["method"] == "FIND_OWNER":
+                    args = output["args"]
+                    self.find_owner(args["key"], args.get("from", addr), output.get("request"), args.get("hops", 0))
                 elif output["method"] == "PREDECESSOR":
                     # Reply with predecessor id
                     self.send(
@@ -307,7 +618,7 @@ class DHTNode(threading.Thread):
                 elif output["method"] == "SUCCESSOR":
                     # Reply with successor of id
                     self.get_successor(output["args"])
-                elif output["method"] == "STABILIZE":
+                elif output["method"] == "STABILIZE" and not self.leaving:
                     # Initiate stabilize protocol
                     self.stabilize(output["args"], addr)
                 elif output["method"] == "SUCCESSOR_REP":
@@ -315,9 +626,13 @@ class DHTNode(threading.Thread):
                     succ_id = output["args"]["successor_id"]
                     succ_addr = output["args"]["successor_addr"]
                     self.finger_table.update(self.finger_table.getIdxFromId(output["args"]["req_id"]), succ_id, succ_addr)
-            else:  # timeout occurred, lets run the stabilize algorithm
+            # every timeout, busy or not, lets run the stabilize algorithm
+            # (a node waiting to be notified holds requests until then, see route)
+            if not self.leaving and (payload is None or time.monotonic() - stabilized >= self.socket.gettimeout()):
+                stabilized = time.monotonic()
                 # Ask successor for predecessor, to start the stabilize process
                 self.send(self.successor_addr, {"method": "PREDECESSOR"})
+        transfer_server.done = True
 
     def __str__(self):
         return "Node ID: {}; DHT: {}; Successor: {}; Predecessor: {}; FingerTable: {}".format(
@@ -0,0 +1,99 @@
+"""Benchmark the finger table against the list based one it replaced.
+
+Builds the table of a node in a stable ring of random node ids, for several
+ring sizes, and times find, refresh, getIdxFromId and update.
+
+Run from the project root:
+    python -m benchmarks.finger_table --m-bits 10 32 64 160
+"""
+import argparse
+import bisect
+import random
+import time
+
+from DHTNode import FingerTable
+from utils import contains
+
+
+class LegacyFingerTable:
+    """Finger table as it used to be: list pop/insert, linear scans, 2**i on every refresh."""
+
+    def __init__(self, node_id, node_addr, m_bits=10):
+        self.node_id = node_id
+        self.m_bits = m_bits
+        self.finger_table = []
+        self.indexTable = []
+        for i in range(m_bits):
+            self.finger_table.append((node_id, node_addr))
+            self.indexTable.append((i + 1, (node_id + 2**i) % 2**m_bits))
+
+    def update(self, index, node_id, node_addr):
+        if len(self.finger_table) > index - 1:
+            self.finger_table.pop(index - 1)
+        self.finger_table.insert(index - 1, (node_id, node_addr))
+
+    def find(self, identification):
+        for i in range(self.m_bits - 1, -1, -1):
+            if identification != self.finger_table[i][0] and contains(self.node_id, identification, self.finger_table[i][0]):
+                return self.finger_table[i][1]
+        return self.finger_table[0][1]
+
+    def refresh(self):
+        return [(i + 1, (self.node_id + 2**i) % (2**self.m_bits), self.finger_table[i][1])
+                for i in range(len(self.finger_table))]
+
+    def getIdxFromId(self, id):
+        for i in self.indexTable:
+            if i[1] == id:
+                return i[0]
+
+
+def stable_table(table_type, m_bits: int, nodes: int, rng: random.Random):
+    """Table of a node in a ring of nodes random ids, every entry pointing to the successor of its start."""
+    size = 2**m_bits
+    ids = sorted(rng.sample(range(size), nodes) if size < 2**63 else {rng.randrange(size) for _ in range(nodes)})
+    node_id = ids[0]
+    table = table_type(node_id, ("localhost", 5000), m_bits)
+    for i in range(m_bits):
+        start = (node_id + 2**i) % size
+        successor = ids[bisect.bisect_left(ids, start) % len(ids)]
+        table.update(i + 1, successor, ("localhost", successor % 65536))
+    return table
+
+
+def rate(function, args, rounds: int) -> float:
+    """Calls of function per second, cycling through args."""
+    count = len(args)
+    start = time.perf_counter()
+    for n in range(rounds):
+        function(args[n % count])
+    return rounds / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--m-bits", help="ring sizes, in bits", type=int, nargs="+", default=[10, 32, 64, 160])
+    parser.add_argument("--nodes", help="nodes in the ring", type=int, default=1000)
+    parser.add_argument("--rounds", help="calls per measure", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'m':>4} {'operation':<12} {'legacy/s':>10} {'new/s':>10} {'speedup':>8}")
+    for m_bits in args.m_bits:
+        rng = random.Random(m_bits)
+        legacy = stable_table(LegacyFingerTable, m_bits, args.nodes, rng)
+        table = stable_table(FingerTable, m_bits, args.nodes, random.Random(m_bits))
+        assert legacy.finger_table == table.as_list
+        keys = [rng.randrange(2**m_bits) for _ in range(1000)]
+        starts = [start for _, start, _ in table.refresh()]
+        updates = [(rng.randrange(1, m_bits + 1), entry) for entry in table.as_list]
+
+        measures = {
+            "find": (lambda t: t.find, keys),
+            "refresh": (lambda t: lambda _: t.refresh(), [None]),
+            "getIdxFromId": (lambda t: t.getIdxFromId, starts),
+            "update": (lambda t: lambda u: t.update(u[0], *u[1]), updates),
+        }
+        for name, (method, calls) in measures.items():
+            old = rate(method(legacy), calls, args.rounds)
+            new = rate(method(table), calls, args.rounds)
+            print(f"{m_bits:>4} {name:<12} {old:>10.0f} {new:>10.0f} {new / old:>7.1f}x")
@@ -0,0 +1,77 @@
+"""Benchmark the key hashing: keys/sec and how evenly keys spread over the nodes.
+
+Times the FNV-1a loop dht_hash used to be (unbounded Python ints), dht_hash,
+hash_many (NumPy vectorized when installed) and SHA-1, for several ring
+sizes (FNV only up to 2**64 ids). Then places nodes and keys in rings of
+those sizes and reports the id collisions and the load of the nodes: largest
+over mean, and the coefficient of variation (stdev / mean, 0 is perfectly
+even).
+
+Run from the project root:
+    python -m benchmarks.hashing --m-bits 10 32 64 160 --keys 100000 --nodes 64
+"""
+import argparse
+import bisect
+import statistics
+import time
+
+from utils import HASHES, FNV, dht_hash, hash_many, numpy
+
+
+def legacy_hash(text, seed=0, maximum=2**10):
+    """ FNV-1a as dht_hash used to compute it. """
+    h = 2166136261 + seed
+    for char in text:
+        h = h ^ ord(char)
+        h = h * 16777619
+    return h % maximum
+
+
+def rate(function, keys) -> float:
+    """Keys/sec hashed by function(keys)."""
+    start = time.perf_counter()
+    function(keys)
+    return len(keys) / (time.perf_counter() - start)
+
+
+def spread(hashing: str, m_bits: int, nodes: int, keys):
+    """(node ids lost to collisions, key ids lost to collisions, max/mean load, coefficient of variation)."""
+    maximum = 2**m_bits
+    ids = sorted(set(hash_many([str(("localhost", 5000 + n)) for n in range(nodes)], maximum=maximum, method=hashing)))
+    key_ids = hash_many(keys, maximum=maximum, method=hashing)
+    load = [0] * len(ids)
+    for key_id in key_ids:
+        load[bisect.bisect_left(ids, key_id) % len(ids)] += 1
+    mean = len(keys) / len(ids)
+    return (nodes - len(ids), len(keys) - len(set(key_ids)), max(load) / mean, statistics.pstdev(load) / mean)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--m-bits", help="ring sizes, in bits", type=int, nargs="+", default=[10, 32, 64, 160])
+    parser.add_argument("--keys", help="keys hashed", type=int, default=100000)
+    parser.add_argument("--nodes", help="nodes the keys spread over", type=int, default=64)
+    args = parser.parse_args()
+
+    keys = [f"user:{n}:profile" for n in range(args.keys)]
+    print(f"keys/sec (hash_many FNV {'vectorized with NumPy' if numpy is not None else 'without NumPy'})")
+    print(f"{'m':>4} {'legacy':>10} {'dht_hash':>10} {'hash_many':>10} {'sha1':>10}")
+    for m_bits in args.m_bits:
+        maximum = 2**m_bits
+        sha1 = rate(lambda ks: hash_many(ks, maximum=maximum, method="sha1"), keys)
+        if m_bits > max(FNV):
+            print(f"{m_bits:>4} {'-':>10} {'-':>10} {'-':>10} {sha1:>10.0f}")
+            continue
+        legacy = rate(lambda ks: [legacy_hash(k, maximum=maximum) for k in ks], keys)
+        single = rate(lambda ks: [dht_hash(k, maximum=maximum) for k in ks], keys)
+        batch = rate(lambda ks: hash_many(ks, maximum=maximum), keys)
+        print(f"{m_bits:>4} {legacy:>10.0f} {single:>10.0f} {batch:>10.0f} {sha1:>10.0f}")
+
+    print(f"\nspread of {args.keys} keys over {args.nodes} nodes")
+    print(f"{'m':>4} {'hash':<5} {'node coll':>9} {'key coll':>9} {'max/mean':>9} {'cv':>6}")
+    for m_bits in args.m_bits:
+        for hashing in HASHES:
+            if hashing == "fnv" and m_bits > max(FNV):
+                continue
+            lost_nodes, lost_keys, peak, cv = spread(hashing, m_bits, args.nodes, keys)
+            print(f"{m_bits:>4} {hashing:<5} {lost_nodes:>9} {lost_keys:>9} {peak:>9.2f} {cv:>6.2f}")
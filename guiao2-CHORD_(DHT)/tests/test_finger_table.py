@@ -1,6 +1,7 @@
 """Tests finger table."""
 import pytest
-from DHTNode import FingerTable
+from DHTNode import DHTNode, FingerTable
+from utils import dht_hash, sha1_hash
 
 
 def test_finger_table():
@@ -41,3 +42,47 @@ def test_finger_table():
         (3, 14, ("localhost", 5003)),
         (4, 2, ("localhost", 5004)),
     ]
+
+
+def test_wide_finger_table():
+    m = 160
+    f = FingerTable(2**159, ("localhost", 5000), m)
+    assert f.getIdxFromId(2**159 + 1) == 1
+    assert f.getIdxFromId(0) == m       # 2**159 + 2**159 wraps to 0
+    assert f.getIdxFromId(3) is None
+
+    # successor of every start in a ring of nodes 2**159 + 2**k, k even
+    for i in range(m):
+        node = 2**159 + 2**(i + i % 2) if i + i % 2 < m else 2**159 + 2**(m - 2)
+        f.update(i + 1, node % 2**m, ("localhost", i))
+    assert f.inversions == 0
+    assert f.find(2**159 + 2**100 + 1) == ("localhost", 100)
+    assert f.find(2**159 + 2**100) == ("localhost", 98)     # entries 99 and 100 are that node
+    assert f.find(2**159) == ("localhost", 0)
+
+    f.update(None, 1, ("localhost", 1))       # unknown entry, ignored
+    assert f.refresh()[-1] == (m, 0, ("localhost", m - 1))
+
+    with pytest.raises(ValueError):
+        FingerTable(0, ("localhost", 5000), 161)
+
+
+def test_fix_fingers():
+    f = FingerTable(2**159, ("localhost", 5000), 160)
+    rounds = [f.fix_fingers() for _ in range(40)]
+    assert all(len(entries) == 4 for entries in rounds)
+    assert [entry for entries in rounds for entry in entries] == f.refresh()     # each entry once
+    assert f.fix_fingers(2) == f.refresh()[:2]
+    assert len(FingerTable(1, ("localhost", 5000), 2).fix_fingers()) == 2
+
+
+def test_wide_ring_node():
+    node = DHTNode(("localhost", 5100), m_bits=160)
+    assert node.hashing == "sha1" and node.finger_table.m_bits == 160
+    assert node.identification == sha1_hash(str(("localhost", 5100)), maximum=2**160)
+    assert node.key_hash("d") == sha1_hash("d", maximum=2**160)
+    node.socket.close()
+
+    node = DHTNode(("localhost", 5100), m_bits=40)
+    assert node.hashing == "fnv" and node.identification == dht_hash(str(("localhost", 5100)), maximum=2**40)
+    node.socket.close()
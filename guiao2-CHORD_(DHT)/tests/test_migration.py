@@ -0,0 +1,239 @@
+"""Tests the key migration on join and leave."""
+import itertools
+import threading
+import time
+import pytest
+import DHTNode as dht_node
+from DHTClient import DHTClient
+from DHTNode import DHTNode
+from transfer import TransferServer, send_keys
+
+
+def failing_send_keys(address, items, **options):
+    raise ConnectionError("refused")
+from utils import contains
+
+KEYS = {f"key{n}": f"value{n}" for n in range(200)}
+PORTS = itertools.count(7200, 2)     # nodes never close their socket, so every ring gets new ports
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def fill(address):
+    client = DHTClient(address)
+    client.socket.settimeout(2)
+    for key, value in KEYS.items():
+        assert client.put(key, value)
+    return client
+
+
+@pytest.fixture
+def ring():
+    """Node a, holding all KEYS, then node b joining it."""
+    port = next(PORTS)
+    a = DHTNode(("localhost", port), timeout=0.5)
+    b = DHTNode(("localhost", port + 1), ("localhost", port), timeout=0.5)
+    a.start()
+    try:
+        time.sleep(0.5)
+        client = fill(a.addr)
+        b.start()
+        assert wait_for(lambda: a.predecessor_id == b.identification and b.predecessor_id == a.identification)
+        assert wait_for(lambda: a.transfers)
+        yield a, b, client
+    finally:
+        a.done = b.done = True
+        a.join()
+        if b.is_alive():
+            b.join()
+
+
+def test_transfer():
+    received = []
+    server = TransferServer(("localhost", 7190), received.extend)
+    server.start()
+    items = list(KEYS.items())[:50]
+    stats = send_keys(("localhost", 7190), items, batch_keys=7)
+    server.done = True
+    server.join()
+
+    assert received == items
+    assert stats["keys"] == 50
+    assert stats["batches"] == 8
+    assert stats["keys_per_sec"] > 0
+
+
+def test_owner_unknown_before_notify():
+    port = next(PORTS)
+    node = DHTNode(("localhost", port), ("localhost", port + 1))
+    node.successor_id, node.successor_addr = (node.identification + 512) % 1024, ("localhost", port + 1)
+    sent = []
+    node.send = lambda address, msg: sent.append((address, msg))
+    keys = {node.key_hash(f"key{n}"): f"key{n}" for n in range(100)}
+    mine = next(k for h, k in keys.items() if not contains(node.identification, node.successor_id, h))
+    successors = next(k for h, k in keys.items() if contains(node.identification, node.successor_id, h))
+
+    assert not node.owns(node.key_hash(mine))
+    node.find_owner(successors, ("localhost", 1), request=1)
+    node.find_owner(mine, ("localhost", 1), request=2)
+    assert [msg["method"] for _, msg in sent] == ["FIND_OWNER"]     # passed on to the successor
+    assert sent[0][0] == node.successor_addr and len(node.deferred) == 1
+
+    node.notify({"predecessor_id": node.successor_id, "predecessor_addr": node.successor_addr})
+    assert sent[1] == (("localhost", 1), {"method": "OWNER", "request": 2, "hops": 0, "owner": node.owner()})
+    assert not node.deferred
+
+
+def test_deferred_bounded(monkeypatch):
+    monkeypatch.setattr(dht_node, "MAX_DEFERRED", 2)
+    port = next(PORTS)
+    node = DHTNode(("localhost", port), ("localhost", port + 1))
+    node.successor_id, node.successor_addr = (node.identification + 512) % 1024, ("localhost", port + 1)
+    sent = []
+    node.send = lambda address, msg: sent.append((address, msg))
+    held = [f"key{n}" for n in range(100) if not contains(node.identification, node.successor_id, node.key_hash(f"key{n}"))]
+
+    for request, key in enumerate(held[:3]):
+        node.get(key, ("localhost", 1), request=request)
+    # the oldest held request is answered, rather than never
+    assert sent == [(("localhost", 1), {"method": "NACK", "request": 0, "hops": 0, "dropped": True})]
+    assert len(node.deferred) == 2 and node.dropped == 1
+
+
+def test_join(ring):
+    a, b, client = ring
+
+    assert b.keystore
+    assert not set(a.keystore) & set(b.keystore)
+    assert {**a.keystore, **b.keystore} == KEYS
+    assert a.transfers[0]["reason"] == "join"
+    assert a.transfers[0]["keys"] == len(b.keystore)
+    for key, value in KEYS.items():
+        assert client.get(key) == value
+
+
+def test_join_transfer_retried(monkeypatch):
+    port = next(PORTS)
+    a = DHTNode(("localhost", port), timeout=0.5)
+    b = DHTNode(("localhost", port + 1), ("localhost", port), timeout=0.5)
+    a.start()
+    try:
+        time.sleep(0.5)
+        client = fill(a.addr)
+        monkeypatch.setattr(dht_node, "send_keys", failing_send_keys)
+        b.start()
+        assert wait_for(lambda: a.predecessor_id == b.identification)
+        time.sleep(1)
+        assert a.keystore == KEYS and not a.transfers
+
+        # the next stabilize rounds send the keys once b takes them
+        monkeypatch.setattr(dht_node, "send_keys", send_keys)
+        assert wait_for(lambda: a.transfers)
+        assert not set(a.keystore) & set(b.keystore)
+        assert {**a.keystore, **b.keystore} == KEYS
+        for key, value in KEYS.items():
+            assert client.get(key) == value
+    finally:
+        a.done = b.done = True
+        a.join()
+        b.join()
+
+
+def test_get_during_join(monkeypatch):
+    released = threading.Event()
+
+    def slow_send_keys(address, items, **options):
+        released.wait(10)
+        return send_keys(address, items, **options)
+
+    port = next(PORTS)
+    a = DHTNode(("localhost", port), timeout=0.5)
+    b = DHTNode(("localhost", port + 1), ("localhost", port), timeout=0.5)
+    a.start()
+    try:
+        time.sleep(0.5)
+        client = fill(a.addr)
+        monkeypatch.setattr(dht_node, "send_keys", slow_send_keys)
+        b.start()
+        assert wait_for(lambda: a.predecessor_id == b.identification and b.predecessor_id == a.identification)
+
+        # b owns keys it hasn't received yet, and asks a for them
+        assert not b.keystore and b.handover_addr == a.addr
+        for key, value in KEYS.items():
+            assert client.get(key) == value
+        assert client.get("missing") is None
+
+        released.set()
+        assert wait_for(lambda: b.handover_addr is None)
+        assert {**a.keystore, **b.keystore} == KEYS and b.keystore
+        for key, value in KEYS.items():
+            assert client.get(key) == value
+    finally:
+        released.set()
+        a.done = b.done = True
+        a.join()
+        b.join()
+
+
+def test_put_during_join():
+    port = next(PORTS)
+    a = DHTNode(("localhost", port), timeout=0.5)
+    b = DHTNode(("localhost", port + 1), ("localhost", port), timeout=0.5)
+    a.start()
+    try:
+        time.sleep(0.5)
+        client = fill(a.addr)
+        expected = dict(KEYS)
+        b.start()
+        # overwrite and add keys while b joins and a hands its keys over
+        for n in range(5000):
+            key = f"key{n % 300}"
+            expected[key] = f"new{n}"
+            assert client.put(key, expected[key])
+            if n >= 300 and a.transfers and b.predecessor_id == a.identification:
+                break
+
+        assert a.transfers
+        assert not set(a.keystore) & set(b.keystore)
+        assert {**a.keystore, **b.keystore} == expected
+        for key, value in expected.items():
+            assert client.get(key) == value
+    finally:
+        a.done = b.done = True
+        a.join()
+        b.join()
+
+
+def test_leave(ring):
+    a, b, client = ring
+
+    stats = b.leave()
+    b.join()
+
+    assert stats["reason"] == "leave"
+    assert a.keystore == KEYS
+    assert wait_for(lambda: a.successor_id == a.identification)
+    for key, value in KEYS.items():
+        assert client.get(key) == value
+
+
+def test_leave_refused(ring, monkeypatch):
+    a, b, client = ring
+
+    monkeypatch.setattr(dht_node, "send_keys", failing_send_keys)
+    assert b.leave(retries=2) is None
+    assert not b.done and not b.leaving
+    for key, value in KEYS.items():
+        assert client.get(key) == value
+
+    monkeypatch.setattr(dht_node, "send_keys", send_keys)
+    assert b.leave()["reason"] == "leave"
+    b.join()
+    assert a.keystore == KEYS
@@ -0,0 +1,106 @@
+"""Tests the pipelined client."""
+import asyncio
+import pickle
+import time
+
+from AsyncDHTClient import AsyncDHTClient, OwnerCache
+from utils import dht_hash
+
+
+class Transport:
+    """Records the datagrams sent."""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append(pickle.loads(data))
+
+    def close(self):
+        pass
+
+
+def test_replies_out_of_order():
+    async def scenario():
+        client = AsyncDHTClient(("localhost", 5000))
+        client.transport = Transport()
+        gets = asyncio.ensure_future(client.get_many(["a", "b", "c"]))
+        while len(client.transport.sent) < 3:
+            await asyncio.sleep(0)
+        for msg in reversed(client.transport.sent):
+            reply = {"method": "ACK", "request": msg["request"], "args": msg["args"]["key"].upper()}
+            client.reply(pickle.dumps(reply))
+        client.reply(pickle.dumps(reply))        # duplicate, ignored
+        return await gets
+
+    assert asyncio.run(scenario()) == ["A", "B", "C"]
+
+
+def test_timeout():
+    async def scenario():
+        client = await AsyncDHTClient.connect(("localhost", 5999), timeout=0.05, retries=2)
+        start = time.perf_counter()
+        stored = await client.put("a", 1)
+        elapsed = time.perf_counter() - start
+        client.close()
+        return stored, elapsed, client.pending
+
+    stored, elapsed, pending = asyncio.run(scenario())
+    assert not stored and pending == {}
+    assert 0.35 - 0.05 < elapsed < 2      # 0.05 + 0.1 + 0.2, then given up
+
+
+def test_put_get_many():
+    async def scenario():
+        client = await AsyncDHTClient.connect(("localhost", 5000))
+        items = [(f"many{n}", n) for n in range(200)]
+        stored = await client.put_many(items)
+        values = await client.get_many([key for key, _ in items] + ["missing"])
+        client.close()
+        return stored, values
+
+    stored, values = asyncio.run(scenario())
+    assert all(stored)
+    assert values == list(range(200)) + [None]
+
+
+def test_owner_cache():
+    cache = OwnerCache()
+    cache.update(100, 300, "b")
+    cache.update(900, 100, "a")         # wraps around the ring
+    cache.update(None, 500, "c")        # range unknown, not cached
+    assert cache.lookup(200) == "b" and cache.lookup(300) == "b"
+    assert cache.lookup(950) == "a" and cache.lookup(50) == "a" and cache.lookup(100) == "a"
+    assert cache.lookup(400) is None and len(cache) == 2
+
+    cache.update(150, 250, "d")         # a node joined in the middle of (100, 300]
+    assert cache.lookup(200) == "d" and cache.lookup(120) is None
+
+    cache.invalidate(50)
+    assert cache.lookup(950) is None and len(cache) == 2
+
+    cache = OwnerCache(2**10)
+    cache.update(1023, 100, "a")        # begins at the last id of the ring
+    cache.update(1000, 10, "b")         # overlaps (1023, 100] from its first id, 0
+    assert cache.lookup(0) == "b" and cache.lookup(50) is None and len(cache) == 1
+
+
+def test_find_owner():
+    async def scenario():
+        client = await AsyncDHTClient.connect(("localhost", 5000))
+        owner = await client.find_owner("owner")
+        assert owner["hops"] >= 0 and owner["addr"][1] in range(5000, 5005)
+
+        assert await client.put("owner", 1)
+        assert await client.get("owner") == 1
+        assert client.stats["direct"] == 2 and client.stats["routed"] == 0
+
+        # a stale entry pointing to another node is dropped on its NACK
+        other = ("localhost", 5000 if owner["addr"][1] != 5000 else 5001)
+        client.owners.update(owner["begin"], owner["id"], other)
+        assert await client.get("owner") == 1
+        assert client.stats["moved"] == 1 and client.stats["routed"] == 1
+        assert client.owners.lookup(dht_hash("owner")) == owner["addr"]
+        client.close()
+
+    asyncio.run(scenario())
@@ -1,6 +1,9 @@
 """Tests two clients."""
+import hashlib
+
 import pytest
-from utils import contains
+import utils
+from utils import contains, dht_hash, hash_many, sha1_hash
 
 
 def test_contains():
@@ -17,3 +20,29 @@ def test_contains():
     assert contains(800, 300, 300)
     assert not contains(800, 300, 700)
     assert not contains(800, 300, 400)
+
+
+def test_dht_hash():
+    # the ids nodes and keys always had in a 2**10 ring
+    assert dht_hash("d") == 115
+    assert dht_hash("f") == 921
+    assert dht_hash(str(("localhost", 5000))) == 770
+
+    assert dht_hash("d", maximum=2**32) % 2**10 == 115
+    assert 2**32 <= max(dht_hash(str(n), maximum=2**64) for n in range(100)) < 2**64
+    assert sha1_hash("d", maximum=2**160) == int(hashlib.sha1(b"d").hexdigest(), 16)
+    assert sha1_hash("d", seed=1, maximum=2**160) != sha1_hash("d", maximum=2**160)
+    with pytest.raises(ValueError):
+        dht_hash("d", maximum=2**160)
+
+
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_hash_many(vectorized, monkeypatch):
+    if not vectorized:
+        monkeypatch.setattr(utils, "numpy", None)
+    elif utils.numpy is None:
+        pytest.skip("NumPy not installed")
+    keys = ["", "a", "ação", "a\0", "key:" * 20] + [f"user:{n}" for n in range(1000)]
+    for maximum in [2**10, 2**32, 2**40, 2**64]:
+        assert hash_many(keys, 7, maximum) == [dht_hash(key, 7, maximum) for key in keys]
+    assert hash_many(keys, maximum=2**160, method="sha1") == [sha1_hash(key, maximum=2**160) for key in keys]
@@ -0,0 +1,94 @@
+""" Bulk key transfer between DHT nodes.
+
+Keys move over TCP, on the port number of the node's UDP socket, in pickled
+batches of up to BATCH_KEYS keys, each prefixed by its 4 byte length. The
+receiver answers with the number of keys it got once the sender is done.
+"""
+import logging
+import pickle
+import socket
+import threading
+import time
+
+BATCH_KEYS = 256
+
+
+def recv_exactly(conn, size):
+    """Receive size bytes (fewer only if the connection closes)."""
+    chunks = []
+    while size:
+        chunk = conn.recv(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_keys(address, items, batch_keys=BATCH_KEYS, timeout=10):
+    """Stream the (key, value) items to the node at address, returns the transfer stats."""
+    start = time.perf_counter()
+    sent = size = batches = 0
+    with socket.create_connection(address, timeout=timeout) as conn:
+        for first in range(0, len(items), batch_keys):
+            payload = pickle.dumps(items[first:first + batch_keys])
+            conn.sendall(len(payload).to_bytes(4, "big") + payload)
+            sent += len(items[first:first + batch_keys])
+            size += len(payload)
+            batches += 1
+        conn.shutdown(socket.SHUT_WR)
+        received = int.from_bytes(recv_exactly(conn, 8), "big")
+    if received != sent:
+        raise ConnectionError(f"{address} received {received} of {sent} keys")
+    seconds = time.perf_counter() - start
+    return {"peer": address, "keys": sent, "bytes": size, "batches": batches, "seconds": seconds,
+            "keys_per_sec": sent / seconds if seconds else 0}
+
+
+class TransferServer(threading.Thread):
+    """Receives the keys other nodes send, handing every batch to receive
+    (and calling finished once a transfer went through)."""
+
+    def __init__(self, address, receive, finished=None, timeout=0.5):
+        threading.Thread.__init__(self, daemon=True)
+        self.receive = receive
+        self.finished = finished
+        self.done = False
+        self.logger = logging.getLogger("Transfer {}".format(address))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen()
+        self.socket.settimeout(timeout)     # how often done is checked
+
+    def handle(self, conn):
+        """Receive the batches of a connection, then tell how many keys arrived."""
+        received = 0
+        with conn:
+            conn.settimeout(None)
+            try:
+                while True:
+                    header = recv_exactly(conn, 4)
+                    if len(header) < 4:
+                        break
+                    batch = pickle.loads(recv_exactly(conn, int.from_bytes(header, "big")))
+                    self.receive(batch)
+                    received += len(batch)
+                conn.sendall(received.to_bytes(8, "big"))
+            except (OSError, pickle.UnpicklingError, EOFError) as err:
+                self.logger.error("Transfer failed after %d keys: %s", received, err)
+                return
+        if self.finished is not None:
+            self.finished()
+        self.logger.debug("Received %d keys", received)
+
+    def run(self):
+        while not self.done:
+            try:
+                conn, _ = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        self.socket.close()
@@ -1,16 +1,120 @@
+import hashlib
 import sys
 
+try:
+    import numpy
+except ImportError:     # hash_many hashes the keys one by one
+    numpy = None
+
+# FNV-1a (prime, offset basis) of each hash width, in bits
+FNV = {
+    32: (16777619, 2166136261),
+    64: (1099511628211, 14695981039346656037),
+}
+MIX64 = (0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53)     # MurmurHash3 fmix64 multipliers
+MASK64 = 2**64 - 1
+
+
+def fnv_width(maximum):
+    """Narrowest FNV width covering the ids below maximum."""
+    for width in FNV:
+        if maximum <= 2**width:
+            return width
+    raise ValueError(f"FNV covers rings of up to 2**64 ids, not {maximum}: use sha1")
+
+
+def default_hashing(m_bits):
+    """Hash function of a ring of 2**m_bits ids: FNV up to 64 bits, SHA-1 above."""
+    return "fnv" if m_bits <= 64 else "sha1"
+
+
+def mix64(h):
+    """Spread the last characters of a 64 bit FNV hash over all of its bits."""
+    h ^= h >> 33
+    h = (h * MIX64[0]) & MASK64
+    h ^= h >> 33
+    h = (h * MIX64[1]) & MASK64
+    return h ^ (h >> 33)
+
+
 def dht_hash(text, seed=0, maximum=2**10):
-    """ FNV-1a Hash Function. """
-    fnv_prime = 16777619
-    offset_basis = 2166136261
+    """ FNV-1a Hash Function.
+
+    32 bits for rings of up to 2**32 ids. Wider rings get the 64 bit hash,
+    finalized with mix64: FNV alone barely mixes the last characters of a key
+    into the high bits, which decide where in the ring it lands.
+    """
+    width = fnv_width(maximum)
+    fnv_prime, offset_basis = FNV[width]
+    mask = 2**width - 1
     h = offset_basis + seed
     for char in text:
         h = h ^ ord(char)
-        h = h * fnv_prime
+        h = (h * fnv_prime) & mask
+    if width == 64:
+        h = mix64(h)
     return h % maximum
 
 
+def sha1_hash(text, seed=0, maximum=2**10):
+    """ SHA-1 Hash Function (hashlib), for rings of up to 2**160 ids. """
+    data = text.encode("utf-8")
+    if seed:
+        data = b"%d:" % seed + data
+    return int.from_bytes(hashlib.sha1(data).digest(), "big") % maximum
+
+
+HASHES = {"fnv": dht_hash, "sha1": sha1_hash}
+
+
+def _fnv_many(texts, seed, maximum):
+    """FNV-1a of texts, a character of every text at a time."""
+    width = fnv_width(maximum)
+    dtype = numpy.uint32 if width == 32 else numpy.uint64
+    fnv_prime, offset_basis = FNV[width]
+    chars = numpy.array(texts, dtype=str)
+    length = chars.dtype.itemsize // 4
+    lengths = numpy.char.str_len(chars)
+
+    # longest first, so the texts still being hashed at every character are a prefix
+    order = numpy.argsort(-lengths, kind="stable")
+    codes = chars.view(numpy.uint32).reshape(len(texts), length)[order].astype(dtype)
+    active = numpy.searchsorted(-lengths[order], -numpy.arange(length), side="left")
+    h = numpy.full(len(texts), (offset_basis + seed) % 2**width, dtype=dtype)
+    prime = dtype(fnv_prime)
+    for column in range(length):
+        count = active[column]
+        h[:count] = (h[:count] ^ codes[:count, column]) * prime
+
+    hashes = numpy.empty_like(h)
+    hashes[order] = h
+    if width == 64:
+        shift = numpy.uint64(33)
+        hashes ^= hashes >> shift
+        hashes *= numpy.uint64(MIX64[0])
+        hashes ^= hashes >> shift
+        hashes *= numpy.uint64(MIX64[1])
+        hashes ^= hashes >> shift
+    if maximum < 2**width:
+        hashes %= dtype(maximum)
+    return hashes.tolist()
+
+
+def hash_many(texts, seed=0, maximum=2**10, method="fnv"):
+    """Hash a batch of keys, the same as hashing them one at a time.
+
+    FNV is vectorized with NumPy when it is installed; SHA-1 runs in hashlib's
+    C code.
+    """
+    texts = list(texts)
+    if method == "sha1":
+        return [sha1_hash(text, seed, maximum) for text in texts]
+    fnv_width(maximum)      # check the ring isn't too wide for FNV
+    if numpy is not None and texts and not any(text[-1:] == "\0" for text in texts):   # NumPy strips trailing NULs
+        return _fnv_many(texts, seed, maximum)
+    return [dht_hash(text, seed, maximum) for text in texts]
+
+
 def contains(begin, end, node):
     """Check node is contained between begin and end in a ring."""
     if (begin > end):
@@ -20,3 +124,7 @@ def contains(begin, end, node):
         if (node > begin and node <= end):
             return True
     return False
+
+
+# largest payload a UDP datagram can carry, so values over 1 KiB aren't truncated
+DATAGRAM_SIZE = 65507
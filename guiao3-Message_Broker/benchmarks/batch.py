@@ -0,0 +1,72 @@
+"""Benchmark batched publishes: messages/sec by batch size and serializer.
+
+Run from the project root (port 5000 must be free):
+    python -m benchmarks.batch
+"""
+import argparse
+import threading
+import time
+
+from src.broker import Broker
+from src.middleware import JSONQueue, XMLQueue, PickleQueue, BinaryQueue, MiddlewareType
+
+q_protocol = {
+    "json": JSONQueue,
+    "xml": XMLQueue,
+    "pickle": PickleQueue,
+    "binary": BinaryQueue,
+}
+
+
+def start_broker() -> Broker:
+    """Run a broker in a background thread."""
+    broker = Broker()
+    threading.Thread(target=broker.run, daemon=True).start()
+    time.sleep(0.5)
+    return broker
+
+
+def run(queue_type, batch: int, messages: int):
+    """Publish <messages> values <batch> at a time, returns (send rate, delivery rate)."""
+    topic = f"/bench/{queue_type.__name__}/{batch}"
+    consumer = queue_type(topic, _type=MiddlewareType.CONSUMER)
+    producer = queue_type(topic, _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+
+    done = threading.Event()
+
+    def consume():
+        for _ in range(messages):
+            consumer.pull()
+        done.set()
+
+    threading.Thread(target=consume, daemon=True).start()
+
+    start = time.perf_counter()
+    for i in range(0, messages, batch):
+        values = range(i, min(i + batch, messages))
+        if batch == 1:
+            producer.push(i)
+        else:
+            producer.push_many(values)
+    sent = time.perf_counter()
+    done.wait()
+    delivered = time.perf_counter()
+
+    consumer.socket.close()
+    producer.socket.close()
+    return messages / (sent - start), messages / (delivered - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", help="messages per run", type=int, default=20000)
+    parser.add_argument("--batch", help="batch sizes", type=int, nargs="+", default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    start_broker()
+    print(f"{'serializer':<10} {'batch':>6} {'sent msg/s':>12} {'delivered msg/s':>16}")
+    for name, queue_type in q_protocol.items():
+        for batch in args.batch:
+            sent, delivered = run(queue_type, batch, args.messages)
+            print(f"{name:<10} {batch:>6} {sent:>12.0f} {delivered:>16.0f}")
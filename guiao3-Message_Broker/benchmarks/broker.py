@@ -0,0 +1,223 @@
+"""Benchmark the broker end to end: throughput, latency and memory.
+
+Drives N producers and M consumers, one thread each, for every combination of
+serializer, topic depth and payload size. Every value carries its send time,
+so consumers measure the end-to-end latency of each delivery. The broker runs
+in this process or, with --subprocess, as `python broker.py` (so the clients
+don't compete with it for the GIL).
+
+Run from the project root (port 5000 must be free):
+    python -m benchmarks.broker --output results.json
+    python -m benchmarks.broker --output new.json --compare results.json
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from src.broker import Broker
+from src.middleware import JSONQueue, XMLQueue, PickleQueue, BinaryQueue, MiddlewareType
+
+q_protocol = {
+    "json": JSONQueue,
+    "xml": XMLQueue,
+    "pickle": PickleQueue,
+    "binary": BinaryQueue,
+}
+
+PORT = 5000
+STAMP = 20          # digits of the send time at the start of every value
+
+
+def rss(pid: int) -> int:
+    """Resident memory of process pid, in bytes (0 if unknown)."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if pid == os.getpid():
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+
+def percentile(ordered, p: float) -> float:
+    """Nearest rank percentile of an ordered list."""
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p * len(ordered)) - 1))]
+
+
+def wait_port(port: int, timeout: float = 10):
+    """Wait until something listens on port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"broker not listening on port {port}")
+
+
+def start_broker(in_subprocess: bool, engine: str):
+    """Start the broker, returns (pid, stop function)."""
+    if in_subprocess:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        process = subprocess.Popen(
+            [sys.executable, "broker.py", "--engine", engine, "--port", str(PORT)],
+            cwd=root,
+            stdout=subprocess.DEVNULL,
+        )
+        wait_port(PORT)
+        return process.pid, lambda: (process.terminate(), process.wait())
+
+    broker = Broker(port=PORT)
+    threading.Thread(target=broker.run, daemon=True).start()
+    wait_port(PORT)
+    return os.getpid(), lambda: setattr(broker, "canceled", True)
+
+
+def run(name: str, producers: int, consumers: int, depth: int, payload: int, messages: int, timeout: float):
+    """Run one scenario, returns its results."""
+    queue_type = q_protocol[name]
+    root = f"/bench{time.monotonic_ns()}"
+    topic = root + "".join(f"/level{i}" for i in range(1, depth))
+    expected = producers * messages
+
+    subscribers = [queue_type(root, _type=MiddlewareType.CONSUMER) for _ in range(consumers)]
+    publishers = [queue_type(topic, _type=MiddlewareType.PRODUCER) for _ in range(producers)]
+    time.sleep(0.2)
+    padding = "x" * max(payload - STAMP, 0)
+    latencies = [[] for _ in subscribers]
+
+    def consume(queue, received):
+        queue.socket.settimeout(timeout)
+        try:
+            while len(received) < expected:
+                event = queue.receive()
+                if event is None:
+                    break
+                received.append(time.perf_counter_ns() - int(str(event[1])[:STAMP]))
+        except OSError:         # timed out, the missing messages count as lost
+            pass
+
+    def produce(queue):
+        for _ in range(messages):
+            queue.push(f"{time.perf_counter_ns():0{STAMP}d}{padding}")
+
+    threads = [threading.Thread(target=consume, args=args) for args in zip(subscribers, latencies)]
+    for thread in threads:
+        thread.start()
+    senders = [threading.Thread(target=produce, args=(queue,)) for queue in publishers]
+
+    start = time.perf_counter()
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    sent = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    delivered = time.perf_counter()
+
+    for queue in subscribers + publishers:
+        queue.socket.close()
+
+    ordered = sorted(itertools.chain.from_iterable(latencies))
+    return {
+        "serializer": name,
+        "producers": producers,
+        "consumers": consumers,
+        "depth": depth,
+        "payload": payload,
+        "messages": expected,
+        "deliveries": len(ordered),
+        "lost": expected * consumers - len(ordered),
+        "sent_per_sec": expected / (sent - start),
+        "delivered_per_sec": len(ordered) / (delivered - start),
+        "p50_ms": percentile(ordered, 0.50) / 1e6,
+        "p99_ms": percentile(ordered, 0.99) / 1e6,
+        "p999_ms": percentile(ordered, 0.999) / 1e6,
+    }
+
+
+def key(result) -> tuple:
+    return tuple(result[field] for field in ("serializer", "producers", "consumers", "depth", "payload"))
+
+
+def compare(results, baseline_path: str):
+    """Print the change of every scenario against the results in baseline_path."""
+    with open(baseline_path) as baseline_file:
+        baseline = {key(result): result for result in json.load(baseline_file)["results"]}
+    print(f"\n{'scenario':<28} {'delivered/s':>12} {'p99':>8}  vs {baseline_path}")
+    for result in results:
+        old = baseline.get(key(result))
+        if old is None:
+            continue
+        scenario = "{} p{} c{} d{} {}B".format(*key(result))
+        rate = result["delivered_per_sec"] / old["delivered_per_sec"] - 1
+        p99 = result["p99_ms"] / old["p99_ms"] - 1
+        print(f"{scenario:<28} {rate:>+12.1%} {p99:>+8.1%}")
+
+
+def commit() -> str:
+    """Current git commit, if any."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serializers", nargs="+", choices=list(q_protocol.keys()), default=list(q_protocol.keys()))
+    parser.add_argument("--producers", help="producer threads", type=int, default=2)
+    parser.add_argument("--consumers", help="consumer threads", type=int, default=2)
+    parser.add_argument("--depth", help="topic depths", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--payload", help="value sizes in bytes", type=int, nargs="+", default=[32, 1024])
+    parser.add_argument("--messages", help="messages per producer", type=int, default=2000)
+    parser.add_argument("--timeout", help="seconds a consumer waits for a message", type=float, default=10)
+    parser.add_argument("--subprocess", help="run the broker in its own process", action="store_true")
+    parser.add_argument("--engine", help="broker implementation with --subprocess", default="selectors")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results to compare with")
+    args = parser.parse_args()
+
+    pid, stop = start_broker(args.subprocess, args.engine)
+    results = []
+    print(f"{'serializer':<10} {'depth':>5} {'payload':>7} {'sent/s':>9} {'delivered/s':>11} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'lost':>5} {'rss MB':>7}")
+    try:
+        for name, depth, payload in itertools.product(args.serializers, args.depth, args.payload):
+            result = run(name, args.producers, args.consumers, depth, payload, args.messages, args.timeout)
+            result["broker_rss"] = rss(pid)
+            results.append(result)
+            print(f"{name:<10} {depth:>5} {payload:>7} {result['sent_per_sec']:>9.0f} "
+                  f"{result['delivered_per_sec']:>11.0f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+                  f"{result['p999_ms']:>8.2f} {result['lost']:>5} {result['broker_rss'] / 2**20:>7.1f}")
+    finally:
+        stop()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "commit": commit(),
+                "python": platform.python_version(),
+                "broker": "subprocess" if args.subprocess else "in-process",
+                "engine": args.engine if args.subprocess else "selectors",
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": results,
+            }, output, indent=2)
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,93 @@
+"""Benchmark the broker throughput against the number of worker processes.
+
+Every producer and consumer runs in its own process, so the clients don't
+share a GIL with each other or with the broker. Producers spread their values
+over several topics, consumers subscribe to all of them.
+
+Run from the project root (port 5000 must be free):
+    python -m benchmarks.cluster --workers 1 2 4
+"""
+import argparse
+import multiprocessing
+import time
+
+from benchmarks.broker import PORT, wait_port
+from src.cluster import Cluster
+from src.middleware import PickleQueue, MiddlewareType
+
+
+def consume(root: str, expected: int, timeout: float, ready, results):
+    queue = PickleQueue(root, _type=MiddlewareType.CONSUMER)
+    queue.socket.settimeout(timeout)
+    ready.release()
+    received = 0
+    try:
+        while received < expected:
+            if queue.receive() is None:
+                break
+            received += 1
+    except OSError:         # timed out, the missing messages count as lost
+        pass
+    results.put((received, time.perf_counter()))
+
+
+def produce(root: str, topics: int, messages: int, payload: int, start):
+    queues = [PickleQueue(f"{root}/t{i}", _type=MiddlewareType.PRODUCER) for i in range(topics)]
+    value = "x" * payload
+    start.wait()
+    for n in range(messages):
+        queues[n % topics].push(value)
+
+
+def run(workers: int, producers: int, consumers: int, topics: int, messages: int, payload: int, timeout: float):
+    """Run one scenario on a cluster of workers, returns the delivered messages/sec and the lost messages."""
+    cluster = Cluster(workers, port=PORT).start()
+    try:
+        wait_port(PORT)
+        root = f"/bench{time.monotonic_ns()}"
+        expected = producers * messages
+        context = multiprocessing.get_context("fork")
+        ready, start, results = context.Semaphore(0), context.Event(), context.Queue()
+
+        readers = [context.Process(target=consume, args=(root, expected, timeout, ready, results))
+                   for _ in range(consumers)]
+        for process in readers:
+            process.start()
+        for _ in readers:
+            ready.acquire()
+        writers = [context.Process(target=produce, args=(root, topics, messages, payload, start))
+                   for _ in range(producers)]
+        for process in writers:
+            process.start()
+        time.sleep(0.5)         # subscriptions and connections settle
+
+        began = time.perf_counter()
+        start.set()
+        done = [results.get() for _ in readers]
+        for process in writers + readers:
+            process.join()
+    finally:
+        cluster.stop()
+
+    delivered = sum(received for received, _ in done)
+    ended = max(finished for _, finished in done)
+    return delivered / (ended - began), expected * consumers - delivered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", help="worker processes of each run", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--producers", help="producer processes", type=int, default=4)
+    parser.add_argument("--consumers", help="consumer processes", type=int, default=4)
+    parser.add_argument("--topics", help="topics each producer publishes on", type=int, default=8)
+    parser.add_argument("--messages", help="messages per producer", type=int, default=5000)
+    parser.add_argument("--payload", help="value size in bytes", type=int, default=64)
+    parser.add_argument("--timeout", help="seconds a consumer waits for a message", type=float, default=10)
+    args = parser.parse_args()
+
+    print(f"{'workers':>7} {'delivered/s':>11} {'lost':>6}")
+    for workers in args.workers:
+        rate, lost = run(workers, args.producers, args.consumers, args.topics, args.messages, args.payload,
+                         args.timeout)
+        print(f"{workers:>7} {rate:>11.0f} {lost:>6}")
+        time.sleep(0.5)
@@ -0,0 +1,56 @@
+"""Benchmark the durable topic log: append and replay throughput.
+
+Run from the project root:
+    python -m benchmarks.commitlog
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+from src.commitlog import TopicLog
+
+values = {
+    "int": 21,
+    "str": "Valeu a pena? Tudo vale a pena",
+    "1KiB": "x" * 1024,
+}
+
+
+def run(value, records: int, segment_bytes: int):
+    """Returns (appends/sec, append MB/s, replayed records/sec, replay MB/s)."""
+    directory = tempfile.mkdtemp()
+    try:
+        log = TopicLog(directory, segment_bytes=segment_bytes)
+        start = time.perf_counter()
+        for _ in range(records):
+            log.append(value)
+        log.flush()
+        appended = time.perf_counter()
+
+        count = sum(1 for _ in log.read(offset=0))
+        replayed = time.perf_counter()
+        assert count == records
+
+        megabytes = log.size / 2**20
+        log.close()
+        return (
+            records / (appended - start),
+            megabytes / (appended - start),
+            records / (replayed - appended),
+            megabytes / (replayed - appended),
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", help="records per run", type=int, default=200000)
+    parser.add_argument("--segment-bytes", help="size of the log segments", type=int, default=2**24)
+    args = parser.parse_args()
+
+    print(f"{'value':<6} {'appends/s':>12} {'append MB/s':>12} {'replays/s':>12} {'replay MB/s':>12}")
+    for name, value in values.items():
+        appends, append_mb, replays, replay_mb = run(value, args.records, args.segment_bytes)
+        print(f"{name:<6} {appends:>12.0f} {append_mb:>12.1f} {replays:>12.0f} {replay_mb:>12.1f}")
@@ -0,0 +1,44 @@
+"""Benchmark encode/decode throughput and frame size of each serializer.
+
+Run from the project root:
+    python -m benchmarks.serializers
+"""
+import argparse
+import time
+
+from src.protocol import PubSubProtocol, Serializer
+
+messages = {
+    "int": PubSubProtocol.pub("/weather2/temperature/celsius", 21),
+    "float": PubSubProtocol.pub("/weather2/temperature/fahrenheit", 69.8),
+    "str": PubSubProtocol.pub("/msg", "Valeu a pena? Tudo vale a pena"),
+    "batch": PubSubProtocol.pubBatch([("/weather/pressure", 10000 + i) for i in range(100)]),
+}
+
+
+def run(serializer: Serializer, msg, rounds: int):
+    """Returns (encodes/sec, decodes/sec, frame bytes)."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        frame = PubSubProtocol.encode(serializer, msg)
+    encoded = time.perf_counter()
+
+    body = frame[3:]
+    for _ in range(rounds):
+        PubSubProtocol.decode(serializer.value, body)
+    decoded = time.perf_counter()
+
+    return rounds / (encoded - start), rounds / (decoded - encoded), len(frame)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", help="encodes/decodes per measure", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'message':<8} {'serializer':<10} {'encode/s':>10} {'decode/s':>10} {'bytes':>7}")
+    for name, msg in messages.items():
+        rounds = args.rounds // 100 if name == "batch" else args.rounds
+        for serializer in Serializer:
+            encode, decode, size = run(serializer, msg, rounds)
+            print(f"{name:<8} {serializer.name.lower():<10} {encode:>10.0f} {decode:>10.0f} {size:>7}")
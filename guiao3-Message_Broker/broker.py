@@ -1,7 +1,82 @@
 """Call broker."""
+import argparse
 
 from src.broker import Broker
+from src.cluster import Cluster
+from src.async_broker import AsyncBroker
+from src.commitlog import CommitLog
+from src.groups import STRATEGIES
+from src.outbox import POLICIES
+
+engines = {
+    "selectors": Broker,
+    "asyncio": AsyncBroker,
+}
 
 if __name__ == "__main__":
-    broker = Broker()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--engine",
+        help="broker implementation",
+        choices=list(engines.keys()),
+        default=list(engines.keys())[0],
+    )
+    parser.add_argument("--port", help="port to listen on", type=int, default=5000)
+    parser.add_argument("--workers", help="worker processes sharing the port (selectors engine only)", type=int, default=1)
+    parser.add_argument("--metrics-port", help="serve Prometheus metrics on http://localhost:<port>/metrics", type=int)
+    parser.add_argument("--log-dir", help="keep a durable log of every topic in this folder")
+    parser.add_argument("--segment-bytes", help="size of the log segments", type=int, default=2**24)
+    parser.add_argument("--retention-bytes", help="log size kept per topic", type=int)
+    parser.add_argument("--retention-seconds", help="age of the log kept per topic", type=float)
+    parser.add_argument("--compact", help="keep only the last value of each topic in the log", action="store_true")
+    parser.add_argument("--log-open-topics", help="topics of the log with their files open at once", type=int, default=128)
+    parser.add_argument("--strategy", help="how consumer groups pick a member", choices=STRATEGIES, default=STRATEGIES[0])
+    parser.add_argument("--ack-timeout", help="seconds before a consumer group message is redelivered", type=float, default=30)
+    parser.add_argument("--max-pending", help="messages a consumer group keeps waiting for a member", type=int, default=10000)
+    parser.add_argument("--overflow", help="what gives when a subscriber queue is full", choices=POLICIES, default=POLICIES[0])
+    parser.add_argument("--max-queued", help="frames queued per subscriber", type=int, default=10000)
+    parser.add_argument("--max-queued-bytes", help="bytes queued per subscriber", type=int, default=2**24)
+    parser.add_argument("--max-frame", help="largest message a client may send, in bytes", type=int, default=2**23)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        if args.engine != "selectors" or args.log_dir:
+            parser.error("--workers runs the selectors engine, without --log-dir")
+        Cluster(
+            args.workers,
+            port=args.port,
+            metrics_port=args.metrics_port,
+            overflow=args.overflow,
+            max_queued=args.max_queued,
+            max_queued_bytes=args.max_queued_bytes,
+            max_frame=args.max_frame,
+            strategy=args.strategy,
+            ack_timeout=args.ack_timeout,
+            max_pending=args.max_pending,
+        ).run()
+        parser.exit()
+
+    log = None
+    if args.log_dir:
+        log = CommitLog(
+            args.log_dir,
+            max_open=args.log_open_topics,
+            segment_bytes=args.segment_bytes,
+            retention_bytes=args.retention_bytes,
+            retention_seconds=args.retention_seconds,
+            compact=args.compact,
+        )
+
+    broker = engines[args.engine](
+        port=args.port,
+        log=log,
+        metrics_port=args.metrics_port,
+        overflow=args.overflow,
+        max_queued=args.max_queued,
+        max_queued_bytes=args.max_queued_bytes,
+        max_frame=args.max_frame,
+        strategy=args.strategy,
+        ack_timeout=args.ack_timeout,
+        max_pending=args.max_pending,
+    )
     broker.run()
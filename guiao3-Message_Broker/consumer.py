@@ -19,8 +19,10 @@ if __name__ == "__main__":
         choices=list(q_protocol.keys()),
         default=list(q_protocol.keys())[0],
     )
+    parser.add_argument("--group", help="consumer group to share the messages with")
+    parser.add_argument("--workers", help="threads processing the messages", type=int, default=1)
     args = parser.parse_args()
 
-    c = Consumer(args.topic, q_protocol[args.queue_type])
+    c = Consumer(args.topic, q_protocol[args.queue_type], args.group)
 
-    c.run(int(args.length))
+    c.run(int(args.length), args.workers)
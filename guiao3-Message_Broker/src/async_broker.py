@@ -0,0 +1,215 @@
+"""Message Broker running on asyncio."""
+import asyncio
+import time
+from itertools import islice
+
+from src.broker import REPLAY_BATCH, Broker
+from src.framing import EXTENDED
+from src.commitlog import CommitLog
+from src.log import get_logger
+from src.metrics import http_response
+from src.outbox import Outbox, Overflow
+from src.protocol import PubSubProtocol
+
+logger = get_logger("AsyncBroker")
+
+
+class Connection:
+    """Client connection with a bounded outgoing buffer.
+
+    Quacks like the socket the Broker logic writes to: `send` only appends the
+    frame to the transport buffer, which is drained by the event loop.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, limit: int, broker: "AsyncBroker"):
+        self.reader = reader
+        self.writer = writer
+        self.limit = limit
+        self._broker = broker
+        writer.transport.set_write_buffer_limits(high=limit)
+
+    def send(self, data: bytes) -> int:
+        """Queue data to be written to the client."""
+        if self.writer.is_closing():
+            return 0
+        self.writer.write(data)
+        if self.congested:
+            self._broker._congested.add(self)
+        return len(data)
+
+    sendall = send
+
+    @property
+    def buffered(self) -> int:
+        """Number of bytes waiting to be written."""
+        return self.writer.transport.get_write_buffer_size()
+
+    @property
+    def congested(self) -> bool:
+        """Check if the outgoing buffer is above its limit."""
+        return self.buffered > self.limit
+
+    def close(self):
+        """Close the connection."""
+        self.writer.close()
+
+    def __repr__(self):
+        return f"Connection({self.writer.get_extra_info('peername')})"
+
+
+class AsyncBroker(Broker):
+    """PubSub Message Broker implemented with asyncio streams.
+
+    Wire compatible with Broker. Every connection gets its own outgoing buffer,
+    so a publish never waits on a socket write; a publisher only stops being
+    read while one of the subscribers it wrote to is above its buffer limit
+    (backpressure instead of the overflow policies of Broker). A subscriber
+    that doesn't drain within drain_timeout seconds is disconnected. Only the
+    values held while a log replay is written follow the overflow policy.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 5000, log: CommitLog = None, metrics_port: int = None,
+                 buffer_limit: int = 2**20, drain_timeout: float = 5, **group_options):
+        """Initialize broker."""
+        self.buffer_limit = buffer_limit
+        self.drain_timeout = drain_timeout
+        self._congested = set()     # connections written above their limit by the message being handled
+        self._connections = set()
+        super().__init__(host, port, log, metrics_port, **group_options)
+
+    def listen(self):
+        """Sockets are created by the event loop in run."""
+        self.server = None
+
+    async def _recv(self, conn: Connection):
+        """Read one frame from conn, None when the connection is closed."""
+        try:
+            head = await conn.reader.readexactly(3)
+            header = int.from_bytes(head[1:3], 'big')
+            if not header:
+                return None
+            if header == EXTENDED:
+                header = int.from_bytes(await conn.reader.readexactly(4), 'big')
+            if header > self.maxFrame:
+                logger.warning("Disconnecting %s: frame of %d bytes, the limit is %d", conn, header, self.maxFrame)
+                return None
+            frame = await conn.reader.readexactly(header)
+            data = PubSubProtocol.decode(head[0], frame)
+            self.received(conn, head[0], frame, data)
+            return data
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def _client(self, reader, writer):
+        """Serve a client connection until it closes."""
+        conn = Connection(reader, writer, self.buffer_limit, self)
+        self._connections.add(conn)
+        try:
+            while not self.canceled:
+                data = await self._recv(conn)
+                if not data:
+                    break
+                start = time.perf_counter()
+                self._congested = set()
+                self.handle(conn, data)
+                congested, self._congested = self._congested, set()
+                self.metrics.loop(0, time.perf_counter() - start)
+
+                # backpressure: stop reading this client while a receiver it wrote to is full
+                if congested:
+                    await asyncio.gather(*(self._drain(receiver) for receiver in congested))
+                if conn in self.replays:
+                    await self._replay(conn)
+        finally:
+            self.disconnect(conn)
+
+    async def _drain(self, conn: Connection):
+        """Wait for conn to drop below its limit, disconnecting it if it takes too long."""
+        try:
+            await asyncio.wait_for(conn.writer.drain(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Disconnecting slow subscriber %s: %d bytes buffered", conn, conn.buffered)
+            self.disconnect(conn)
+        except ConnectionError:
+            pass
+
+    def replay(self, conn, topic: str, offset: int = None, timestamp: float = None):
+        """Send conn the logged values of topic and its subtopics, from offset or timestamp on.
+
+        The replay is written by the coroutine of conn once the Sub is handled
+        (see _replay); values published meanwhile are held until it ends.
+        """
+        self.replays[conn] = (self.logFrames(conn, topic, offset, timestamp), Outbox(**self.outboxOptions))
+
+    async def _replay(self, conn: Connection):
+        """Write the replay of conn REPLAY_BATCH frames at a time, waiting for each to drain, then the held frames."""
+        frames, held = self.replays[conn]
+        serialType = self.getSerial(conn)
+        batch = list(islice(frames, REPLAY_BATCH))
+        while batch and conn in self._connections:
+            self.writeThrough(conn, serialType, [(None, frame) for frame in batch])
+            await self._drain(conn)
+            batch = list(islice(frames, REPLAY_BATCH))
+        if self.replays.pop(conn, None) is not None and held.queue:
+            self.writeThrough(conn, serialType, [(topic, frame) for topic, frame, _ in held.queue])
+
+    def write(self, conn, serialType, frames):
+        """Append encoded frames to the outgoing buffer of conn, or hold them while its replay is written."""
+        replay = self.replays.get(conn)
+        if replay is None:
+            self.writeThrough(conn, serialType, frames)
+            return
+        try:
+            for topic, frame in frames:
+                replay[1].put(frame, topic)
+        except Overflow as err:
+            logger.warning("Disconnecting %s: %s", conn, err)
+            self.disconnect(conn)
+
+    def disconnect(self, conn):
+        """Forget a closed connection."""
+        if conn not in self._connections:
+            return
+        self.unsubscribe("", conn)
+        self.serialTypes.pop(conn, None)
+        self.versions.pop(conn, None)
+        self.metrics.forget(conn)
+        self.replays.pop(conn, None)
+        self._connections.discard(conn)
+        self._congested.discard(conn)
+        conn.close()
+
+    def buffered(self):
+        """Bytes waiting to be written, for each connection."""
+        return {conn: conn.buffered for conn in list(self._connections)}
+
+    async def _metrics(self, reader, writer):
+        """Answer an HTTP request for the metrics."""
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.drain_timeout)
+            writer.write(http_response(request, self.stats))
+            await asyncio.wait_for(writer.drain(), self.drain_timeout)
+        except asyncio.IncompleteReadError as err:
+            writer.write(http_response(err.partial, self.stats))
+        except (asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        writer.close()
+
+    async def serve(self):
+        """Accept clients until canceled."""
+        self.server = await asyncio.start_server(self._client, self._host, self._port, reuse_address=True)
+        if self.metricsPort is not None:
+            self.metricsServer = await asyncio.start_server(self._metrics, self._host, self.metricsPort, reuse_address=True)
+        async with self.server:
+            while not self.canceled:
+                await asyncio.sleep(0.1)
+                self.expire()
+                if self.log is not None:
+                    self.log.flush()        # appends are handed to the OS every 100 ms
+
+    def run(self):
+        """Run until canceled."""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Caught keyboard interrupt, exiting")
@@ -0,0 +1,198 @@
+"""Compact binary serialization of broker messages, built with struct.
+
+A message is its type code followed by its fields, in the order of FIELDS.
+Strings are length-prefixed utf-8 and values carry a one byte type tag, so
+ints, floats, strings and bytes come back with their own type.
+"""
+import json
+import struct
+from typing import Any, Dict, Tuple
+
+_U8 = struct.Struct(">B")
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
+_I64 = struct.Struct(">q")
+_F64 = struct.Struct(">d")
+
+TYPES = ["Sub", "Pub", "TopicListReq", "TopicListRep", "CancelSub", "Ack", "PubBatch", "StatsReq", "StatsRep",
+         "SnapshotReq", "SnapshotRep"]
+TYPE_CODES = {name: code for code, name in enumerate(TYPES)}
+
+FIELDS = {
+    "Sub": ("topic", "offset", "timestamp", "group", "prefetch"),
+    "Pub": ("topic", "value", "id"),
+    "TopicListReq": ("prefix", "after", "limit"),
+    "TopicListRep": ("lista",),
+    "CancelSub": ("topic",),
+    "Ack": ("lan", "version", "id"),
+    "PubBatch": ("pubs",),
+    "StatsReq": (),
+    "StatsRep": ("stats",),
+    "SnapshotReq": ("topic",),
+    "SnapshotRep": ("pubs", "last"),
+}
+
+# value tags
+NONE, INT, FLOAT, STR, BYTES, BOOL, BIGINT = range(7)
+
+_TAG_I64 = struct.Struct(">Bq")
+_TAG_F64 = struct.Struct(">Bd")
+_TAG_U32 = struct.Struct(">BI")
+
+
+def _pack_str(out: bytearray, text: str):
+    data = text.encode("utf-8")
+    out += _U16.pack(len(data))
+    out += data
+
+
+def _pack_int(out: bytearray, value: int):
+    if -2**63 <= value < 2**63:
+        out += _TAG_I64.pack(INT, value)
+    else:
+        data = value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True)
+        out += _TAG_U32.pack(BIGINT, len(data))
+        out += data
+
+
+def _pack_float(out: bytearray, value: float):
+    out += _TAG_F64.pack(FLOAT, value)
+
+
+def _pack_text(out: bytearray, value: str):
+    data = value.encode("utf-8")
+    out += _TAG_U32.pack(STR, len(data))
+    out += data
+
+
+def _pack_bytes(out: bytearray, value: bytes):
+    out += _TAG_U32.pack(BYTES, len(value))
+    out += value
+
+
+def _pack_bool(out: bytearray, value: bool):
+    out += _U8.pack(BOOL)
+    out += _U8.pack(value)
+
+
+def _pack_none(out: bytearray, value: None):
+    out += _U8.pack(NONE)
+
+
+# bool before int, so subclasses are matched by their closest supported type
+_PACKERS = {
+    bool: _pack_bool,
+    int: _pack_int,
+    float: _pack_float,
+    str: _pack_text,
+    bytes: _pack_bytes,
+    bytearray: _pack_bytes,
+    memoryview: _pack_bytes,
+    type(None): _pack_none,
+}
+
+
+def _pack_value(out: bytearray, value: Any):
+    packer = _PACKERS.get(type(value))
+    if packer is None:
+        packer = next((p for base, p in _PACKERS.items() if isinstance(value, base)), None)
+        if packer is None:
+            raise TypeError(f"Binary serializer does not support {type(value).__name__} values")
+    packer(out, value)
+
+
+def _unpack_str(data: memoryview, offset: int) -> Tuple[str, int]:
+    (size,) = _U16.unpack_from(data, offset)
+    offset += 2
+    return str(data[offset:offset + size], "utf-8"), offset + size
+
+
+def _unpack_value(data: memoryview, offset: int) -> Tuple[Any, int]:
+    (tag,) = _U8.unpack_from(data, offset)
+    offset += 1
+    if tag == NONE:
+        return None, offset
+    if tag == INT:
+        return _I64.unpack_from(data, offset)[0], offset + 8
+    if tag == FLOAT:
+        return _F64.unpack_from(data, offset)[0], offset + 8
+    if tag == BOOL:
+        return bool(data[offset]), offset + 1
+    (size,) = _U32.unpack_from(data, offset)
+    offset += 4
+    if offset + size > len(data):
+        raise ValueError("Truncated binary value")
+    raw = data[offset:offset + size]
+    if tag == STR:
+        return str(raw, "utf-8"), offset + size
+    if tag == BYTES:
+        return bytes(raw), offset + size
+    if tag == BIGINT:
+        return int.from_bytes(raw, "big", signed=True), offset + size
+    raise ValueError(f"Unknown binary value tag {tag}")
+
+
+def dumps(msg: Dict[str, Any]) -> bytes:
+    """Serialize a message dict (as given by Message.toPickle)."""
+    out = bytearray(_U8.pack(TYPE_CODES[msg["type"]]))
+    for field in FIELDS[msg["type"]]:
+        if field == "topic":
+            _pack_str(out, msg[field])
+        elif field == "lista":
+            out += _U32.pack(len(msg[field]))
+            for topic in msg[field]:
+                _pack_str(out, topic)
+        elif field == "pubs":
+            out += _U32.pack(len(msg[field]))
+            for topic, value in msg[field]:
+                _pack_str(out, topic)
+                _pack_value(out, value)
+        elif field == "stats":
+            _pack_text(out, json.dumps(msg[field]))     # nested, kept as JSON text
+        else:
+            _pack_value(out, msg.get(field))
+    return bytes(out)
+
+
+def loads(data: bytes) -> Dict[str, Any]:
+    """Deserialize a message dict."""
+    data = memoryview(data)
+    try:
+        msg_type = TYPES[data[0]]
+    except IndexError:
+        raise ValueError("Unknown binary message type")
+    msg = {"type": msg_type}
+    offset = 1
+    for field in FIELDS[msg_type]:
+        if field == "topic":
+            msg[field], offset = _unpack_str(data, offset)
+        elif field == "lista":
+            (count,) = _U32.unpack_from(data, offset)
+            offset += 4
+            msg[field] = []
+            for _ in range(count):
+                topic, offset = _unpack_str(data, offset)
+                msg[field].append(topic)
+        elif field == "pubs":
+            (count,) = _U32.unpack_from(data, offset)
+            offset += 4
+            msg[field] = []
+            for _ in range(count):
+                topic, offset = _unpack_str(data, offset)
+                value, offset = _unpack_value(data, offset)
+                msg[field].append((topic, value))
+        else:
+            msg[field], offset = _unpack_value(data, offset)
+    return msg
+
+
+def dump_value(value: Any) -> bytes:
+    """Serialize a single tagged value."""
+    out = bytearray()
+    _pack_value(out, value)
+    return bytes(out)
+
+
+def load_value(data, offset: int = 0) -> Tuple[Any, int]:
+    """Deserialize the tagged value at offset, returns (value, offset after it)."""
+    return _unpack_value(data, offset)
@@ -1,10 +1,22 @@
 """Message Broker"""
 import enum
-from typing import Dict, List, Any, Tuple
+from itertools import islice
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterator, List, Any, Optional, Tuple
 import socket
 import selectors
-
+import time
+
+from src.framing import MAX_FRAME, STREAM_THRESHOLD, FrameDecoder
+from src.commitlog import CommitLog
+from src.groups import ConsumerGroup
+from src.log import get_logger
+from src.metrics import TOP_CONNECTIONS, Metrics, http_response, peer
+from src.outbox import DROP_OLDEST, Outbox, Overflow
 from src.protocol import PubSubProtocol
+from src.topics import TopicTrie, is_pattern
+
+logger = get_logger("Broker")
 
 
 class Serializer(enum.Enum):
@@ -13,72 +25,388 @@ class Serializer(enum.Enum):
     JSON = 0
     XML = 1
     PICKLE = 2
+    BINARY = 3
+
+
+SNAPSHOT_BATCH = 256        # last values per snapshot frame
+REPLAY_BATCH = 256          # logged values queued at a time when replaying
+MAX_REQUEST = 8192          # bytes of the headers of a metrics request
 
 
 class Broker:
     """Implementation of a PubSub Message Broker."""
-    
-    def __init__(self):
-        """Initialize broker."""
+
+    reusePort = False           # let other processes listen on the same port
+
+    def __init__(self, host: str = "localhost", port: int = 5000, log: CommitLog = None, metrics_port: int = None,
+                 overflow: str = DROP_OLDEST, max_queued: int = 10000, max_queued_bytes: int = 2**24,
+                 max_frame: int = MAX_FRAME, **group_options):
+        """Initialize broker, restoring the topics of log if given.
+
+        With a metrics_port, metrics are served there in the Prometheus format.
+        Every connection gets an Outbox of max_queued frames and max_queued_bytes
+        bytes, handling a full queue by the overflow policy. A client announcing
+        a frame above max_frame bytes is disconnected.
+        group_options (strategy, ack_timeout, max_pending) are given to every ConsumerGroup.
+        """
         self.canceled = False
-        self._host = "localhost"
-        self._port = 5000
+        self._host = host
+        self._port = port
+        self.messages = {}          
+        self.topicIndex = []        # sorted topics with a value
+        self.serialTypes = {}       
+        self.decoders = {}
+        self.maxFrame = max_frame
+        self.versions = {}          # protocol version announced by each connection
+        self.outboxes = {}          # frames waiting for each connection to be writable
+        self.replays = {}           # conn -> (logged frames left to replay, Outbox of live frames held until then)
+        self.outboxOptions = {"policy": overflow, "max_messages": max_queued, "max_bytes": max_queued_bytes}
+        Outbox(**self.outboxOptions)    # fail early on an unknown policy
+        self.subscriptions = TopicTrie()
+        self.encodeStats = {serializer: {"encodes": 0, "hits": 0} for serializer in Serializer}
+        self.groups = {}            # (topic, group name) -> ConsumerGroup
+        self.groupOptions = group_options
+        self.metrics = Metrics()
+        self.metricsPort = metrics_port
+        self.scrapes = {}           # metrics request received so far, then the response left to send, per connection
+        self.log = log
+        if log is not None:
+            for topic, value in log.last_values().items():
+                self.createTopic(topic)
+                self.messages[topic] = value
+                if value is not None:
+                    insort(self.topicIndex, topic)
+        self.listen()
+
+    def listen(self):
+        """Bind the broker socket and register it in the selector."""
         self.broker = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  
+        self.broker.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reusePort:
+            self.broker.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.broker.bind((self._host, self._port))
         self.sel = selectors.DefaultSelector()
         self.broker.listen()
-        self.messages = {}          
-        self.serialTypes = {}       
-        self.subscriptions = {}    
         self.sel.register(self.broker, selectors.EVENT_READ, self.accept)
+        if self.metricsPort is not None:
+            self.metricsServer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.metricsServer.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.metricsServer.bind((self._host, self.metricsPort))
+            self.metricsServer.listen()
+            self.sel.register(self.metricsServer, selectors.EVENT_READ, self.acceptMetrics)
+
+    def acceptMetrics(self, server, mask):
+        """Accept a connection to the metrics endpoint."""
+        conn, addr = server.accept()
+        conn.setblocking(False)
+        self.scrapes[conn] = bytearray()
+        self.sel.register(conn, selectors.EVENT_READ, self.serveMetrics)
+
+    def serveMetrics(self, conn, mask):
+        """Read an HTTP request for the metrics, then write the response as conn takes it."""
+        try:
+            if mask & selectors.EVENT_READ:
+                request = self.scrapes[conn]
+                data = conn.recv(4096)
+                request += data
+                if len(request) > MAX_REQUEST:
+                    raise ConnectionError("metrics request too large")
+                if data and b"\r\n\r\n" not in request:
+                    return      # wait for the rest of the headers
+                self.scrapes[conn] = memoryview(http_response(bytes(request), self.stats))
+                self.sel.modify(conn, selectors.EVENT_WRITE, self.serveMetrics)
+            response = self.scrapes[conn]
+            self.scrapes[conn] = response = response[conn.send(response):]
+            if response:
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+        self.sel.unregister(conn)
+        del self.scrapes[conn]
+        conn.close()
 
     def accept(self, broker, mask):
         """Accept a connection and store it's serialization type."""
         conn, addr = broker.accept()  
+        conn.setblocking(False)
+        self.decoders[conn] = FrameDecoder(prefix=1, max_frame=self.maxFrame)
+        self.outboxes[conn] = Outbox(**self.outboxOptions)
         self.sel.register(conn, selectors.EVENT_READ, self.read)
 
+    def ready(self, conn, mask):
+        """Handle a connection waiting to be written to."""
+        if mask & selectors.EVENT_WRITE:
+            self.flush(conn)
+        if mask & selectors.EVENT_READ:
+            self.read(conn, mask)
+
     def read(self, conn, mask):
         """Handle further operations"""
 
-        data = PubSubProtocol.recv_msg(conn)
-        if data:
-            if data.type == "Sub":
-                self.subscribe(data.topic, conn, self.getSerial(conn))
-
-            elif data.type == "Pub":
-                topic = data.topic
-                message = data.value
-                self.put_topic(topic, message)
-
-                # Send message to subscribers of the topic, if any
-                if topic in self.subscriptions:
-                    subscribers = self.list_subscriptions(topic)
-                    for conn, serialType in subscribers:
-                        PubSubProtocol.sendMsg(conn, self.getSerial(conn), data)
+        # handle every complete frame received, a partial one waits for more data
+        decoder = self.decoders.get(conn)
+        if decoder is None:     # already disconnected while handling another event
+            return
+        decoder.feed_from(conn)
+        for codeSerial, frame in decoder.frames():
+            data = PubSubProtocol.decode(codeSerial[0], frame)
+            self.received(conn, codeSerial[0], frame, data)
+            if data:
+                self.handle(conn, data)
+            if conn not in self.decoders:   # disconnected while handling
+                return
+        if self.log is not None:
+            self.log.flush()
+
+        if decoder.rejected is not None:
+            logger.warning("Disconnecting %s: frame of %d bytes, the limit is %d", peer(conn), decoder.rejected, self.maxFrame)
+        if decoder.closed:
+            self.disconnect(conn)
+
+    def received(self, conn, codeSerial: int, frame: bytes, data):
+        """Count a frame received from conn in the metrics."""
+        self.metrics.received(conn, codeSerial, len(frame) + 3)
+        if data is None:
+            return
+        if data.type == "Pub":
+            self.metrics.published(data.topic, len(frame))
+        elif data.type == "PubBatch" and data.pubs:
+            size = len(frame) // len(data.pubs)
+            for topic, _ in data.pubs:
+                self.metrics.published(topic, size)
+
+    def handle(self, conn, data):
+        """Process a message received from conn."""
+
+        if data.type == "Sub" and data.group is not None:
+            self.join(data.topic, data.group, conn, self.getSerial(conn), data.prefetch or 1)
+
+        elif data.type == "Sub":
+            self.subscribe(data.topic, conn, self.getSerial(conn), data.offset, data.timestamp)
+
+        elif data.type == "Pub":
+            topic = data.topic
+            message = data.value
+            self.put_topic(topic, message)
+
+            # Send message to subscribers of the topic and its parent topics, if any
+            self.publish(data)
+
+        elif data.type == "PubBatch":
+            pubs = [PubSubProtocol.pub(topic, value) for topic, value in data.pubs]
+            for pub in pubs:
+                self.put_topic(pub.topic, pub.value)
+            self.publish(*pubs)
+
+        elif data.type == "TopicListReq":
+            self.send(conn, PubSubProtocol.topicListRep(self.list_topics(data.prefix or "", data.after, data.limit)))
+
+        elif data.type == "SnapshotReq":
+            self.snapshot(conn, data.topic)
+
+        elif data.type == "StatsReq":
+            self.send(conn, PubSubProtocol.statsRep(self.stats()))
+
+        elif data.type == "CancelSub":
+            self.unsubscribe(data.topic, conn)
+
+        elif data.type == "Ack" and data.id is not None:
+            self.acknowledgeDelivery(conn, data.id)
+
+        elif data.type == "Ack" or data["type"] == "Ack":
+            self.acknowledge(conn, data.lan)
+            self.versions[conn] = data.version or 1
+
+    def send(self, conn, msg):
+        """Send msg to conn, unless it is too large for the protocol version of conn."""
+        serialType = self.getSerial(conn)
+        try:
+            frame = PubSubProtocol.encode(serialType, msg, self.versions.get(conn, 1))
+        except OverflowError as err:
+            logger.warning("Not sent to %s: %s", peer(conn), err)
+            return
+        # values for consumer groups carry a delivery id, they are never conflated
+        topic = msg.topic if msg.type == "Pub" and msg.id is None else None
+        self.write(conn, serialType, [(topic, frame)])
+
+    def outbox(self, conn) -> Optional[Outbox]:
+        """Outbox of conn, given to a non-blocking socket the first time it is written to here."""
+        outbox = self.outboxes.get(conn)
+        if outbox is None and conn in self.serialTypes and isinstance(conn, socket.socket) and conn.gettimeout() == 0:
+            outbox = self.outboxes[conn] = Outbox(**self.outboxOptions)
+        return outbox
+
+    def write(self, conn, serialType, frames: List[Tuple[Optional[str], bytes]]):
+        """Queue encoded frames, with the topic of their value, and send what conn takes."""
+        outbox = self.outbox(conn)
+        if outbox is None:
+            # not accepted here (or disconnected), and blocking: written without a queue
+            if conn in self.serialTypes:
+                self.writeThrough(conn, serialType, frames)
+            return
+        replay = self.replays.get(conn)
+        queue = outbox if replay is None else replay[1]
+        try:
+            for topic, frame in frames:
+                queue.put(frame, topic)
+        except Overflow as err:
+            logger.warning("Disconnecting %s: %s", peer(conn), err)
+            self.disconnect(conn)
+            return
+        self.flush(conn)
+
+    def writeThrough(self, conn, serialType, frames: List[Tuple[Optional[str], bytes]]):
+        """Send encoded frames to conn right away, disconnecting it if the connection broke.
+
+        conn is a blocking socket, or a connection object taking whole frames
+        on send (like those of AsyncBroker).
+        """
+        data = frames[0][1] if len(frames) == 1 else b"".join(frame for _, frame in frames)
+        start = time.perf_counter()
+        try:
+            if len(data) > STREAM_THRESHOLD or isinstance(conn, socket.socket):
+                conn.sendall(data)
+            else:
+                conn.send(data)
+        except OSError:
+            self.disconnect(conn)
+            return
+        code = serialType.value if isinstance(serialType, Serializer) else int(serialType or 0)
+        self.metrics.sent(conn, code, len(data), len(frames), time.perf_counter() - start)
 
-                # Create a new empty list of subscribers if the topic doesn't have any yet
+    def flush(self, conn):
+        """Write the queued frames until conn would block, then wait for it to be writable."""
+        outbox = self.outboxes.get(conn)
+        if outbox is None:
+            return
+        serialType = self.serialTypes.get(conn)
+        code = serialType.value if isinstance(serialType, Serializer) else int(serialType or 0)
+        while True:
+            if not len(outbox) and conn in self.replays and not self.refill(conn, outbox):
+                return
+            if not outbox:
+                break
+            data, messages = outbox.take()
+            start = time.perf_counter()
+            try:
+                sent = conn.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.disconnect(conn)
+                return
+            if sent or messages:
+                self.metrics.sent(conn, code, sent, messages, time.perf_counter() - start)
+            outbox.sent(sent)
+            if sent < len(data):
+                break
+        # sockets not accepted here are only written to
+        events = selectors.EVENT_READ if conn in self.decoders else 0
+        if outbox:
+            events |= selectors.EVENT_WRITE
+        key = self.sel.get_map().get(conn)
+        if key is None:
+            if events:
+                self.sel.register(conn, events, self.ready)
+        elif not events:
+            self.sel.unregister(conn)
+        elif key.events != events:
+            self.sel.modify(conn, events, self.ready if outbox else self.read)
+
+    def publish(self, *msgs):
+        """Send msgs to their subscribers, encoding each at most once per serializer.
+
+        All frames for the same subscriber are sent together. Frames over 64 KiB
+        are only sent to subscribers using protocol version 2.
+        """
+        pending = {}
+        groups = set()
+        for msg in msgs:
+            frames = {}
+            subscribers = self.subscriptions.match(msg.topic)
+            for group in subscribers:
+                if isinstance(group, ConsumerGroup):
+                    group.enqueue(msg)
+                    groups.add(group)
+            for subscriber, serialType in self.list_subscriptions(msg.topic, subscribers):
+                frame = frames.get(serialType)
+                if frame is None:
+                    frame = frames[serialType] = PubSubProtocol.encode(serialType, msg)
+                    self.encodeStats[serialType]["encodes"] += 1
                 else:
-                    self.subscriptions[topic] = []
-
+                    self.encodeStats[serialType]["hits"] += 1
+                if PubSubProtocol.is_extended(frame) and self.versions.get(subscriber, 1) < 2:
+                    continue
+                pending.setdefault(subscriber, []).append((msg.topic, frame))
 
-            elif data.type == "TopicListReq":
-                PubSubProtocol.sendMsg(conn, self.serialType, PubSubProtocol.topicListRep(self.list_topics()))
+        for subscriber, frames in pending.items():
+            self.write(subscriber, self.serialTypes.get(subscriber), frames)
 
-            elif data.type == "CancelSub":
-                self.unsubscribe(data.topic, conn)
+        for group in groups:
+            self.dispatch(group)
 
-            elif data.type == "Ack" or data["type"] == "Ack":
-                self.acknowledge(conn, data.lan)
+    def dispatch(self, group: ConsumerGroup):
+        """Send the messages of group its members have room for."""
+        for conn, delivery, msg in group.dispatch():
+            self.send(conn, PubSubProtocol.pub(msg.topic, msg.value, delivery))
 
-        else:
-            self.unsubscribe("", conn)
+    def join(self, topic: str, name: str, conn, _format: Serializer = None, prefetch: int = 1):
+        """Add conn to the consumer group name of topic."""
+        if conn not in self.serialTypes:
+            self.acknowledge(conn, _format)
+        group = self.groups.get((topic, name))
+        if group is None:
+            group = self.groups[(topic, name)] = ConsumerGroup(name, topic, **self.groupOptions)
+            self.subscriptions.subscribe(topic, group)
+            if not is_pattern(topic) and topic not in self.messages:
+                self.createTopic(topic)
+        group.add(conn, prefetch)
+        self.dispatch(group)
+
+    def acknowledgeDelivery(self, conn, delivery: int):
+        """Acknowledge a consumer group delivery, freeing a slot in the prefetch window of conn."""
+        for group in self.groups.values():
+            if group.ack(conn, delivery):
+                self.dispatch(group)
+                return
+
+    def expire(self):
+        """Redeliver the consumer group messages past their ack timeout."""
+        for group in list(self.groups.values()):
+            if group.in_flight:
+                group.expire()
+                self.dispatch(group)
+
+    def disconnect(self, conn):
+        """Forget a closed connection."""
+        self.unsubscribe("", conn)
+        self.serialTypes.pop(conn, None)
+        self.versions.pop(conn, None)
+        self.metrics.forget(conn)
+        self.outboxes.pop(conn, None)
+        self.replays.pop(conn, None)
+        self.decoders.pop(conn, None)
+        if conn in self.sel.get_map():
             self.sel.unregister(conn)
-            conn.close()
+        conn.close()
 
-    def list_topics(self) -> List[str]:
-        """Returns a list of strings containing all topics containing values."""
+    def list_topics(self, prefix: str = "", after: str = None, limit: int = None) -> List[str]:
+        """Returns the sorted topics containing values that start with prefix.
 
-        return [topic for topic in self.messages.keys() if self.messages[topic] is not None]
+        With after and limit, returns the page of up to limit topics following after.
+        """
+        start = bisect_left(self.topicIndex, prefix)
+        if after is not None:
+            start = max(start, bisect_right(self.topicIndex, after))
+        end = len(self.topicIndex)
+        if prefix:
+            # first string after every topic starting with prefix
+            end = bisect_left(self.topicIndex, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        if limit is not None:
+            end = min(end, start + max(limit, 0))
+        return self.topicIndex[start:end]
 
 
     def get_topic(self, topic):
@@ -92,53 +420,151 @@ class Broker:
         if topic not in self.messages.keys():
             self.createTopic(topic)
 
+        if (self.messages[topic] is None) != (value is None):
+            if value is None:
+                del self.topicIndex[bisect_left(self.topicIndex, topic)]
+            else:
+                insort(self.topicIndex, topic)
         self.messages[topic] = value
+        if self.log is not None:
+            try:
+                self.log.append(topic, value)
+            except (TypeError, OSError) as err:
+                logger.warning("Not logged on %s: %s", topic, err)
 
-    def list_subscriptions(self, topic: str) -> List[Tuple[socket.socket, Serializer]]:
-        """Provide list of subscribers to a given topic."""
+    def list_subscriptions(self, topic: str, subscribers: List = None) -> List[Tuple[socket.socket, Serializer]]:
+        """Provide list of subscribers to a given topic (consumer groups aside)."""
+        if subscribers is None:
+            subscribers = self.subscriptions.match(topic)
+        return [(conn, self.serialTypes[conn]) for conn in subscribers if not isinstance(conn, ConsumerGroup)]
 
-        return [(conn, self.serialTypes[conn]) for conn in self.subscriptions[topic]]
 
+    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None, offset: int = None, timestamp: float = None):
+        """Subscribe to topic by client in address.
 
-    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None):
-        """Subscribe to topic by client in address."""
+        With an offset or timestamp, the logged values of the topic are replayed
+        instead of sending the last one.
+        """
         conn = address
         codeSerial = _format
 
         if conn not in self.serialTypes:
             self.acknowledge(conn, codeSerial)
 
-        if topic in self.messages.keys():               
-            if topic not in self.subscriptions:
-                self.createTopic(topic)
+        self.subscriptions.subscribe(topic, conn)
 
-            if conn not in self.subscriptions[topic]:
-                self.subscriptions[topic].append(conn)
+        if self.log is not None and (offset is not None or timestamp is not None):
+            self.replay(conn, topic, offset, timestamp)
+            if not is_pattern(topic) and topic not in self.messages:
+                self.createTopic(topic)
 
-            if topic in self.messages and self.messages[topic] is not None:
-                PubSubProtocol.sendMsg(conn, self.getSerial(conn), PubSubProtocol.pub(topic, self.messages[topic]))
-            return
+        # wildcard subscriptions get the last value of every matching topic
+        elif is_pattern(topic):
+            for t in self.subscriptions.topics(topic):
+                if self.messages[t] is not None:
+                    self.send(conn, PubSubProtocol.pub(t, self.messages[t]))
 
-        else:
-            self.put_topic(topic, None)
-            self.subscribe(topic, conn, codeSerial)
+        elif topic not in self.messages:
+            self.createTopic(topic)
 
+        elif self.messages[topic] is not None:
+            self.send(conn, PubSubProtocol.pub(topic, self.messages[topic]))
+
+
+    def snapshot(self, conn, topic: str):
+        """Send conn the last values of topic and its subtopics, SNAPSHOT_BATCH values per frame."""
+        serialType = self.getSerial(conn)
+        version = self.versions.get(conn, 1)
+        pubs = [(t, self.messages[t]) for t in self.subscriptions.topics(topic) if self.messages[t] is not None]
+        frames = []
+        for start in range(0, len(pubs), SNAPSHOT_BATCH):
+            batch = pubs[start:start + SNAPSHOT_BATCH]
+            frames.extend(self.encodeSnapshot(serialType, batch, start + SNAPSHOT_BATCH >= len(pubs), version))
+        if not pubs:
+            frames.append(PubSubProtocol.encode(serialType, PubSubProtocol.snapshotRep([]), version))
+        self.write(conn, serialType, [(None, frame) for frame in frames])
+
+    def encodeSnapshot(self, serialType, pubs, last: bool, version: int) -> List[bytes]:
+        """Encode a snapshot batch, split in smaller frames if it is too large for version."""
+        try:
+            return [PubSubProtocol.encode(serialType, PubSubProtocol.snapshotRep(pubs, last), version)]
+        except OverflowError:
+            if len(pubs) == 1:
+                logger.warning("Not in the snapshot: %s", pubs[0][0])
+                return [PubSubProtocol.encode(serialType, PubSubProtocol.snapshotRep([], last), version)]
+            half = len(pubs) // 2
+            return (self.encodeSnapshot(serialType, pubs[:half], False, version)
+                    + self.encodeSnapshot(serialType, pubs[half:], last, version))
+
+    def replay(self, conn, topic: str, offset: int = None, timestamp: float = None):
+        """Send conn the logged values of topic and its subtopics, from offset or timestamp on.
+
+        The values are queued REPLAY_BATCH at a time, each batch once conn took
+        the previous one; values published meanwhile are held until the replay
+        ends (under the overflow policy of conn), so they come after it.
+        """
+        frames = self.logFrames(conn, topic, offset, timestamp)
+        outbox = self.outbox(conn)
+        if outbox is None:
+            # not accepted here, written without a queue
+            self.sendLog(conn, frames)
+            return
+        self.replays[conn] = (frames, Outbox(**self.outboxOptions))
+        self.flush(conn)
+
+    def logFrames(self, conn, topic: str, offset: int = None, timestamp: float = None) -> Iterator[bytes]:
+        """Encode the logged values of topic and its subtopics for conn, up to the values logged by now."""
+        serialType = self.getSerial(conn)
+        version = self.versions.get(conn, 1)
+        ends = {t: self.log.next_offset(t) for t in self.subscriptions.topics(topic)}
+
+        def frames():
+            for t, end in ends.items():
+                for _, _, value in self.log.read(t, offset, timestamp, end):
+                    try:
+                        yield PubSubProtocol.encode(serialType, PubSubProtocol.pub(t, value), version)
+                    except OverflowError as err:
+                        logger.warning("Not sent to %s: %s", peer(conn), err)
+        return frames()
+
+    def refill(self, conn, outbox: Outbox) -> bool:
+        """Queue the next batch of the replay to conn, then the held frames once it is over.
+
+        A batch stops short when outbox is full, so the overflow policy never
+        drops replayed values. Returns False if conn had to be disconnected.
+        """
+        frames, held = self.replays[conn]
+        for frame in frames:
+            outbox.put(frame)
+            if len(outbox) >= REPLAY_BATCH or outbox.full:
+                return True
+        del self.replays[conn]
+        outbox.dropped += held.dropped
+        try:
+            for topic, frame, _ in held.queue:
+                outbox.put(frame, topic)
+        except Overflow as err:
+            logger.warning("Disconnecting %s: %s", peer(conn), err)
+            self.disconnect(conn)
+            return False
+        return True
+
+    def sendLog(self, conn, frames: Iterator[bytes]):
+        """Write logged frames to conn, in batches of REPLAY_BATCH."""
+        serialType = self.getSerial(conn)
+        batch = list(islice(frames, REPLAY_BATCH))
+        while batch:
+            self.write(conn, serialType, [(None, frame) for frame in batch])
+            batch = list(islice(frames, REPLAY_BATCH))
 
     def unsubscribe(self, topic, address):
         """Unsubscribe to topic by client in address."""
-        conn = address
-
-        # unsub from specific topic and all subtopics
-        if topic != "":
-            subtopics = [t for t in self.messages.keys() if t.startswith(topic)]
-            for t in subtopics:
-                self.subscriptions[t] = [c for c in self.subscriptions[t] if c != conn]
-
-        # unsub from all topics
-        else:
-            for t in self.messages.keys():
-                if conn in self.subscriptions[t]:
-                    self.subscriptions[t] = [c for c in self.subscriptions[t] if c != conn]
+        # unsub from specific topic and all subtopics ("" unsubs from all topics)
+        self.subscriptions.unsubscribe(topic, address)
+        for (groupTopic, _), group in self.groups.items():
+            if address in group.members and (groupTopic + "/").startswith(topic + "/" if topic else ""):
+                group.remove(address)
+                self.dispatch(group)
 
 
     def acknowledge(self, conn, codeSerial):
@@ -152,6 +578,9 @@ class Broker:
         def set_pickle():
             self.serialTypes[conn] = Serializer.PICKLE
 
+        def set_binary():
+            self.serialTypes[conn] = Serializer.BINARY
+
         switch = {
             0: set_json,
             Serializer.JSON: set_json,
@@ -160,21 +589,66 @@ class Broker:
             Serializer.XML: set_xml,
             2: set_pickle,
             Serializer.PICKLE: set_pickle,
+            3: set_binary,
+            Serializer.BINARY: set_binary,
         }
         switch.get(codeSerial, set_json)()
 
     def createTopic(self, topic):
-        self.messages[topic] = None  
-        self.subscriptions[topic] = []
-
-        i = 0
-        while i < len(self.messages.keys()):
-            t = list(self.messages.keys())[i]
-            if topic.startswith(t):
-                for consumer in self.subscriptions[t]:
-                    if consumer not in self.subscriptions[topic]:
-                        self.subscriptions[topic].append(consumer)
-            i += 1
+        """Create an empty topic; subscribers of parent topics are found through the trie."""
+        self.messages[topic] = None
+        self.subscriptions.add_topic(topic)
+
+    def buffered(self) -> Dict[Any, int]:
+        """Bytes received but not handled yet, for each connection."""
+        return {conn: len(decoder) for conn, decoder in list(self.decoders.items())}
+
+    def queues(self) -> List[Dict[str, Any]]:
+        """Outgoing queues of the connections lagging the most (or that dropped values)."""
+        outboxes = [(conn, outbox) for conn, outbox in list(self.outboxes.items()) if outbox or outbox.dropped]
+        outboxes.sort(key=lambda item: (item[1].lag(), item[1].bytes), reverse=True)
+        return [dict(peer=peer(conn), **outbox.snapshot()) for conn, outbox in outboxes[:TOP_CONNECTIONS]]
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of the broker load."""
+        metrics = self.metrics
+        buffered = self.buffered()
+        return {
+            "connections": len(buffered),
+            "serializers": {
+                serializer.name.lower(): {
+                    "messages_in": metrics.messages_in.get(serializer.value, 0),
+                    "bytes_in": metrics.bytes_in.get(serializer.value, 0),
+                    "messages_out": metrics.messages_out.get(serializer.value, 0),
+                    "bytes_out": metrics.bytes_out.get(serializer.value, 0),
+                    "encodes": self.encodeStats[serializer]["encodes"],
+                    "encode_hits": self.encodeStats[serializer]["hits"],
+                }
+                for serializer in Serializer
+            },
+            "topics": {
+                topic: {
+                    "subscribers": len(self.subscriptions.match(topic)),
+                    "messages": metrics.topic_messages.get(topic, 0),
+                    "bytes": metrics.topic_bytes.get(topic, 0),
+                }
+                for topic in list(self.messages)
+            },
+            "busiest_connections": metrics.connections(buffered),
+            "queues": self.queues(),
+            "groups": {
+                f"{topic} {name}": {
+                    "members": len(group.members),
+                    "pending": len(group.pending),
+                    "in_flight": len(group.in_flight),
+                    "dropped": group.dropped,
+                }
+                for (topic, name), group in list(self.groups.items())
+            },
+            "select_seconds": metrics.select_seconds,
+            "read_seconds": metrics.read_seconds.snapshot(),
+            "send_seconds": metrics.send_seconds.snapshot(),
+        }
 
     def getSerial(self, conn):
         return self.serialTypes[conn] if conn in self.serialTypes else None
@@ -183,10 +657,14 @@ class Broker:
         """Run until canceled."""
         while not self.canceled:
             try:
-                events = self.sel.select()
+                start = time.perf_counter()
+                events = self.sel.select(timeout=1 if self.groups else None)
+                selected = time.perf_counter()
                 for key, mask in events:
                     callback = key.data
                     callback(key.fileobj, mask)
+                self.expire()
+                self.metrics.loop(selected - start, time.perf_counter() - selected)
             except KeyboardInterrupt:
                 print("Caught keyboard interrupt, exiting")
                 self.sock.close()
@@ -6,19 +6,28 @@ from src.middleware import PickleQueue, MiddlewareType
 class Consumer:
     """Consumer implementation"""
 
-    def __init__(self, topic, queue_type=PickleQueue):
-        """Initialize Queue"""
+    def __init__(self, topic, queue_type=PickleQueue, group=None):
+        """Initialize Queue, sharing the topic messages with the rest of group if given."""
         self.topic = topic
-        self.queue = queue_type(f"{topic}", _type=MiddlewareType.CONSUMER)
+        self.queue = queue_type(f"{topic}", _type=MiddlewareType.CONSUMER, group=group)
         self.logger = get_logger(f"Consumer {topic}")
         self.received = []
 
-    def run(self, events=10):
-        """Consume at most <events> events."""
+    def run(self, events=10, workers=1):
+        """Consume at most <events> events, on <workers> threads."""
+        if workers > 1:
+            self.queue.consume(self.handle, workers, events)
+            return
         for _ in range(events):
-            topic, data = self.queue.pull()
-            self.logger.info("%s: %s", topic, data)
-            self.received.append(data)
+            event = self.queue.pull()
+            if event is None:       # the broker closed the connection
+                break
+            self.handle(*event)
+
+    def handle(self, topic, data):
+        """Process an event."""
+        self.logger.info("%s: %s", topic, data)
+        self.received.append(data)
 
 
 class Producer:
@@ -38,11 +47,20 @@ class Producer:
         self.produced = []
         self.gen = value_generator
 
-    def run(self, events=10):
-        """Produce at most <events> events."""
-        for _ in range(events):
-            for queue, value in zip(self.queue, self.gen()):
-                queue.push(value)
+    def run(self, events=10, batch=1):
+        """Produce at most <events> events, sent <batch> events at a time."""
+        pending = [[] for _ in self.queue]
+        for i in range(events):
+            for queue, values, value in zip(self.queue, pending, self.gen()):
+                if batch == 1:
+                    queue.push(value)
+                else:
+                    values.append(value)
                 self.logger.info("%s: %s", queue.topic, value)
 
                 self.produced.append(value)
+
+            if batch > 1 and ((i + 1) % batch == 0 or i + 1 == events):
+                for queue, values in zip(self.queue, pending):
+                    queue.push_many(values)
+                    values.clear()
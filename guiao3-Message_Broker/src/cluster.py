@@ -0,0 +1,366 @@
+"""Multi-process broker: workers accept on the same port (SO_REUSEPORT).
+
+Every topic is ordered by one worker, picked by a hash of the topic. A worker
+forwards the values published on topics it doesn't order to their worker,
+which delivers them to its subscribers and broadcasts them to every other
+worker, over Unix sockets. Each worker so gets the values of a topic from a
+single stream, in the same order.
+
+Every consumer group is served by one worker too, picked by a hash of its
+topic and name. Its members connected to other workers join it, get its
+messages and acknowledge them through the worker they are connected to.
+"""
+import multiprocessing
+import os
+import pickle
+import selectors
+import shutil
+import socket
+import tempfile
+import zlib
+from typing import Any, Dict, List, Tuple
+
+from src.broker import Broker
+from src.framing import FrameDecoder, frame_header
+from src.outbox import Outbox, Overflow
+from src.protocol import PubSubProtocol
+
+INTERCONNECT = 2            # serializer between workers: Pickle, any value goes
+GROUPS = 255                # code of the frames with consumer group requests between workers
+
+
+class PeerLink:
+    """Non-blocking connection to another worker with an outgoing queue.
+
+    Workers never block writing to each other, two workers writing to each
+    other at once would deadlock. The frames wait in an Outbox (see
+    outbox_options), so a worker that stops reading can't grow it without
+    bound: past its limits the overflow policy drops frames, and disconnect,
+    as a worker can't leave the others, drops the new frame. Consumer group
+    deliveries lost this way are redelivered after their ack timeout.
+    """
+
+    def __init__(self, sock: socket.socket, sel: selectors.BaseSelector, **outbox_options):
+        self.sock = sock
+        self.sel = sel
+        self.pending = []           # (topic, value) to send on the next flush
+        self.requests = []          # consumer group requests to send on the next flush
+        self.outbox = Outbox(**outbox_options)
+        self._writing = False       # registered for EVENT_WRITE
+        sock.setblocking(False)
+
+    def flush(self):
+        """Send the pending values in one frame, and the consumer group requests in another."""
+        if self.pending:
+            self.put(PubSubProtocol.encode(INTERCONNECT, PubSubProtocol.pubBatch(self.pending)))
+            self.pending = []
+        if self.requests:
+            data = pickle.dumps(self.requests)
+            self.put(GROUPS.to_bytes(1, "big") + frame_header(len(data)) + data)
+            self.requests = []
+        self.write()
+
+    def put(self, frame: bytes):
+        """Queue a frame, as the overflow policy allows."""
+        try:
+            self.outbox.put(frame)
+        except Overflow:
+            self.outbox.dropped += 1
+
+    def write(self, sock=None, mask=None):
+        """Write as much of the queue as the socket takes, wait to be writable for the rest."""
+        while self.outbox:
+            data, _ = self.outbox.take()
+            try:
+                sent = self.sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            self.outbox.sent(sent)
+            if sent < len(data):
+                break
+        if self.outbox and not self._writing:
+            self.sel.register(self.sock, selectors.EVENT_WRITE, self.write)
+            self._writing = True
+        elif not self.outbox and self._writing:
+            self.sel.unregister(self.sock)
+            self._writing = False
+
+
+class RemoteMember:
+    """Member of a consumer group connected to another worker."""
+
+    __slots__ = ("worker", "id")
+
+    def __init__(self, worker: int, id: int):
+        self.worker = worker
+        self.id = id
+
+    def __repr__(self):
+        return f"RemoteMember({self.worker}, {self.id})"
+
+
+class WorkerBroker(Broker):
+    """Broker worker, routing publishes through the other workers.
+
+    paths are the Unix socket paths of all workers, peerServer the listening
+    socket at paths[index].
+    """
+
+    reusePort = True
+
+    def __init__(self, index: int, paths: List[str], peerServer: socket.socket, host: str = "localhost",
+                 port: int = 5000, **options):
+        self.index = index
+        self.paths = paths
+        self.peerServer = peerServer
+        self.peerDecoders = {}
+        self.remoteMembers = {}     # (worker, id) -> RemoteMember in the groups served here
+        self.groupClients = {}      # conn -> (id, {(topic, group name): worker serving it})
+        self.groupClientIds = {}    # id -> conn, of the clients in groups served elsewhere
+        self._nextClient = 1
+        super().__init__(host, port, **options)
+        self.links = {}
+        for peer, path in enumerate(paths):
+            if peer != index:
+                link = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                link.connect(path)
+                self.links[peer] = PeerLink(link, self.sel, **self.outboxOptions)
+
+    def listen(self):
+        """Bind the broker socket, shared with the other workers, and accept the workers."""
+        super().listen()
+        self.sel.register(self.peerServer, selectors.EVENT_READ, self.acceptPeer)
+
+    def acceptPeer(self, server, mask):
+        conn, _ = server.accept()
+        self.peerDecoders[conn] = FrameDecoder(prefix=1, max_frame=None)     # batches of the other workers
+        self.sel.register(conn, selectors.EVENT_READ, self.readPeer)
+
+    def owner(self, topic: str) -> int:
+        """Worker ordering the values published on topic."""
+        return zlib.crc32(topic.encode("utf-8")) % len(self.paths)
+
+    def groupOwner(self, topic: str, name: str) -> int:
+        """Worker serving the consumer group name of topic."""
+        return zlib.crc32(f"{topic}\0{name}".encode("utf-8")) % len(self.paths)
+
+    def read(self, conn, mask):
+        super().read(conn, mask)
+        self.flushPeers()
+
+    def handle(self, conn, data):
+        """Process a message received from a client, publishes are routed."""
+        if data.type == "Pub":
+            self.route([(data.topic, data.value)])
+        elif data.type == "PubBatch":
+            self.route(data.pubs)
+        elif data.type == "Sub" and data.group is not None and self.groupOwner(data.topic, data.group) != self.index:
+            self.joinRemote(data.topic, data.group, conn, data.prefetch or 1)
+        else:
+            if data.type == "Ack" and data.id is not None and conn in self.groupClients:
+                clientId, groups = self.groupClients[conn]
+                for worker in set(groups.values()):
+                    self.links[worker].requests.append(("ack", self.index, clientId, data.id))
+            super().handle(conn, data)
+
+    def route(self, pubs: List[Tuple[str, Any]]):
+        """Deliver the values this worker orders, forward the others to their worker."""
+        ordered = []
+        for topic, value in pubs:
+            owner = self.owner(topic)
+            if owner == self.index:
+                ordered.append((topic, value))
+            else:
+                self.links[owner].pending.append((topic, value))
+        self.deliver(ordered, broadcast=True)
+
+    def deliver(self, pubs: List[Tuple[str, Any]], broadcast: bool):
+        """Store and publish values here, and send them to the other workers if broadcast."""
+        if not pubs:
+            return
+        msgs = [PubSubProtocol.pub(topic, value) for topic, value in pubs]
+        for msg in msgs:
+            self.put_topic(msg.topic, msg.value)
+        self.publish(*msgs)
+        if broadcast:
+            for link in self.links.values():
+                link.pending.extend(pubs)
+
+    def readPeer(self, conn, mask):
+        """Handle values sent by another worker: forwarded to order, or broadcast."""
+        decoder = self.peerDecoders[conn]
+        decoder.feed_from(conn)
+        for codeSerial, frame in decoder.frames():
+            if codeSerial[0] == GROUPS:
+                for request in pickle.loads(frame):
+                    self.groupRequest(*request)
+                continue
+            data = PubSubProtocol.decode(codeSerial[0], frame)
+            run, ordering = [], None
+            for topic, value in data.pubs:
+                mine = self.owner(topic) == self.index
+                if mine != ordering and run:
+                    self.deliver(run, broadcast=ordering)
+                    run = []
+                run.append((topic, value))
+                ordering = mine
+            self.deliver(run, broadcast=bool(ordering))
+        self.flushPeers()
+
+        if decoder.closed:
+            self.sel.unregister(conn)
+            self.peerDecoders.pop(conn)
+            conn.close()
+
+    def flushPeers(self):
+        """Send the values routed while handling the last event."""
+        for link in self.links.values():
+            link.flush()
+
+    def joinRemote(self, topic: str, name: str, conn, prefetch: int):
+        """Add conn to the consumer group name of topic, served by another worker."""
+        if conn not in self.serialTypes:
+            self.acknowledge(conn, self.getSerial(conn))
+        client = self.groupClients.get(conn)
+        if client is None:
+            client = self.groupClients[conn] = (self._nextClient, {})
+            self.groupClientIds[self._nextClient] = conn
+            self._nextClient += 1
+        clientId, groups = client
+        worker = groups[(topic, name)] = self.groupOwner(topic, name)
+        self.links[worker].requests.append(("join", self.index, clientId, topic, name, prefetch))
+
+    def groupRequest(self, kind: str, *args):
+        """Handle a consumer group request of another worker.
+
+        The worker serving a group gets the joins, leaves and acks of its remote
+        members, the worker they are connected to their deliveries.
+        """
+        if kind == "deliver":
+            clientId, topic, value, delivery = args
+            conn = self.groupClientIds.get(clientId)
+            if conn is not None:
+                super().send(conn, PubSubProtocol.pub(topic, value, delivery))
+            return
+
+        member = self.remoteMembers.get(args[:2])
+        if kind == "join":
+            topic, name, prefetch = args[2:]
+            if member is None:
+                member = self.remoteMembers[args[:2]] = RemoteMember(*args[:2])
+            self.join(topic, name, member, None, prefetch)
+        elif member is None:
+            return
+        elif kind == "ack":
+            self.acknowledgeDelivery(member, args[2])
+        elif kind == "leave":
+            group = self.groups.get(args[2:])
+            if group is not None:
+                group.remove(member)
+                self.dispatch(group)
+            if not any(member in group.members for group in self.groups.values()):
+                del self.remoteMembers[args[:2]]
+                self.serialTypes.pop(member, None)
+
+    def send(self, conn, msg):
+        """Send msg to conn, through its worker for a remote member."""
+        if isinstance(conn, RemoteMember):
+            self.links[conn.worker].requests.append(("deliver", conn.id, msg.topic, msg.value, msg.id))
+        else:
+            super().send(conn, msg)
+
+    def unsubscribe(self, topic, address):
+        """Unsubscribe address, leaving the consumer groups of topic served elsewhere."""
+        super().unsubscribe(topic, address)
+        client = self.groupClients.get(address)
+        if client is None:
+            return
+        clientId, groups = client
+        for (groupTopic, name), worker in list(groups.items()):
+            if (groupTopic + "/").startswith(topic + "/" if topic else ""):
+                del groups[(groupTopic, name)]
+                self.links[worker].requests.append(("leave", self.index, clientId, groupTopic, name))
+        if not groups:
+            del self.groupClients[address]
+            del self.groupClientIds[clientId]
+
+    def expire(self):
+        """Redeliver the consumer group messages past their ack timeout, to remote members too."""
+        super().expire()
+        self.flushPeers()
+
+    def queues(self) -> List[Dict[str, Any]]:
+        """Outgoing queues of the connections lagging the most, then those of the links to other workers."""
+        links = [dict(peer=f"worker {worker}", **link.outbox.snapshot())
+                 for worker, link in self.links.items() if link.outbox or link.outbox.dropped]
+        return super().queues() + links
+
+
+def _work(index: int, paths: List[str], peerServer: socket.socket, host: str, port: int, options: dict):
+    """Run worker index until the process is terminated."""
+    metrics_port = options.pop("metrics_port", None)
+    if metrics_port is not None:
+        options["metrics_port"] = metrics_port + index
+    WorkerBroker(index, paths, peerServer, host, port, **options).run()
+
+
+class Cluster:
+    """Broker running on several worker processes, sharing host and port.
+
+    options are given to every WorkerBroker; worker i serves its metrics on
+    metrics_port + i.
+    """
+
+    def __init__(self, workers: int = os.cpu_count(), host: str = "localhost", port: int = 5000, **options):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.options = options
+        self.processes = []
+        self.directory = None
+
+    def start(self):
+        """Start the workers."""
+        self.directory = tempfile.mkdtemp(prefix="broker-")
+        paths = [os.path.join(self.directory, f"worker-{i}.sock") for i in range(self.workers)]
+        servers = []
+        for path in paths:
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen()
+            servers.append(server)
+
+        # forked, so every worker inherits its listening socket (already accepting)
+        context = multiprocessing.get_context("fork")
+        for index, server in enumerate(servers):
+            process = context.Process(
+                target=_work,
+                args=(index, paths, server, self.host, self.port, dict(self.options)),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        for server in servers:
+            server.close()
+        return self
+
+    def stop(self):
+        """Stop the workers."""
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def run(self):
+        """Run until interrupted."""
+        self.start()
+        try:
+            for process in self.processes:
+                process.join()
+        except KeyboardInterrupt:
+            print("Caught keyboard interrupt, exiting")
+        finally:
+            self.stop()
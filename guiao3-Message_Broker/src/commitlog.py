@@ -0,0 +1,341 @@
+"""Durable append-only log of the values published on each topic.
+
+Every topic has a directory of segments. A segment is a pair of files named
+after the offset of its first record: the .log file holds the records,
+
+    <offset u64><timestamp f64><size u32><value>
+
+with the value tagged like the binary serializer does, and the .index file
+holds a (position u32, timestamp f64) entry per record, so a record is found
+by offset in O(1) and by timestamp with a binary search. Appends go through
+buffered files and reads mmap the segment. Files and mmaps are only open for
+the max_open topics of the CommitLog used last.
+"""
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+from src import binary
+
+_RECORD = struct.Struct(">QdI")     # offset, timestamp, value size
+_ENTRY = struct.Struct(">Id")       # position in the .log file, timestamp
+
+TOPIC_PREFIX = "topic-"
+
+
+class Segment:
+    """Records of a topic starting at offset base."""
+
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        self.path = os.path.join(directory, f"{base:020d}")
+        self._recover()
+        self._log = self._index = None     # opened by the first append
+        self._dirty = False
+        self._maps = None           # (log mmap, index mmap, mapped log size)
+
+    def _recover(self):
+        """Drop a record left half written, if the broker stopped while appending."""
+        for suffix in (".log", ".index"):
+            open(self.path + suffix, "ab").close()
+        size = os.path.getsize(self.path + ".log")
+        count = os.path.getsize(self.path + ".index") // _ENTRY.size
+        end = 0
+        with open(self.path + ".log", "rb") as log, open(self.path + ".index", "rb") as index:
+            while count:
+                index.seek((count - 1) * _ENTRY.size)
+                position, _ = _ENTRY.unpack(index.read(_ENTRY.size))
+                log.seek(position)
+                head = log.read(_RECORD.size)
+                if len(head) == _RECORD.size and position + _RECORD.size + _RECORD.unpack(head)[2] <= size:
+                    end = position + _RECORD.size + _RECORD.unpack(head)[2]
+                    break
+                count -= 1
+        self.count = count
+        self.size = end
+        if end != size:
+            os.truncate(self.path + ".log", end)
+        os.truncate(self.path + ".index", count * _ENTRY.size)
+
+    @property
+    def next_offset(self) -> int:
+        return self.base + self.count
+
+    def append(self, timestamp: float, value: bytes):
+        """Append an encoded value."""
+        if self._log is None:
+            self._log = open(self.path + ".log", "ab")
+            self._index = open(self.path + ".index", "ab")
+        self._log.write(_RECORD.pack(self.next_offset, timestamp, len(value)))
+        self._log.write(value)
+        self._index.write(_ENTRY.pack(self.size, timestamp))
+        self.size += _RECORD.size + len(value)
+        self.count += 1
+        self._dirty = True
+
+    def flush(self):
+        """Hand the buffered appends to the OS."""
+        if self._dirty:
+            self._log.flush()
+            self._index.flush()
+            self._dirty = False
+
+    def _mapped(self) -> Tuple[mmap.mmap, mmap.mmap]:
+        """mmaps of the .log and .index files, remapped when they grew."""
+        self.flush()
+        if self._maps is None or self._maps[2] != self.size:
+            with open(self.path + ".log", "rb") as log, open(self.path + ".index", "rb") as index:
+                self._maps = (
+                    mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ),
+                    mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ),
+                    self.size,
+                )
+        return self._maps[0], self._maps[1]
+
+    def timestamp(self, i: int) -> float:
+        """Timestamp of the i-th record."""
+        return _ENTRY.unpack_from(self._mapped()[1], i * _ENTRY.size)[1]
+
+    def find(self, timestamp: float) -> int:
+        """Index of the first record appended at or after timestamp."""
+        _, index = self._mapped()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if _ENTRY.unpack_from(index, middle * _ENTRY.size)[1] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def records(self, start: int = 0) -> Iterator[Tuple[int, float, bytes]]:
+        """Yield (offset, timestamp, encoded value) from the start-th record on."""
+        if start >= self.count:
+            return
+        log, index = self._mapped()
+        count = self.count
+        position = _ENTRY.unpack_from(index, start * _ENTRY.size)[0]
+        view = memoryview(log)
+        try:
+            for _ in range(start, count):
+                offset, timestamp, size = _RECORD.unpack_from(view, position)
+                position += _RECORD.size
+                yield offset, timestamp, view[position:position + size]
+                position += size
+        finally:
+            view.release()
+
+    def seal(self):
+        """Close the files appended to, a sealed segment is only read."""
+        if self._log is not None:
+            self.flush()
+            self._log.close()
+            self._index.close()
+            self._log = self._index = None
+
+    def close(self):
+        """Close the files and drop the mmaps, they are opened again when needed."""
+        self.seal()
+        self._maps = None
+
+    def delete(self):
+        self.close()
+        for suffix in (".log", ".index"):
+            os.remove(self.path + suffix)
+
+
+class TopicLog:
+    """Segmented log of the values published on one topic.
+
+    A new segment is started when the active one reaches segment_bytes. Old
+    segments are deleted once the log is over retention_bytes or they are
+    older than retention_seconds. With compact, sealed segments are reduced to
+    their last record, which keeps just enough to restore the topic value.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 2**24, retention_bytes: Optional[int] = None,
+                 retention_seconds: Optional[float] = None, compact: bool = False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.compact = compact
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+        self.segments = [Segment(directory, base) for base in bases] or [Segment(directory, 0)]
+        for segment in self.segments[:-1]:
+            segment.seal()
+
+    @property
+    def first_offset(self) -> int:
+        """Offset of the oldest record kept."""
+        return self.segments[0].base
+
+    @property
+    def next_offset(self) -> int:
+        """Offset the next record will get."""
+        return self.segments[-1].next_offset
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    def append(self, value: Any, timestamp: Optional[float] = None) -> int:
+        """Append a value, returns its offset."""
+        data = binary.dump_value(value)
+        active = self.segments[-1]
+        if active.count and active.size + _RECORD.size + len(data) > self.segment_bytes:
+            active = self._roll()
+        offset = active.next_offset
+        active.append(time.time() if timestamp is None else timestamp, data)
+        return offset
+
+    def _roll(self) -> Segment:
+        """Seal the active segment and start a new one."""
+        sealed = self.segments[-1]
+        sealed.seal()
+        self.segments.append(Segment(self.directory, sealed.next_offset))
+        if self.compact:
+            self._compact()
+        self._retain()
+        return self.segments[-1]
+
+    def _compact(self):
+        """Replace the sealed segments by one holding just the last sealed record."""
+        sealed = self.segments[-2]
+        if sealed.count == 1:
+            compacted = sealed
+        else:
+            offset, timestamp, value = next(sealed.records(sealed.count - 1))
+            compacted = Segment(self.directory, offset)
+            compacted.append(timestamp, bytes(value))
+            compacted.seal()
+        for segment in self.segments[:-1]:
+            if segment is not compacted:
+                segment.delete()
+        self.segments[:-1] = [compacted]
+
+    def _expired(self, segment: Segment) -> bool:
+        """Check if segment is past the retention limits."""
+        if self.retention_bytes is not None and self.size > self.retention_bytes:
+            return True
+        return self.retention_seconds is not None and segment.count > 0 \
+            and segment.timestamp(segment.count - 1) < time.time() - self.retention_seconds
+
+    def _retain(self):
+        """Delete the oldest segments past the retention limits, never the active one."""
+        while len(self.segments) > 1 and self._expired(self.segments[0]):
+            self.segments.pop(0).delete()
+
+    def read(self, offset: Optional[int] = None, timestamp: Optional[float] = None) -> Iterator[Tuple[int, float, Any]]:
+        """Yield (offset, timestamp, value) from offset, or from the first record at timestamp, on."""
+        for segment in list(self.segments):
+            if offset is not None:
+                if segment.next_offset <= offset:
+                    continue
+                start = max(offset - segment.base, 0)
+            elif timestamp is not None:
+                if not segment.count or segment.timestamp(segment.count - 1) < timestamp:
+                    continue
+                start = segment.find(timestamp)
+                timestamp = None        # later segments are read from their start
+            else:
+                start = 0
+            offset = None
+            for record_offset, record_timestamp, value in segment.records(start):
+                yield record_offset, record_timestamp, binary.load_value(value)[0]
+
+    def last(self) -> Any:
+        """Last value appended, None for an empty log."""
+        for segment in reversed(self.segments):
+            if segment.count:
+                return binary.load_value(next(segment.records(segment.count - 1))[2])[0]
+        return None
+
+    def flush(self):
+        self.segments[-1].flush()
+
+    def close(self):
+        """Close the files and mmaps of every segment, the log can still be used."""
+        for segment in self.segments:
+            segment.close()
+
+
+class CommitLog:
+    """TopicLogs of every topic, kept under one directory.
+
+    Only the max_open topics used last keep their files and mmaps open, so the
+    number of topics isn't bound by the file descriptors of the process.
+    """
+
+    def __init__(self, directory: str, max_open: int = 128, **options):
+        """Open the logs found in directory, options are given to every TopicLog."""
+        self.directory = directory
+        self.max_open = max_open
+        self.options = options
+        self.logs: Dict[str, TopicLog] = {}
+        self._dirty = set()         # topics appended to since the last flush
+        self._recent = OrderedDict()    # topics with files or mmaps open, least recently used first
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.startswith(TOPIC_PREFIX):
+                self._open(unquote(name[len(TOPIC_PREFIX):]))
+
+    def _open(self, topic: str) -> TopicLog:
+        log = self.logs[topic] = TopicLog(
+            os.path.join(self.directory, TOPIC_PREFIX + quote(topic, safe="")), **self.options
+        )
+        return log
+
+    def _use(self, topic: str) -> TopicLog:
+        """Log of topic, closing the files of the topic used longest ago past max_open."""
+        log = self.logs.get(topic) or self._open(topic)
+        self._recent[topic] = None
+        self._recent.move_to_end(topic)
+        while len(self._recent) > self.max_open:
+            idle, _ = self._recent.popitem(last=False)
+            self._dirty.discard(idle)
+            self.logs[idle].close()
+        return log
+
+    def topics(self) -> List[str]:
+        return list(self.logs)
+
+    def append(self, topic: str, value: Any, timestamp: Optional[float] = None) -> int:
+        """Append a value to the log of topic, returns its offset."""
+        log = self._use(topic)
+        self._dirty.add(topic)
+        return log.append(value, timestamp)
+
+    def read(self, topic: str, offset: Optional[int] = None, timestamp: Optional[float] = None,
+             end: Optional[int] = None) -> Iterator[Tuple[int, float, Any]]:
+        """Yield (offset, timestamp, value) of topic from offset or timestamp on, up to offset end (excluded)."""
+        if topic in self.logs:
+            for record in self._use(topic).read(offset, timestamp):
+                if end is not None and record[0] >= end:
+                    return
+                yield record
+
+    def next_offset(self, topic: str) -> int:
+        """Offset the next record of topic will get."""
+        return self.logs[topic].next_offset if topic in self.logs else 0
+
+    def last_values(self) -> Dict[str, Any]:
+        """Last value of every logged topic."""
+        return {topic: self._use(topic).last() for topic in list(self.logs)}
+
+    def flush(self):
+        """Hand the buffered appends of every topic to the OS."""
+        for topic in self._dirty:
+            self.logs[topic].flush()
+        self._dirty.clear()
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
+        self._recent.clear()
+        self._dirty.clear()
@@ -0,0 +1,128 @@
+"""Consumer groups: every message on the group topic goes to one of its members."""
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+ROUND_ROBIN = "round-robin"
+LEAST_IN_FLIGHT = "least-in-flight"
+STRATEGIES = [ROUND_ROBIN, LEAST_IN_FLIGHT]
+
+
+class Member:
+    """Connection in a group, with the deliveries it hasn't acknowledged yet."""
+
+    __slots__ = ("conn", "prefetch", "in_flight")
+
+    def __init__(self, conn, prefetch: int):
+        self.conn = conn
+        self.prefetch = prefetch
+        self.in_flight = OrderedDict()      # delivery id -> deadline
+
+    @property
+    def ready(self) -> bool:
+        return len(self.in_flight) < self.prefetch
+
+
+class ConsumerGroup:
+    """Named group of consumers sharing the messages of a topic.
+
+    A message is delivered to one member with a free slot in its prefetch
+    window, picked round-robin or by least in flight, and is redelivered to
+    another member if it isn't acknowledged within ack_timeout seconds or its
+    member leaves. Messages waiting for a free slot are kept up to
+    max_pending; past that the oldest are dropped, so a group without members
+    doesn't grow without bound.
+    """
+
+    def __init__(self, name: str, topic: str, strategy: str = ROUND_ROBIN, ack_timeout: float = 30,
+                 max_pending: int = 10000):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown consumer group strategy {strategy}")
+        self.name = name
+        self.topic = topic
+        self.strategy = strategy
+        self.ack_timeout = ack_timeout
+        self.max_pending = max_pending
+        self.members: Dict[Any, Member] = OrderedDict()
+        self.pending = deque()              # (delivery id, message) waiting for a member
+        self.in_flight = {}                 # delivery id -> (message, member)
+        self.dropped = 0
+        self._next_id = 1
+        self._turn = 0
+
+    def __repr__(self):
+        return f"ConsumerGroup({self.name!r}, {self.topic!r})"
+
+    def add(self, conn, prefetch: int = 1):
+        """Add conn to the group, with up to prefetch unacknowledged messages."""
+        if conn in self.members:
+            self.members[conn].prefetch = max(prefetch, 1)
+        else:
+            self.members[conn] = Member(conn, max(prefetch, 1))
+
+    def remove(self, conn):
+        """Remove conn from the group, its unacknowledged messages are redelivered."""
+        member = self.members.pop(conn, None)
+        if member is not None:
+            self._requeue(member, list(member.in_flight))
+
+    def enqueue(self, msg):
+        """Queue a message for delivery."""
+        self.pending.append((self._next_id, msg))
+        self._next_id += 1
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft()
+            self.dropped += 1
+
+    def ack(self, conn, delivery: int) -> bool:
+        """Acknowledge a delivery made to conn, returns whether it was in flight."""
+        member = self.members.get(conn)
+        if member is None or member.in_flight.pop(delivery, None) is None:
+            return False
+        del self.in_flight[delivery]
+        return True
+
+    def expire(self, now: Optional[float] = None):
+        """Queue again the deliveries past their ack timeout."""
+        now = time.monotonic() if now is None else now
+        for member in self.members.values():
+            # deliveries are ordered by deadline
+            expired = []
+            for delivery, deadline in member.in_flight.items():
+                if deadline > now:
+                    break
+                expired.append(delivery)
+            self._requeue(member, expired)
+
+    def _requeue(self, member: Member, deliveries: List[int]):
+        for delivery in reversed(deliveries):
+            member.in_flight.pop(delivery, None)
+            msg, _ = self.in_flight.pop(delivery)
+            self.pending.appendleft((delivery, msg))
+
+    def _pick(self) -> Optional[Member]:
+        """Member to get the next message, None if every window is full."""
+        members = list(self.members.values())
+        if self.strategy == LEAST_IN_FLIGHT:
+            ready = [m for m in members if m.ready]
+            return min(ready, key=lambda m: len(m.in_flight)) if ready else None
+        for i in range(len(members)):
+            member = members[(self._turn + i) % len(members)]
+            if member.ready:
+                self._turn = (self._turn + i + 1) % len(members)
+                return member
+        return None
+
+    def dispatch(self, now: Optional[float] = None) -> List[Tuple[Any, int, Any]]:
+        """Assign pending messages to members, returns the (conn, delivery id, message) to send."""
+        now = time.monotonic() if now is None else now
+        deliveries = []
+        while self.pending:
+            member = self._pick()
+            if member is None:
+                break
+            delivery, msg = self.pending.popleft()
+            member.in_flight[delivery] = now + self.ack_timeout
+            self.in_flight[delivery] = (msg, member)
+            deliveries.append((member.conn, delivery, msg))
+        return deliveries
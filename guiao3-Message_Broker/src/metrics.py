@@ -0,0 +1,190 @@
+"""Broker metrics: counters and histograms cheap enough to update per message."""
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any, Dict, List
+
+# upper bounds, in seconds, of the duration histogram buckets
+DURATION_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+SLOW_SEND = 0.01            # a send blocking longer than this marks a slow consumer
+TOP_CONNECTIONS = 20        # connections listed in the stats, by bytes sent
+
+
+class Histogram:
+    """Observations counted in fixed buckets."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=DURATION_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Cumulative bucket counts, as Prometheus reports them."""
+        buckets, total = {}, 0
+        for bound, count in zip(list(self.bounds) + ["+Inf"], self.counts):
+            total += count
+            buckets[str(bound)] = total
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class Metrics:
+    """Load of a broker, by serializer, topic and connection."""
+
+    def __init__(self):
+        self.messages_in = defaultdict(int)     # serializer code -> frames received
+        self.bytes_in = defaultdict(int)
+        self.messages_out = defaultdict(int)    # serializer code -> messages sent
+        self.bytes_out = defaultdict(int)
+        self.topic_messages = defaultdict(int)  # topic -> values published
+        self.topic_bytes = defaultdict(int)
+        self.conn_bytes_in = defaultdict(int)
+        self.conn_bytes_out = defaultdict(int)
+        self.slow_sends = defaultdict(int)      # conn -> sends over SLOW_SEND
+        self.select_seconds = 0.0
+        self.read_seconds = Histogram()         # handling the events of each select
+        self.send_seconds = Histogram()
+
+    def received(self, conn, codeSerial: int, size: int):
+        """A frame of size bytes arrived from conn."""
+        self.messages_in[codeSerial] += 1
+        self.bytes_in[codeSerial] += size
+        self.conn_bytes_in[conn] += size
+
+    def published(self, topic: str, size: int):
+        self.topic_messages[topic] += 1
+        self.topic_bytes[topic] += size
+
+    def sent(self, conn, codeSerial: int, size: int, messages: int, seconds: float):
+        """messages taking size bytes were sent to conn in seconds."""
+        self.messages_out[codeSerial] += messages
+        self.bytes_out[codeSerial] += size
+        self.conn_bytes_out[conn] += size
+        self.send_seconds.observe(seconds)
+        if seconds > SLOW_SEND:
+            self.slow_sends[conn] += 1
+
+    def loop(self, selecting: float, reading: float):
+        """An event loop iteration waited selecting seconds and handled events for reading seconds."""
+        self.select_seconds += selecting
+        self.read_seconds.observe(reading)
+
+    def forget(self, conn):
+        """Drop the counters of a closed connection."""
+        self.conn_bytes_in.pop(conn, None)
+        self.conn_bytes_out.pop(conn, None)
+        self.slow_sends.pop(conn, None)
+
+    def connections(self, buffered: Dict[Any, int]) -> List[Dict[str, Any]]:
+        """Load of the busiest connections; buffered gives the bytes queued for each."""
+        conns = sorted(buffered, key=lambda conn: self.conn_bytes_out.get(conn, 0), reverse=True)
+        return [
+            {
+                "peer": peer(conn),
+                "bytes_in": self.conn_bytes_in.get(conn, 0),
+                "bytes_out": self.conn_bytes_out.get(conn, 0),
+                "slow_sends": self.slow_sends.get(conn, 0),
+                "buffered": buffered[conn],
+            }
+            for conn in conns[:TOP_CONNECTIONS]
+        ]
+
+
+def peer(conn) -> str:
+    """host:port of the other end of conn."""
+    try:
+        address = conn.getpeername()
+    except (AttributeError, OSError):
+        address = getattr(conn, "writer", None) and conn.writer.get_extra_info("peername")
+    return ":".join(str(part) for part in address[:2]) if address else repr(conn)
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus(stats: Dict[str, Any]) -> str:
+    """Format the stats of a broker in the Prometheus text format."""
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append(f"# HELP broker_{name} {help}")
+        lines.append(f"# TYPE broker_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"broker_{name}{labels} {value}")
+
+    def histogram(name, help, snapshot):
+        lines.append(f"# HELP broker_{name} {help}")
+        lines.append(f"# TYPE broker_{name} histogram")
+        for bound, count in snapshot["buckets"].items():
+            lines.append(f"broker_{name}_bucket{_labels(le=bound)} {count}")
+        lines.append(f"broker_{name}_sum {snapshot['sum']}")
+        lines.append(f"broker_{name}_count {snapshot['count']}")
+
+    serializers = stats["serializers"].items()
+    metric("connections", "gauge", "Open client connections.", [("", stats["connections"])])
+    for field, help in [("messages_in", "Frames received."), ("bytes_in", "Bytes received."),
+                        ("messages_out", "Messages sent."), ("bytes_out", "Bytes sent.")]:
+        metric(f"{field}_total", "counter", f"{help[:-1]} by serializer.",
+               [(_labels(serializer=name), counts[field]) for name, counts in serializers])
+
+    topics = stats["topics"].items()
+    metric("topic_subscribers", "gauge", "Subscribers of each topic.",
+           [(_labels(topic=topic), t["subscribers"]) for topic, t in topics])
+    metric("topic_messages_total", "counter", "Values published on each topic.",
+           [(_labels(topic=topic), t["messages"]) for topic, t in topics])
+    metric("topic_bytes_total", "counter", "Bytes published on each topic.",
+           [(_labels(topic=topic), t["bytes"]) for topic, t in topics])
+
+    conns = stats["busiest_connections"]
+    for field, kind, help in [("bytes_in", "counter", "Bytes received from"), ("bytes_out", "counter", "Bytes sent to"),
+                              ("slow_sends", "counter", "Slow sends to"), ("buffered", "gauge", "Bytes queued in the broker for")]:
+        suffix = "_total" if kind == "counter" else ""
+        metric(f"connection_{field}{suffix}", kind, f"{help} the busiest connections.",
+               [(_labels(peer=c["peer"]), c[field]) for c in conns])
+
+    queues = stats["queues"]
+    for field, kind, help in [("queued", "gauge", "Frames queued for"), ("queued_bytes", "gauge", "Bytes queued for"),
+                              ("dropped", "counter", "Frames dropped by the overflow policy for"),
+                              ("lag_seconds", "gauge", "Age of the oldest frame queued for")]:
+        suffix = "_total" if kind == "counter" else ""
+        metric(f"queue_{field}{suffix}", kind, f"{help} the lagging subscribers.",
+               [(_labels(peer=q["peer"]), q[field]) for q in queues])
+
+    groups = stats["groups"].items()
+    for field, help in [("members", "Members"), ("pending", "Messages waiting for a member"),
+                        ("in_flight", "Messages not acknowledged yet"), ("dropped", "Messages dropped")]:
+        metric(f"group_{field}", "gauge", f"{help} of each consumer group.",
+               [(_labels(group=name), g[field]) for name, g in groups])
+
+    metric("select_seconds_total", "counter", "Time spent waiting in select.", [("", stats["select_seconds"])])
+    histogram("read_seconds", "Time spent handling the events of each select.", stats["read_seconds"])
+    histogram("send_seconds", "Time spent in each send.", stats["send_seconds"])
+    return "\n".join(lines) + "\n"
+
+
+def http_response(request: bytes, stats) -> bytes:
+    """HTTP response to a request for /metrics; stats is called to get the broker stats."""
+    path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+    if path.split(b"?")[0] != b"/metrics":
+        status, body = "404 Not Found", b"Not found, try /metrics\n"
+    else:
+        status, body = "200 OK", prometheus(stats()).encode("utf-8")
+    head = (
+        f"HTTP/1.0 {status}\r\n"
+        "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    )
+    return head.encode("ascii") + body
@@ -1,14 +1,22 @@
 """Middleware to communicate with PubSub Message Broker."""
+import asyncio
+from collections import deque
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from queue import LifoQueue, Empty
+from queue import LifoQueue, Empty, Queue as BoundedQueue
 import socket
-from typing import Any
+import threading
+from typing import Any, AsyncIterator, Iterator, Tuple
 import json
 import pickle
 
+from src.framing import PROTOCOL_VERSION, FrameDecoder
+from src.log import get_logger
 from src.protocol import PubSubProtocol
 
+logger = get_logger("Middleware")
+
 
 class MiddlewareType(Enum):
     """Middleware Type."""
@@ -29,58 +37,267 @@ class Queue:
         self.cereal = 0
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.host, self.port))
+        self.decoder = FrameDecoder(prefix=1)
+        self.version = PROTOCOL_VERSION
+        self.delivery = None        # consumer group delivery to acknowledge
+        self.buffer = None          # messages read ahead, see start
+        self._reader = None
+        self._stash = deque()       # messages received while waiting for a reply
+        self._callbacks = {"TopicListRep": deque(), "StatsRep": deque(), "SnapshotRep": deque()}
+        self._sendLock = threading.Lock()
+
+    def subscribe(self, offset=None, timestamp=None, group=None, prefetch=None):
+        """Announce the serializer and subscribe the queue topic.
+
+        Replays the topic log from offset or timestamp if given. With a group, the
+        queue shares the topic messages with the other members of that group,
+        getting up to prefetch of them before acknowledging.
+        """
+        PubSubProtocol.sendMsg(self.socket, 0, PubSubProtocol.ack(self.cereal))
+        PubSubProtocol.sendMsg(
+            self.socket, self.cereal, PubSubProtocol.sub(self.topic, offset, timestamp, group, prefetch)
+        )
 
     def push(self, value):
         """Sends data to broker."""
         if self.type.value == 2:
             PubSubProtocol.sendMsg(self.socket, self.cereal, PubSubProtocol.pub(self.topic, value))
 
+    def push_many(self, values):
+        """Sends several values to broker in a single frame."""
+        self.push_batch([(self.topic, value) for value in values])
+
+    def push_batch(self, pubs):
+        """Sends a list of (topic, value) to broker in as few frames as possible."""
+        if self.type.value == 2 and pubs:
+            self.socket.sendall(self._encode_batch(pubs))
+
+    def _encode_batch(self, pubs) -> bytes:
+        """Encode pubs, splitting the batch when it does not fit in one frame."""
+        try:
+            return PubSubProtocol.encode(self.cereal, PubSubProtocol.pubBatch(pubs), self.version)
+        except OverflowError:
+            if len(pubs) == 1:
+                raise
+            half = len(pubs) // 2
+            return self._encode_batch(pubs[:half]) + self._encode_batch(pubs[half:])
+
     def pull(self) -> (str, Any):
         """Receives (topic, data) from broker.
-        Should BLOCK the consumer!"""
-        data = PubSubProtocol.recv_msg(self.socket)
-        if data and data.value:
-            if data.type == "TopicListReply":
-                return data.lista
-            else:
-                return (data.topic, int(data.value))
-        else:
+        Should BLOCK the consumer!
+
+        A consumer group message is acknowledged on the next pull (or ack)."""
+        event = self.receive()
+        if not isinstance(event, tuple):     # None, a topic list, a snapshot batch or stats
+            return event
+        topic, value = event
+        return (topic, int(value))
+
+    def receive(self) -> (str, Any):
+        """Like pull, with the value as the broker sent it."""
+        if self.delivery is not None:
+            self.ack()
+        data = self._next()
+        if data is None:
             return None
+        if data.type == "TopicListRep":
+            return data.lista
+        if data.type == "StatsRep":
+            return data.stats
+        if data.type == "SnapshotRep":
+            return data.pubs
+        self.delivery = data.id
+        return (data.topic, data.value)
+
+    def _recv(self):
+        """Receive the next message from the broker, None once the connection closed."""
+        data = PubSubProtocol.recv_msg(self.socket, self.decoder)
+        while data is None and not self.decoder.closed:
+            data = PubSubProtocol.recv_msg(self.socket, self.decoder)
+        return data
+
+    def _next(self):
+        """Next message, from the read ahead buffer once started."""
+        if self._stash:
+            return self._stash.popleft()
+        if self.buffer is None:
+            return self._recv()
+        data = self.buffer.get()
+        if data is None:
+            self.buffer.put(None)   # closed, for the other readers too
+        return data
+
+    def _send(self, msg):
+        """Send a message to the broker, from any thread."""
+        with self._sendLock:
+            PubSubProtocol.sendMsg(self.socket, self.cereal, msg)
+
+    def start(self, size: int = 1000):
+        """Read ahead up to size messages on a background thread.
+
+        pull, iterating the queue and consume then take messages from that
+        buffer; while it is full the broker connection isn't read.
+        """
+        if self._reader is None:
+            self.buffer = BoundedQueue(size)
+            self._reader = threading.Thread(target=self._read, daemon=True)
+            self._reader.start()
+        return self
+
+    def _read(self):
+        """Fill the buffer until the connection closes."""
+        data = self._recv()
+        while data is not None:
+            callbacks = self._callbacks.get(data.type)
+            if callbacks:
+                callbacks[0](data)
+                if getattr(data, "last", True):     # replies may come in several parts
+                    callbacks.popleft()
+            else:
+                self.buffer.put(data)
+            data = self._recv()
+        self.buffer.put(None)
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        """Iterate over the (topic, data) received until the connection closes."""
+        event = self.pull()
+        while event is not None:
+            yield event
+            event = self.pull()
 
-    def list_topics(self, callback: Callable):
-        """Lists all topics available in the broker."""
-        PubSubProtocol.sendMsg(self.socket, self.cereal, PubSubProtocol.topicListReq())
+    async def __aiter__(self) -> AsyncIterator[Tuple[str, Any]]:
+        """Iterate over the (topic, data) received without blocking the event loop."""
+        self.start()
+        event = await asyncio.to_thread(self.pull)
+        while event is not None:
+            yield event
+            event = await asyncio.to_thread(self.pull)
+
+    def consume(self, callback: Callable, workers: int = 4, events: int = None):
+        """Call callback(topic, data) for every message on a pool of workers.
+
+        Messages keep being read ahead while the workers are busy. Returns after
+        events messages, or once the connection closed, when every callback
+        finished. A consumer group message is acknowledged once its callback
+        returns, so it is redelivered if the callback raises.
+        """
+        self.start()
+        slots = threading.BoundedSemaphore(2 * workers)    # messages handed to the pool
+        count = 0
+        with ThreadPoolExecutor(workers) as pool:
+            while events is None or count < events:
+                data = self._next()
+                if data is None:
+                    break
+                if data.type in self._callbacks:
+                    continue
+                slots.acquire()
+                pool.submit(self._dispatch, callback, data).add_done_callback(lambda _: slots.release())
+                count += 1
+
+    def _dispatch(self, callback: Callable, data):
+        """Run callback on a message, then acknowledge it."""
+        try:
+            callback(data.topic, int(data.value))
+        except Exception as err:
+            logger.warning("Callback failed on %s: %r", data.topic, err)
+            return
+        if data.id is not None:
+            self._send(PubSubProtocol.ackDelivery(data.id))
+
+    def ack(self):
+        """Acknowledge the last consumer group message pulled."""
+        if self.delivery is not None:
+            self._send(PubSubProtocol.ackDelivery(self.delivery))
+            self.delivery = None
+
+    def list_topics(self, callback: Callable, prefix: str = None, after: str = None, limit: int = None):
+        """Lists the topics with a value in the broker, calls callback with the list.
+
+        Only topics starting with prefix are listed; with limit, a page of at most
+        limit topics after the topic after (the last of the previous page).
+        """
+        self._request(
+            PubSubProtocol.topicListReq(prefix, after, limit), "TopicListRep", lambda reply: callback(reply.lista)
+        )
+
+    def snapshot(self, callback: Callable, topic: str = None):
+        """Requests the last values of topic (the queue topic by default) and its subtopics.
+
+        The broker sends them in batches, callback is called with all the
+        (topic, value) once the last batch arrived.
+        """
+        pubs = []
+
+        def collect(reply):
+            pubs.extend(reply.pubs)
+            if reply.last:
+                callback(pubs)
+
+        self._request(PubSubProtocol.snapshotReq(self.topic if topic is None else topic), "SnapshotRep", collect)
+
+    def stats(self, callback: Callable):
+        """Requests the broker metrics, calls callback with them (a dict)."""
+        self._request(PubSubProtocol.statsReq(), "StatsRep", lambda reply: callback(reply.stats))
+
+    def _request(self, msg, reply: str, callback: Callable):
+        """Send a request and call callback with its reply.
+
+        Once started, callback is called from the reader thread when the reply
+        arrives; otherwise this blocks until it does, keeping the messages
+        received meanwhile for pull.
+        """
+        if self._reader is not None:
+            self._callbacks[reply].append(callback)
+            self._send(msg)
+            return
+
+        self._send(msg)
+        while True:
+            data = self._recv()
+            while data is not None and data.type != reply:
+                self._stash.append(data)
+                data = self._recv()
+            if data is None:
+                return
+            callback(data)
+            if getattr(data, "last", True):
+                return
 
     def cancel(self):
         """Cancel subscription."""
-        PubSubProtocol.sendMsg(self.socket, self.cereal, PubSubProtocol.cancelSubs(self.topic))
+        self._send(PubSubProtocol.cancelSub(self.topic))
 
-    
 
 class JSONQueue(Queue):
     """Queue implementation with JSON based serialization."""
 
-    def __init__(self, topic, _type = MiddlewareType.CONSUMER):
+    def __init__(self, topic, _type = MiddlewareType.CONSUMER, offset=None, timestamp=None, group=None, prefetch=None):
         super().__init__(topic, _type)
         self.cereal = 0
         if _type == MiddlewareType.CONSUMER:
-            PubSubProtocol.sendMsg(self.socket, 0, PubSubProtocol.ack(self.cereal))
-            PubSubProtocol.sendMsg(self.socket, self.cereal, PubSubProtocol.sub(self.topic))
+            self.subscribe(offset, timestamp, group, prefetch)
 
 class XMLQueue(Queue):
     """Queue implementation with XML based serialization."""
-    def __init__(self, topic, _type = MiddlewareType.CONSUMER):
+    def __init__(self, topic, _type = MiddlewareType.CONSUMER, offset=None, timestamp=None, group=None, prefetch=None):
         super().__init__(topic, _type)
         self.cereal = 1
         if _type == MiddlewareType.CONSUMER:
-            PubSubProtocol.sendMsg(self.socket, 0, PubSubProtocol.ack(self.cereal))
-            PubSubProtocol.sendMsg(self.socket, self.cereal, PubSubProtocol.sub(self.topic))
+            self.subscribe(offset, timestamp, group, prefetch)
 
 class PickleQueue(Queue):
     """Queue implementation with Pickle based serialization."""
-    def __init__(self, topic, _type = MiddlewareType.CONSUMER):
+    def __init__(self, topic, _type = MiddlewareType.CONSUMER, offset=None, timestamp=None, group=None, prefetch=None):
         super().__init__(topic, _type)
         self.cereal = 2
         if _type == MiddlewareType.CONSUMER:
-            PubSubProtocol.sendMsg(self.socket, 0, PubSubProtocol.ack(self.cereal))
-            PubSubProtocol.sendMsg(self.socket, self.cereal, PubSubProtocol.sub(self.topic))
\ No newline at end of file
+            self.subscribe(offset, timestamp, group, prefetch)
+
+class BinaryQueue(Queue):
+    """Queue implementation with struct based binary serialization."""
+    def __init__(self, topic, _type = MiddlewareType.CONSUMER, offset=None, timestamp=None, group=None, prefetch=None):
+        super().__init__(topic, _type)
+        self.cereal = 3
+        if _type == MiddlewareType.CONSUMER:
+            self.subscribe(offset, timestamp, group, prefetch)
@@ -0,0 +1,116 @@
+"""Bounded outgoing queues: a subscriber that stops reading can't stall the broker."""
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+CONFLATE = "conflate"
+DISCONNECT = "disconnect"
+POLICIES = [DROP_OLDEST, DROP_NEWEST, CONFLATE, DISCONNECT]
+
+WRITE_SIZE = 2**16          # bytes of queued frames joined for each send
+
+
+class Overflow(Exception):
+    """Raised when a queue using the disconnect policy is full."""
+
+
+class Outbox:
+    """Frames waiting to be written to a non-blocking connection.
+
+    Holds up to max_messages frames and max_bytes bytes (a single frame is
+    always accepted). When full, the policy decides what gives: drop-oldest
+    drops the frames queued first, drop-newest the new frame, disconnect raises
+    Overflow, and conflate keeps only the latest value of each topic (queued
+    values are replaced in place, dropping the oldest if still full).
+    """
+
+    def __init__(self, policy: str = DROP_OLDEST, max_messages: int = 10000, max_bytes: int = 2**24):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}")
+        self.policy = policy
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.queue = deque()        # [topic, frame, time queued], topic None for replies
+        self.latest = {}            # topic -> its queued entry, when conflating
+        self.bytes = 0
+        self.dropped = 0
+        self._current = b""         # frames taken from the queue, partially written
+
+    def __len__(self):
+        """Number of queued frames."""
+        return len(self.queue)
+
+    def __bool__(self):
+        return bool(self.queue or self._current)
+
+    @property
+    def full(self) -> bool:
+        return len(self.queue) >= self.max_messages or self.bytes >= self.max_bytes
+
+    def put(self, frame: bytes, topic: Optional[str] = None):
+        """Queue a frame, with the topic of its value if it carries one."""
+        if self.policy == CONFLATE and topic is not None:
+            entry = self.latest.get(topic)
+            if entry is not None:
+                self.bytes += len(frame) - len(entry[1])
+                entry[1] = frame
+                self.dropped += 1
+                return
+
+        if self.queue and self.full:
+            if self.policy == DISCONNECT:
+                raise Overflow(f"{len(self.queue)} messages, {self.bytes} bytes queued")
+            if self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return
+            while self.queue and self.full:
+                self._drop()
+
+        entry = [topic, frame, time.monotonic()]
+        self.queue.append(entry)
+        self.bytes += len(frame)
+        if self.policy == CONFLATE and topic is not None:
+            self.latest[topic] = entry
+
+    def _drop(self):
+        self._pop()
+        self.dropped += 1
+
+    def _pop(self):
+        entry = self.queue.popleft()
+        self.bytes -= len(entry[1])
+        if entry[0] is not None and self.latest.get(entry[0]) is entry:
+            del self.latest[entry[0]]
+        return entry
+
+    def take(self, size: int = WRITE_SIZE) -> Tuple[bytes, int]:
+        """Data to write next and the number of frames it completes."""
+        if self._current or not self.queue:
+            return self._current, 0
+        frames = [self._pop()[1]]
+        taken = len(frames[0])
+        while self.queue and taken + len(self.queue[0][1]) <= size:
+            frames.append(self._pop()[1])
+            taken += len(frames[-1])
+        self._current = memoryview(frames[0] if len(frames) == 1 else b"".join(frames))
+        return self._current, len(frames)
+
+    def sent(self, count: int):
+        """count bytes of the data taken were written."""
+        self._current = self._current[count:] if count < len(self._current) else b""
+
+    def lag(self, now: Optional[float] = None) -> float:
+        """Seconds the oldest queued frame has been waiting."""
+        if not self.queue:
+            return 0.0
+        return (time.monotonic() if now is None else now) - self.queue[0][2]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self.queue),
+            "queued_bytes": self.bytes + len(self._current),
+            "dropped": self.dropped,
+            "lag_seconds": self.lag(),
+        }
@@ -3,6 +3,13 @@ import pickle
 import xml.etree.ElementTree as ET
 import enum
 import socket
+import struct
+
+from src import binary
+from src.framing import PROTOCOL_VERSION, FrameDecoder, frame_header, recv_exactly, recv_payload, send_frame
+from src.log import get_logger
+
+logger = get_logger("Protocol")
 
 
 class Serializer(enum.Enum):
@@ -11,6 +18,7 @@ class Serializer(enum.Enum):
     JSON = 0
     XML = 1
     PICKLE = 2
+    BINARY = 3
 
 class Message:
     """Base message."""
@@ -19,52 +27,75 @@ class Message:
         self.type = type
 
 class Sub(Message):
-    """Message to subscribe a topic."""
+    """Message to subscribe a topic, replaying its log from offset or timestamp if given.
 
-    def __init__(self, topic):
+    With a group, the subscriber joins that consumer group of the topic and
+    gets up to prefetch messages at a time, each to be acknowledged.
+    """
+
+    def __init__(self, topic, offset=None, timestamp=None, group=None, prefetch=None):
         super().__init__("Sub")
         self.topic = topic
+        self.offset = offset
+        self.timestamp = timestamp
+        self.group = group
+        self.prefetch = prefetch
 
     def __repr__(self):
-        return f'{{"type": "{self.type}", "topic": "{self.topic}"}}'
+        return json.dumps(self.toPickle())
 
     def toXML(self):
-        return f'<?xml version="1.0"?><data type="{self.type}" topic="{self.topic}"></data>'
+        return f'<?xml version="1.0"?><data type="{self.type}" topic="{self.topic}" offset="{self.offset}" timestamp="{self.timestamp}" group="{self.group}" prefetch="{self.prefetch}"></data>'
 
     def toPickle(self):
-        return {"type": self.type, "topic": self.topic}
+        return {"type": self.type, "topic": self.topic, "offset": self.offset, "timestamp": self.timestamp,
+                "group": self.group, "prefetch": self.prefetch}
 
 class Pub(Message):
-    """Message to publish on a topic"""
+    """Message to publish on a topic, id is set on consumer group deliveries"""
 
-    def __init__(self, topic, value):
+    def __init__(self, topic, value, id=None):
         super().__init__("Pub")
         self.topic = topic
         self.value = value
+        self.id = id
 
     def __repr__(self):
-        return f'{{"type": "{self.type}", "topic": "{self.topic}", "value": "{self.value}"}}'
+        if self.id is None:
+            return f'{{"type": "{self.type}", "topic": "{self.topic}", "value": "{self.value}"}}'
+        return f'{{"type": "{self.type}", "topic": "{self.topic}", "value": "{self.value}", "id": "{self.id}"}}'
 
     def toXML(self):
-        return f'<?xml version="1.0"?><data type="{self.type}" topic="{self.topic}" value="{self.value}"></data>'
+        if self.id is None:
+            return f'<?xml version="1.0"?><data type="{self.type}" topic="{self.topic}" value="{self.value}"></data>'
+        return f'<?xml version="1.0"?><data type="{self.type}" topic="{self.topic}" value="{self.value}" id="{self.id}"></data>'
 
     def toPickle(self):
-        return {"type": self.type, "topic": self.topic, "value": self.value}
+        if self.id is None:
+            return {"type": self.type, "topic": self.topic, "value": self.value}
+        return {"type": self.type, "topic": self.topic, "value": self.value, "id": self.id}
 
 class TopicListReq(Message):
-    """Message to request the topic list."""
+    """Message to request the topics with a value, starting with prefix.
 
-    def __init__(self):
+    A page holds up to limit topics, in order, after the topic given as after.
+    """
+
+    def __init__(self, prefix=None, after=None, limit=None):
         super().__init__("TopicListReq")
+        self.prefix = prefix
+        self.after = after
+        self.limit = limit
 
     def __repr__(self):
-        return f'{{"type": "{self.type}"}}'
+        return json.dumps(self.toPickle())
 
     def toXML(self):
-        return f'<?xml version="1.0"?><data type="{self.type}"></data>'
+        root = ET.Element("data", type=self.type, prefix=str(self.prefix), after=str(self.after), limit=str(self.limit))
+        return '<?xml version="1.0"?>' + ET.tostring(root, encoding="unicode")
 
     def toPickle(self):
-        return {"type": self.type}
+        return {"type": self.type, "prefix": self.prefix, "after": self.after, "limit": self.limit}
 
 class TopicListRep(Message):
     """Message to reply with the topic list."""
@@ -100,49 +131,167 @@ class CancelSub(Message):
         return {"type": self.type, "topic": self.topic}
 
 class Ack(Message):
-    """Message to inform broker of your language"""
+    """Message to inform broker of your language, or with an id, to acknowledge a delivery"""
 
-    def __init__(self, lan):
+    def __init__(self, lan, version=None, id=None):
         super().__init__("Ack")
         self.lan = lan
+        self.version = version
+        self.id = id
+
+    def __repr__(self):
+        return f'{{"type": "{self.type}", "lan": "{self.lan}", "version": "{self.version}", "id": "{self.id}"}}'
+
+    def toXML(self):
+        return f'<?xml version="1.0"?><data type="{self.type}" lan="{self.lan}" version="{self.version}" id="{self.id}"></data>'
+
+    def toPickle(self):
+        return {"type": self.type, "lan": self.lan, "version": self.version, "id": self.id}
+
+class StatsReq(Message):
+    """Message to request the broker metrics."""
+
+    def __init__(self):
+        super().__init__("StatsReq")
 
     def __repr__(self):
-        return f'{{"type": "{self.type}", "lan": "{self.lan}"}}'
+        return f'{{"type": "{self.type}"}}'
 
     def toXML(self):
-        return f'<?xml version="1.0"?><data type="{self.type}" lan="{self.lan}"></data>'
+        return f'<?xml version="1.0"?><data type="{self.type}"></data>'
 
     def toPickle(self):
-        return {"type": self.type, "lan": self.lan}
+        return {"type": self.type}
+
+class StatsRep(Message):
+    """Message to reply with the broker metrics."""
+
+    def __init__(self, stats):
+        super().__init__("StatsRep")
+        self.stats = stats
+
+    def __repr__(self):
+        return json.dumps(self.toPickle())
+
+    def toXML(self):
+        root = ET.Element("data", type=self.type, stats=json.dumps(self.stats))
+        return '<?xml version="1.0"?>' + ET.tostring(root, encoding="unicode")
+
+    def toPickle(self):
+        return {"type": self.type, "stats": self.stats}
+
+class SnapshotReq(Message):
+    """Message to request the last values of the topics under topic."""
+
+    def __init__(self, topic):
+        super().__init__("SnapshotReq")
+        self.topic = topic
+
+    def __repr__(self):
+        return f'{{"type": "{self.type}", "topic": "{self.topic}"}}'
+
+    def toXML(self):
+        root = ET.Element("data", type=self.type, topic=self.topic)
+        return '<?xml version="1.0"?>' + ET.tostring(root, encoding="unicode")
+
+    def toPickle(self):
+        return {"type": self.type, "topic": self.topic}
+
+class SnapshotRep(Message):
+    """Message with a batch of (topic, last value), last is set on the final batch."""
+
+    def __init__(self, pubs, last=True):
+        super().__init__("SnapshotRep")
+        self.pubs = [(topic, value) for topic, value in pubs]
+        self.last = last
+
+    def __repr__(self):
+        return json.dumps(self.toPickle())
+
+    def toXML(self):
+        root = ET.Element("data", type=self.type, last=str(self.last))
+        for topic, value in self.pubs:
+            ET.SubElement(root, "pub", topic=str(topic), value=str(value))
+        return '<?xml version="1.0"?>' + ET.tostring(root, encoding="unicode")
+
+    def toPickle(self):
+        return {"type": self.type, "pubs": self.pubs, "last": self.last}
+
+class PubBatch(Message):
+    """Message to publish several values, possibly on different topics"""
+
+    def __init__(self, pubs):
+        super().__init__("PubBatch")
+        self.pubs = [(topic, value) for topic, value in pubs]
+
+    def __repr__(self):
+        return json.dumps(self.toPickle())
+
+    def toXML(self):
+        root = ET.Element("data", type=self.type)
+        for topic, value in self.pubs:
+            ET.SubElement(root, "pub", topic=str(topic), value=str(value))
+        return '<?xml version="1.0"?>' + ET.tostring(root, encoding="unicode")
+
+    def toPickle(self):
+        return {"type": self.type, "pubs": self.pubs}
+
+def _optional(convert, value):
+    """Convert an optional field, which XML gives as the string "None" when unset."""
+    return convert(value) if value not in (None, "None") else None
 
 class PubSubProtocol:
     @classmethod
-    def sub(cls, topic) -> Sub:
-        return Sub(topic)
+    def sub(cls, topic, offset=None, timestamp=None, group=None, prefetch=None) -> Sub:
+        return Sub(topic, offset, timestamp, group, prefetch)
 
     @classmethod
-    def pub(cls, topic, value) -> Pub:
-        return Pub(topic, value) 
+    def pub(cls, topic, value, id=None) -> Pub:
+        return Pub(topic, value, id)
 
     @classmethod
-    def topicListReq(cls) -> TopicListReq:
-        return TopicListReq()
+    def pubBatch(cls, pubs) -> PubBatch:
+        return PubBatch(pubs)
+
+    @classmethod
+    def topicListReq(cls, prefix=None, after=None, limit=None) -> TopicListReq:
+        return TopicListReq(prefix, after, limit)
 
     @classmethod
     def topicListRep(cls, lista) -> TopicListRep:
         return TopicListRep(lista)
 
+    @classmethod
+    def snapshotReq(cls, topic) -> SnapshotReq:
+        return SnapshotReq(topic)
+
+    @classmethod
+    def snapshotRep(cls, pubs, last=True) -> SnapshotRep:
+        return SnapshotRep(pubs, last)
+
+    @classmethod
+    def statsReq(cls) -> StatsReq:
+        return StatsReq()
+
+    @classmethod
+    def statsRep(cls, stats) -> StatsRep:
+        return StatsRep(stats)
+
     @classmethod
     def cancelSub(cls, topic) -> CancelSub:
         return CancelSub(topic)
 
     @classmethod
-    def ack(cls, lan) -> Ack:
-        return Ack(lan)
+    def ack(cls, lan, version=PROTOCOL_VERSION, id=None) -> Ack:
+        return Ack(lan, version, id)
+
+    @classmethod
+    def ackDelivery(cls, id) -> Ack:
+        return Ack(None, None, id)
 
     @classmethod
-    def sendMsg(cls, conn: socket, codeSerial, msg: Message):
-        """Send a message."""
+    def serialize(cls, codeSerial, msg: Message):
+        """Serialize a message, returns (Serializer code, message)."""
 
         if codeSerial == None: 
             codeSerial = 0
@@ -151,41 +300,45 @@ class PubSubProtocol:
         if isinstance(codeSerial, enum.Enum): 
             codeSerial = codeSerial.value
 
-        conn.send(codeSerial.to_bytes(1, 'big'))            # send Serializer code
         if codeSerial == 2 or codeSerial == Serializer.PICKLE:
-            msgPickle = pickle.dumps(msg.toPickle())               # get message in Pickle
-            headerPickle = len(msgPickle).to_bytes(2, 'big')     # get header
-            conn.send(headerPickle + msgPickle)                # send header + message
+            data = pickle.dumps(msg.toPickle())                   # get message in Pickle
         elif codeSerial == 1 or codeSerial == Serializer.XML:
-            msgXml = msg.toXML().encode('utf-8')                 # get message in XML
-            headerXml = len(msgXml).to_bytes(2, 'big')          # get header   
-            conn.send(headerXml + msgXml)                      # send header + message
-        elif codeSerial == 0 or codeSerial == Serializer.JSON:
-            msgI = json.loads(msg.__repr__())    
-            msgJson = json.dumps(msgI).encode('utf-8')         # get message in JSON
-            headerJson = len(msgJson).to_bytes(2, 'big')        # get header      
-            conn.send(headerJson + msgJson)                               # send header + message
+            data = msg.toXML().encode('utf-8')                    # get message in XML
+        elif codeSerial == 3 or codeSerial == Serializer.BINARY:
+            data = binary.dumps(msg.toPickle())                   # get message in binary
+        else:
+            data = json.dumps(msg.toPickle()).encode('utf-8')     # get message in JSON
+        return codeSerial, data
 
     @classmethod
-    def recv_msg(cls, conn: socket) -> Message:
-        """Receive a message."""
+    def encode(cls, codeSerial, msg: Message, version=PROTOCOL_VERSION) -> bytes:
+        """Encode a message into a frame: Serializer code + header + message.
 
-        codeSerial = int.from_bytes(conn.recv(1), 'big')
+        Messages over 64 KiB need protocol version 2 (OverflowError otherwise).
+        """
 
-        header = int.from_bytes(conn.recv(2), 'big')
-        if not header:
-            return None
+        codeSerial, data = cls.serialize(codeSerial, msg)
+        return codeSerial.to_bytes(1, 'big') + frame_header(len(data), version) + data
 
-        try:
-            if codeSerial == 0 or codeSerial == Serializer.JSON or codeSerial == None:
-                data = conn.recv(header)
-                messsageI = data.decode('utf-8')    
-                if len(messsageI) == 0: 
-                    return None                   
-                msg = json.loads(messsageI)
+    @classmethod
+    def is_extended(cls, frame: bytes) -> bool:
+        """Check if an encoded frame can only be read by protocol version 2 peers."""
+        return frame[1:3] == b'\xff\xff'
 
-            elif codeSerial == 1 or codeSerial == Serializer.XML:
-                data = conn.recv(header)
+    @classmethod
+    def sendMsg(cls, conn: socket, codeSerial, msg: Message, version=PROTOCOL_VERSION):
+        """Send a message, large messages are streamed in chunks."""
+
+        codeSerial, data = cls.serialize(codeSerial, msg)
+        head = codeSerial.to_bytes(1, 'big') + frame_header(len(data), version)
+        send_frame(conn, head, data)                              # send code + header + message
+
+    @classmethod
+    def decode(cls, codeSerial, data: bytes) -> Message:
+        """Decode the body of a frame serialized with codeSerial."""
+
+        try:
+            if codeSerial == 1 or codeSerial == Serializer.XML:
                 messsageI = data.decode('utf-8') 
                 if len(messsageI) == 0: 
                     return None
@@ -193,33 +346,95 @@ class PubSubProtocol:
                 root = ET.fromstring(messsageI)
                 for child in root.keys():                               
                     msg[child] = root.get(child)   
+                if len(root):
+                    msg["pubs"] = [(pub.get("topic"), pub.get("value")) for pub in root]
 
             elif codeSerial == 2 or codeSerial == Serializer.PICKLE:
-                messsageI = conn.recv(header)
+                messsageI = data
                 if len(messsageI) == 0:              
                     return None
                 msg = pickle.loads(messsageI)
 
+            elif codeSerial == 3 or codeSerial == Serializer.BINARY:
+                if len(data) == 0:
+                    return None
+                msg = binary.loads(data)
 
-        except json.JSONDecodeError as err:
-            raise CDProtoBadFormat(messsageI)
+            else:
+                messsageI = data.decode('utf-8')    
+                if len(messsageI) == 0: 
+                    return None                   
+                msg = json.loads(messsageI)
+
+        except (json.JSONDecodeError, struct.error, ValueError) as err:
+            raise CDProtoBadFormat(data)
 
         if msg["type"] == "Sub":
-            return cls.sub(msg["topic"])
+            return cls.sub(
+                msg["topic"],
+                _optional(int, msg.get("offset")),
+                _optional(float, msg.get("timestamp")),
+                _optional(str, msg.get("group")),
+                _optional(int, msg.get("prefetch")),
+            )
         elif msg["type"] == "Pub":
-            return cls.pub(msg["topic"], msg["value"])
+            return cls.pub(msg["topic"], msg["value"], _optional(int, msg.get("id")))
+        elif msg["type"] == "PubBatch":
+            return cls.pubBatch(msg["pubs"])
         elif msg["type"] == "TopicListReq":
-            return cls.topicListReq()
+            return cls.topicListReq(
+                _optional(str, msg.get("prefix")),
+                _optional(str, msg.get("after")),
+                _optional(int, msg.get("limit")),
+            )
         elif msg["type"] == "TopicListRep":
             return cls.topicListRep(msg["lista"])
+        elif msg["type"] == "SnapshotReq":
+            return cls.snapshotReq(msg["topic"])
+        elif msg["type"] == "SnapshotRep":
+            return cls.snapshotRep(msg.get("pubs", []), msg["last"] in (True, "True"))
+        elif msg["type"] == "StatsReq":
+            return cls.statsReq()
+        elif msg["type"] == "StatsRep":
+            stats = msg["stats"]
+            return cls.statsRep(json.loads(stats) if isinstance(stats, str) else stats)
         elif msg["type"] == "CancelSub":
             return cls.cancelSub(msg["topic"])
         elif msg["type"] == "Ack":
-            return cls.ack(msg["lan"])
+            return cls.ack(msg["lan"], _optional(int, msg.get("version")), _optional(int, msg.get("id")))
         else:
-            print("couldn't parse (?) type")
+            logger.warning("Unknown message type: %s", msg["type"])
+            return None
+
+    @classmethod
+    def recv_msg(cls, conn: socket, decoder: FrameDecoder = None) -> Message:
+        """Receive a message.
+
+        Without a decoder, blocks until a whole message arrives. With a decoder,
+        reads what conn has available only if no complete frame is buffered, and
+        returns None while the next frame is partial (decoder.closed tells EOF).
+        A frame above the limit of the decoder raises CDProtoBadFormat, and closes it.
+        """
+
+        if decoder is not None:
+            if not decoder.has_frame():
+                decoder.feed_from(conn)
+            if decoder.rejected is not None:
+                raise CDProtoBadFormat(f"Frame of {decoder.rejected} bytes, the limit is {decoder.max_frame}".encode("utf-8"))
+            frame = decoder.next_frame()
+            if frame is None:
+                return None
+            codeSerial, data = frame
+            return cls.decode(int.from_bytes(codeSerial, 'big'), data)
+
+        codeSerial = int.from_bytes(conn.recv(1), 'big')
+
+        header = recv_exactly(conn, 2)
+        if not int.from_bytes(header, 'big'):
             return None
 
+        return cls.decode(codeSerial, recv_payload(conn, header))
+
 class CDProtoBadFormat(Exception):
     """Exception when source message is not CDProto."""
 
@@ -0,0 +1,196 @@
+"""Topic trie used to index subscriptions by path segment."""
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+SINGLE_LEVEL = "+"
+MULTI_LEVEL = "#"
+
+
+def split_topic(topic: str) -> Tuple[str, ...]:
+    """Split a topic into its path segments ("" is the root of every topic)."""
+    if not topic:
+        return ()
+    return tuple(topic.split("/"))
+
+
+def is_pattern(topic: str) -> bool:
+    """Check if topic contains wildcard segments."""
+    return any(seg in (SINGLE_LEVEL, MULTI_LEVEL) for seg in split_topic(topic))
+
+
+class _TopicNode:
+    """Trie node: one path segment."""
+
+    __slots__ = ("children", "subscribers", "excluded", "topic")
+
+    def __init__(self):
+        self.children: Dict[str, "_TopicNode"] = {}
+        self.subscribers: Dict[Any, None] = {}   # ordered set of connections
+        self.excluded: Set[Any] = set()           # connections that cancelled this subtree
+        self.topic = None                         # set when a topic exists here
+
+    def is_empty(self):
+        return not self.children and not self.subscribers and not self.excluded and self.topic is None
+
+
+def _covers(pattern: Tuple[str, ...], segments: Tuple[str, ...]) -> bool:
+    """Check if a subscription to pattern receives publishes on segments."""
+    for depth, seg in enumerate(pattern):
+        if seg == MULTI_LEVEL:
+            return True
+        if depth == len(segments) or seg not in (SINGLE_LEVEL, segments[depth]):
+            return False
+    return True
+
+
+class TopicTrie:
+    """Subscription index keyed by topic path segments.
+
+    A subscription to a topic also covers all its subtopics, so it is stored
+    once on its trie node. Patterns may use "+" to match exactly one segment
+    and "#" (last segment only) to match any number of remaining segments.
+
+    Cancelling a subtopic of a subscription excludes that subtopic from it,
+    until the connection subscribes to it (or below it) again.
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+        self._patterns: Dict[Any, Set[Tuple[str, ...]]] = {}
+        self._excluded: Dict[Any, Set[Tuple[str, ...]]] = {}
+
+    def _node(self, segments, create=False):
+        node = self._root
+        for seg in segments:
+            child = node.children.get(seg)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[seg] = _TopicNode()
+            node = child
+        return node
+
+    def _prune(self, segments):
+        """Remove empty nodes along the path of segments."""
+        path = [self._root]
+        for seg in segments:
+            child = path[-1].children.get(seg)
+            if child is None:
+                return
+            path.append(child)
+        for depth in range(len(segments), 0, -1):
+            if not path[depth].is_empty():
+                return
+            del path[depth - 1].children[segments[depth - 1]]
+
+    def add_topic(self, topic: str):
+        """Register an existing topic."""
+        self._node(split_topic(topic), create=True).topic = topic
+
+    def subscribe(self, topic: str, conn):
+        """Subscribe conn to topic (and all its subtopics)."""
+        segments = split_topic(topic)
+        if MULTI_LEVEL in segments[:-1]:
+            raise ValueError(f"'{MULTI_LEVEL}' must be the last segment: {topic}")
+        node = self._node(segments, create=True)
+        node.subscribers[conn] = None
+        self._patterns.setdefault(conn, set()).add(segments)
+        if conn in node.excluded:
+            node.excluded.discard(conn)
+            self._excluded[conn].discard(segments)
+            if not self._excluded[conn]:
+                del self._excluded[conn]
+
+    def unsubscribe(self, topic: str, conn):
+        """Remove subscriptions of conn to topic and its subtopics ("" removes all).
+
+        A subscription of conn to a parent of topic stays, without topic.
+        """
+        prefix = split_topic(topic)
+        excluded = self._excluded.get(conn, set())
+        for segments in [p for p in excluded if p[:len(prefix)] == prefix]:
+            excluded.discard(segments)
+            node = self._node(segments)
+            if node is not None:
+                node.excluded.discard(conn)
+                self._prune(segments)
+
+        patterns = self._patterns.get(conn, set())
+        for segments in [p for p in patterns if p[:len(prefix)] == prefix]:
+            patterns.discard(segments)
+            node = self._node(segments)
+            if node is not None:
+                node.subscribers.pop(conn, None)
+                self._prune(segments)
+
+        if prefix and not is_pattern(topic) and any(_covers(p, prefix) for p in patterns):
+            self._node(prefix, create=True).excluded.add(conn)
+            excluded.add(prefix)
+            self._excluded[conn] = excluded
+        if not excluded:
+            self._excluded.pop(conn, None)
+        if not patterns:
+            self._patterns.pop(conn, None)
+
+    def subscriptions(self, conn) -> List[str]:
+        """List the topics conn is subscribed to."""
+        return ["/".join(p) for p in self._patterns.get(conn, ())]
+
+    def match(self, topic: str) -> List[Any]:
+        """Return the subscribers that should receive a publish on topic.
+
+        Only the trie nodes along the topic path (and wildcard branches) are
+        visited, so the cost depends on the topic depth.
+        """
+        segments = split_topic(topic)
+        found = {}
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            found.update(node.subscribers)
+            multi = node.children.get(MULTI_LEVEL)
+            if multi is not None:
+                found.update(multi.subscribers)
+            if depth == len(segments):
+                continue
+            single = node.children.get(SINGLE_LEVEL)
+            if single is not None:
+                stack.append((single, depth + 1))
+            child = node.children.get(segments[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+        if self._excluded:
+            self._exclude(found, segments)
+        return list(found)
+
+    def _exclude(self, found: Dict[Any, None], segments: Tuple[str, ...]):
+        """Drop from found the connections that cancelled a subtopic along segments.
+
+        A subscription at or below the cancelled subtopic still counts.
+        """
+        node = self._root
+        for depth, seg in enumerate(segments, 1):
+            node = node.children.get(seg)
+            if node is None:
+                return
+            for conn in node.excluded:
+                if conn in found and not any(p[:depth] == segments[:depth] and _covers(p, segments)
+                                             for p in self._patterns.get(conn, ())):
+                    del found[conn]
+
+    def topics(self, pattern: str = "") -> Iterator[str]:
+        """Yield existing topics matched by pattern (including subtopics)."""
+        segments = split_topic(pattern)
+        level = [self._root]
+        for seg in segments:
+            if seg == MULTI_LEVEL:
+                break
+            if seg == SINGLE_LEVEL:
+                level = [c for n in level for c in n.children.values()]
+            else:
+                level = [n.children[seg] for n in level if seg in n.children]
+        stack = list(reversed(level))
+        while stack:
+            node = stack.pop()
+            if node.topic is not None:
+                yield node.topic
+            stack.extend(reversed(list(node.children.values())))
@@ -0,0 +1,120 @@
+"""Test the asyncio broker on the wire."""
+import socket
+import threading
+import time
+
+import pytest
+
+from src.async_broker import AsyncBroker
+from src.broker import Broker, Serializer
+from src.protocol import PubSubProtocol
+
+PORT = 5001
+
+
+@pytest.fixture(scope="module")
+def async_broker():
+    broker = AsyncBroker(port=PORT, buffer_limit=4096)
+
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    time.sleep(0.5)
+    yield broker
+    broker.canceled = True
+    thread.join(timeout=5)
+
+
+def connect(serializer=None, topic=None, port=PORT):
+    conn = socket.create_connection(("localhost", port))
+    conn.settimeout(2)
+    if serializer is not None:
+        PubSubProtocol.sendMsg(conn, 0, PubSubProtocol.ack(serializer.value))
+        PubSubProtocol.sendMsg(conn, serializer, PubSubProtocol.sub(topic))
+    return conn
+
+
+@pytest.mark.parametrize("serializer", list(Serializer))
+def test_fan_out(async_broker, serializer):
+    topic = f"/async/{serializer.name}"
+    consumers = [connect(serializer, topic) for _ in range(20)]
+    producer = connect()
+    time.sleep(0.1)
+
+    for value in range(10):
+        PubSubProtocol.sendMsg(producer, serializer, PubSubProtocol.pub(topic, value))
+
+    for consumer in consumers:
+        received = [PubSubProtocol.recv_msg(consumer) for _ in range(10)]
+        assert [int(msg.value) for msg in received] == list(range(10))
+        assert all(msg.topic == topic for msg in received)
+        consumer.close()
+
+    assert str(async_broker.get_topic(topic)) == "9"  # JSON and XML only transfer strings
+    producer.close()
+
+
+def test_slow_consumer(async_broker):
+    slow = connect(Serializer.JSON, "/async/slow")
+    fast = connect(Serializer.JSON, "/async/fast")
+    producer = connect()
+    time.sleep(0.1)
+
+    # fill the slow consumer buffer without it reading anything
+    for value in range(2000):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/async/slow", "x" * 100))
+
+    # other publishers are still served
+    other = connect()
+    PubSubProtocol.sendMsg(other, Serializer.JSON, PubSubProtocol.pub("/async/fast", 1))
+    assert int(PubSubProtocol.recv_msg(fast).value) == 1
+
+    for conn in (slow, fast, producer, other):
+        conn.close()
+
+
+def test_stalled_consumer():
+    broker = AsyncBroker(port=PORT + 1, buffer_limit=4096, drain_timeout=0.5)
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    time.sleep(0.5)
+
+    stalled = connect(Serializer.JSON, "/stalled", PORT + 1)
+    fast = connect(Serializer.JSON, "/fast", PORT + 1)
+    producer = connect(port=PORT + 1)
+    producer.settimeout(10)
+    time.sleep(0.1)
+    # far more than the socket buffers of the stalled consumer hold
+    for _ in range(2000):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/stalled", "x" * 10000))
+
+    # the stalled consumer is dropped, and the producer is read again
+    PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/fast", 1))
+    assert int(PubSubProtocol.recv_msg(fast).value) == 1
+    assert len(broker.buffered()) == 2
+
+    for conn in (stalled, fast, producer):
+        conn.close()
+    broker.canceled = True
+    thread.join(timeout=5)
+
+
+
+@pytest.mark.parametrize("engine", [Broker, AsyncBroker])
+def test_max_frame(engine):
+    port = PORT + 2 if engine is Broker else PORT + 3
+    broker = engine(port=port, max_frame=2**16)
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    time.sleep(0.5)
+
+    greedy = connect(Serializer.JSON, "/greedy", port)
+    other = connect(Serializer.JSON, "/greedy", port)
+    time.sleep(0.1)
+    greedy.sendall(b"\x00\xff\xff" + (2**32 - 1).to_bytes(4, "big"))     # 4 GiB announced
+    assert greedy.recv(1) == b""
+
+    producer = connect(port=port)
+    PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/greedy", 1))
+    assert int(PubSubProtocol.recv_msg(other).value) == 1
+    for conn in (greedy, other, producer):
+        conn.close()
@@ -0,0 +1,61 @@
+"""Test batched publishes."""
+import random
+import string
+import threading
+import time
+
+import pytest
+
+from src.clients import Consumer, Producer
+from src.framing import FrameDecoder
+from src.middleware import BinaryQueue, JSONQueue, PickleQueue, XMLQueue, MiddlewareType
+from src.protocol import PubSubProtocol
+
+TOPIC = "/" + "".join(random.sample(string.ascii_lowercase, 6))
+
+
+def gen():
+    while True:
+        yield random.randint(0, 100)
+
+
+@pytest.mark.parametrize("serializer", [0, 1, 2, 3])
+def test_batch_encoding(serializer):
+    pubs = [("/weather/temperature", 20), ("/weather/humidity", 80), ("/msg", "São lágrimas")]
+    frame = PubSubProtocol.encode(serializer, PubSubProtocol.pubBatch(pubs))
+
+    msg = PubSubProtocol.decode(frame[0], frame[3:])
+    assert msg.type == "PubBatch"
+    assert [topic for topic, _ in msg.pubs] == [topic for topic, _ in pubs]
+    assert [str(value) for _, value in msg.pubs] == [str(value) for _, value in pubs]
+
+
+def test_batch_split(broker):
+    queue = PickleQueue(TOPIC + "/split", _type=MiddlewareType.PRODUCER)
+    queue.version = 1
+
+    decoder = FrameDecoder(prefix=1)
+    decoder.feed(queue._encode_batch([(queue.topic, "x" * 1000 + str(i)) for i in range(200)]))
+    batches = [PubSubProtocol.decode(code[0], data) for code, data in decoder.frames()]
+
+    assert len(batches) > 1  # 200 KB do not fit in a single version 1 frame
+    assert sum(len(batch.pubs) for batch in batches) == 200
+    queue.socket.close()
+
+
+@pytest.mark.parametrize("queue_type", [JSONQueue, XMLQueue, PickleQueue, BinaryQueue])
+def test_batch_producer_consumer(queue_type, broker):
+    consumer = Consumer(TOPIC, queue_type)
+    thread = threading.Thread(target=consumer.run, args=(25,), daemon=True)
+    thread.start()
+    time.sleep(0.1)
+
+    producer = Producer([TOPIC + "/a", TOPIC + "/b"], lambda: iter([1, 2]), PickleQueue)
+    producer.run(10, batch=4)
+    thread.join(timeout=2)
+
+    previous = len(consumer.received) - len(producer.produced)
+    assert previous in (0, 1)  # last value of TOPIC, if it was published before
+    # batches are sent per subtopic queue
+    assert sorted(int(v) for v in consumer.received[previous:]) == sorted(producer.produced)
+    assert broker.get_topic(TOPIC + "/b") == 2
@@ -0,0 +1,44 @@
+"""Test the binary serializer."""
+import pytest
+
+from src import binary
+from src.protocol import PubSubProtocol, CDProtoBadFormat, Serializer
+
+
+@pytest.mark.parametrize("value", [0, -7, 2**70, 21.5, "São lágrimas", b"\x00\xff", True, None])
+def test_typed_values(value):
+    frame = PubSubProtocol.encode(Serializer.BINARY, PubSubProtocol.pub("/weather2/temperature/celsius", value))
+    assert frame[0] == 3
+
+    msg = PubSubProtocol.decode(3, frame[3:])
+    assert msg.topic == "/weather2/temperature/celsius"
+    assert msg.value == value
+    assert type(msg.value) is type(value)
+
+
+def test_messages():
+    messages = [
+        PubSubProtocol.sub("/temp"),
+        PubSubProtocol.cancelSub("/temp"),
+        PubSubProtocol.topicListReq(),
+        PubSubProtocol.topicListRep(["/temp", "/msg"]),
+        PubSubProtocol.ack(3),
+        PubSubProtocol.pubBatch([("/temp", 20), ("/msg", "Ó mar salgado")]),
+    ]
+    for msg in messages:
+        decoded = PubSubProtocol.decode(3, PubSubProtocol.encode(3, msg)[3:])
+        assert decoded.toPickle() == msg.toPickle()
+
+
+def test_compact():
+    msg = PubSubProtocol.pub("/weather/pressure", 10500)
+    sizes = [len(PubSubProtocol.encode(serializer, msg)) for serializer in Serializer]
+    assert sizes[Serializer.BINARY.value] == min(sizes)
+
+
+def test_bad_format():
+    with pytest.raises(TypeError):
+        binary.dumps(PubSubProtocol.pub("/temp", [1, 2]).toPickle())
+
+    with pytest.raises(CDProtoBadFormat):
+        PubSubProtocol.decode(3, b"\x01\x00\x10/te")
@@ -4,6 +4,7 @@ from unittest.mock import MagicMock, patch
 import pytest
 
 from src.broker import Serializer
+from src.protocol import PubSubProtocol
 
 
 def test_subscriptions(broker):
@@ -24,6 +25,20 @@ def test_subscriptions(broker):
     assert broker.list_subscriptions("/t2") == [(fake_subscriber2, Serializer.PICKLE)]
 
 
+def test_unsubscribe_subtopic(broker):
+    fake_subscriber = MagicMock()
+
+    broker.subscribe("/t5", fake_subscriber, Serializer.JSON)
+    broker.put_topic("/t5/a", 1)
+    broker.put_topic("/t5/b", 2)
+    broker.unsubscribe("/t5/a", fake_subscriber)
+
+    assert broker.list_subscriptions("/t5") == [(fake_subscriber, Serializer.JSON)]
+    assert broker.list_subscriptions("/t5/a") == []
+    assert broker.list_subscriptions("/t5/b") == [(fake_subscriber, Serializer.JSON)]
+    broker.unsubscribe("", fake_subscriber)
+
+
 def test_topics(broker):
     broker.put_topic("/t3", 1000)
 
@@ -38,3 +53,70 @@ def test_topics(broker):
     assert len(broker.list_topics()) >= 2  # t3, t4 and the topic from basic
     assert "/t3" in broker.list_topics()
     assert "/t4" in broker.list_topics()
+
+
+def test_wildcard_subscriptions(broker):
+    fake_subscriber = MagicMock()
+
+    broker.put_topic("/w1/temperature/celsius", 20)
+    broker.subscribe("/w1/+/celsius", fake_subscriber, Serializer.JSON)
+
+    assert fake_subscriber.send.called  # got the last stored value
+    assert broker.list_subscriptions("/w1/temperature/celsius") == [(fake_subscriber, Serializer.JSON)]
+    assert broker.list_subscriptions("/w1/temperature") == []
+
+    broker.unsubscribe("", fake_subscriber)
+    assert broker.list_subscriptions("/w1/temperature/celsius") == []
+
+
+def test_encode_once(broker):
+    json_subscribers = [MagicMock() for _ in range(3)]
+    pickle_subscribers = [MagicMock() for _ in range(2)]
+    for subscriber in json_subscribers:
+        broker.subscribe("/t5", subscriber, Serializer.JSON)
+    for subscriber in pickle_subscribers:
+        broker.subscribe("/t5", subscriber, Serializer.PICKLE)
+
+    json_stats = dict(broker.encodeStats[Serializer.JSON])
+    pickle_stats = dict(broker.encodeStats[Serializer.PICKLE])
+
+    broker.handle(MagicMock(), PubSubProtocol.pub("/t5", 42))
+
+    assert broker.encodeStats[Serializer.JSON]["encodes"] == json_stats["encodes"] + 1
+    assert broker.encodeStats[Serializer.JSON]["hits"] == json_stats["hits"] + 2
+    assert broker.encodeStats[Serializer.PICKLE]["encodes"] == pickle_stats["encodes"] + 1
+    assert broker.encodeStats[Serializer.PICKLE]["hits"] == pickle_stats["hits"] + 1
+
+    frames = {s.send.call_args[0][0] for s in json_subscribers}
+    assert len(frames) == 1
+    assert PubSubProtocol.decode(0, frames.pop()[3:]).value == 42
+
+    for subscriber in json_subscribers + pickle_subscribers:
+        broker.unsubscribe("", subscriber)
+
+
+def test_large_messages(broker):
+    old_subscriber = MagicMock()
+    new_subscriber = MagicMock()
+
+    broker.subscribe("/large", old_subscriber, Serializer.PICKLE)
+    broker.subscribe("/large", new_subscriber, Serializer.PICKLE)
+    broker.versions[new_subscriber] = 2
+
+    broker.handle(MagicMock(), PubSubProtocol.pub("/large", "x" * 100000))
+
+    assert not old_subscriber.send.called and not old_subscriber.sendall.called  # version 1 can't read it
+    assert new_subscriber.sendall.called
+    broker.unsubscribe("", old_subscriber)
+    broker.unsubscribe("", new_subscriber)
+
+
+def test_unsent_logged(broker, caplog):
+    old_subscriber = MagicMock()
+    broker.acknowledge(old_subscriber, Serializer.JSON)
+
+    broker.send(old_subscriber, PubSubProtocol.pub("/large", "x" * 100000))
+
+    assert not old_subscriber.send.called and not old_subscriber.sendall.called
+    assert [record.levelname for record in caplog.records if "Not sent to" in record.getMessage()] == ["WARNING"]
+    broker.disconnect(old_subscriber)
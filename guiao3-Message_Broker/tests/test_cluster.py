@@ -0,0 +1,166 @@
+"""Test the multi-process broker."""
+import os
+import selectors
+import socket
+import threading
+import time
+
+import pytest
+
+from src.broker import Serializer
+from src.cluster import Cluster, PeerLink, WorkerBroker
+from src.framing import FrameDecoder
+from src.protocol import PubSubProtocol
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def connect(port, topic=None, serializer=Serializer.JSON):
+    conn = socket.create_connection(("localhost", port))
+    conn.settimeout(5)
+    if topic is not None:
+        PubSubProtocol.sendMsg(conn, 0, PubSubProtocol.ack(serializer.value))
+        PubSubProtocol.sendMsg(conn, serializer, PubSubProtocol.sub(topic))
+    return conn
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """Three workers in threads, each on its own port, so clients pick the worker."""
+    paths = [str(tmp_path / f"worker-{i}.sock") for i in range(3)]
+    servers = []
+    for path in paths:
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        servers.append(server)
+    brokers = [WorkerBroker(i, paths, server, port=free_port()) for i, server in enumerate(servers)]
+    for broker in brokers:
+        threading.Thread(target=broker.run, daemon=True).start()
+    yield brokers
+    for broker in brokers:
+        broker.canceled = True
+
+
+def test_cross_worker(workers):
+    topics = [f"/cluster/t{i}" for i in range(6)]
+    assert len({workers[0].owner(topic) for topic in topics}) > 1
+
+    consumers = [connect(broker._port, "/cluster") for broker in workers]
+    producers = [connect(broker._port) for broker in workers]
+    time.sleep(0.2)
+
+    for value in range(30):
+        producer = producers[value % 3]
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub(topics[value % 6], value))
+
+    received = [[PubSubProtocol.recv_msg(consumer) for _ in range(30)] for consumer in consumers]
+    for msgs in received:
+        assert sorted(msg.value for msg in msgs) == list(range(30))
+        for topic in topics:
+            # each producer's values keep their order
+            values = [msg.value for msg in msgs if msg.topic == topic]
+            assert values == sorted(values)
+
+    # every worker has the last values
+    time.sleep(0.1)
+    assert all(broker.get_topic(topics[5]) == 29 for broker in workers)
+
+
+def test_same_order_everywhere(workers):
+    topic = "/cluster/ordered"
+    consumers = [connect(broker._port, topic) for broker in workers]
+    producers = [connect(broker._port) for broker in workers]
+    time.sleep(0.2)
+
+    threads = [
+        threading.Thread(target=lambda p=producer, i=i: [
+            PubSubProtocol.sendMsg(p, Serializer.JSON, PubSubProtocol.pub(topic, i * 1000 + n)) for n in range(50)
+        ])
+        for i, producer in enumerate(producers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    orders = [[PubSubProtocol.recv_msg(consumer).value for _ in range(150)] for consumer in consumers]
+    assert orders[0] == orders[1] == orders[2]
+
+
+def test_group_across_workers(workers):
+    topic = "/cluster/jobs"
+    members = []
+    for broker in workers:
+        member = connect(broker._port)
+        PubSubProtocol.sendMsg(member, 0, PubSubProtocol.ack(Serializer.JSON.value))
+        PubSubProtocol.sendMsg(member, Serializer.JSON, PubSubProtocol.sub(topic, group="workers", prefetch=5))
+        members.append(member)
+    producer = connect(workers[0]._port)
+    time.sleep(0.2)
+
+    for value in range(30):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub(topic, value))
+
+    received = [[] for _ in members]
+    for values, member in zip(received, members):
+        member.settimeout(0.5)
+        try:
+            while True:
+                msg = PubSubProtocol.recv_msg(member)
+                values.append(int(msg.value))
+                PubSubProtocol.sendMsg(member, Serializer.JSON, PubSubProtocol.ackDelivery(msg.id))
+        except socket.timeout:
+            pass
+    # a single group, served by one worker: each value goes to one member, wherever it is connected
+    assert sorted(sum(received, [])) == list(range(30))
+    assert all(received)
+    owner = workers[0].groupOwner(topic, "workers")
+    assert len(workers[owner].groups) == 1 and not any(b.groups for b in workers if b.index != owner)
+
+
+def test_peer_link_bounded():
+    a, b = socket.socketpair()
+    link = PeerLink(a, selectors.DefaultSelector(), max_bytes=2**16)
+    for n in range(1000):
+        link.pending.append(("/cluster/bounded", "x" * 1000))
+        link.flush()
+        assert link.outbox.bytes <= 2**16 + 2000
+    assert link.outbox.dropped > 0
+
+    decoder = FrameDecoder(prefix=1, max_frame=None)
+    b.settimeout(0.2)
+    while link.outbox:
+        decoder.feed(b.recv(2**16))
+        link.write()
+    try:
+        while True:
+            decoder.feed(b.recv(2**16))
+    except socket.timeout:
+        pass
+    batches = [PubSubProtocol.decode(code[0], frame) for code, frame in decoder.frames()]
+    assert len(batches) + link.outbox.dropped == 1000     # whole batches, the oldest dropped
+    a.close()
+    b.close()
+
+
+@pytest.mark.skipif(not hasattr(socket, "SO_REUSEPORT"), reason="needs SO_REUSEPORT")
+def test_cluster_processes():
+    port = free_port()
+    cluster = Cluster(workers=2, port=port).start()
+    try:
+        time.sleep(0.5)
+        consumers = [connect(port, "/cluster/processes", serializer) for serializer in Serializer for _ in range(3)]
+        producer = connect(port)
+        time.sleep(0.2)
+        for value in range(10):
+            PubSubProtocol.sendMsg(producer, Serializer.PICKLE, PubSubProtocol.pub("/cluster/processes", value))
+        for consumer in consumers:
+            assert [int(PubSubProtocol.recv_msg(consumer).value) for _ in range(10)] == list(range(10))
+    finally:
+        cluster.stop()
+    assert not os.path.exists(cluster.directory)
@@ -0,0 +1,196 @@
+"""Test the durable topic log."""
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from src.async_broker import AsyncBroker
+from src.broker import Broker, Serializer
+from src.commitlog import CommitLog, TopicLog
+from src.protocol import PubSubProtocol
+
+
+def test_append_read(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=200)
+    for i in range(100):
+        assert log.append(i, timestamp=1000 + i) == i
+
+    assert len(log.segments) > 1
+    assert [value for _, _, value in log.read()] == list(range(100))
+    assert [offset for offset, _, _ in log.read(offset=95)] == [95, 96, 97, 98, 99]
+    assert [value for _, _, value in log.read(timestamp=1097.5)] == [98, 99]
+    assert log.last() == 99
+
+    log.append("Ó mar salgado")
+    log.close()
+    log = TopicLog(str(tmp_path), segment_bytes=200)
+    assert log.next_offset == 101
+    assert log.last() == "Ó mar salgado"
+
+
+def test_truncated_record(tmp_path):
+    log = TopicLog(str(tmp_path))
+    log.append(1)
+    log.append("x" * 100)
+    log.close()
+
+    path = log.segments[0].path + ".log"
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 10)   # the broker stopped halfway through the last append
+
+    log = TopicLog(str(tmp_path))
+    assert [value for _, _, value in log.read()] == [1]
+    assert log.append(2) == 1
+
+
+def test_retention(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=200, retention_bytes=600)
+    for i in range(100):
+        log.append(i)
+
+    assert log.first_offset > 0
+    assert log.size <= 600 + 200
+    assert [value for _, _, value in log.read(offset=0)][-1] == 99
+
+    old = TopicLog(str(tmp_path / "old"), segment_bytes=50, retention_seconds=60)
+    for i in range(10):
+        old.append(i, timestamp=time.time() - 120)
+    old.append(10)
+    old.append(11)
+    assert [value for _, _, value in old.read()] == [10, 11]
+
+
+def test_compaction(tmp_path):
+    log = TopicLog(str(tmp_path), segment_bytes=200, compact=True)
+    for i in range(100):
+        log.append(i)
+
+    assert len(log.segments) == 2
+    assert log.segments[0].count == 1
+    assert log.last() == 99
+    assert [offset for offset, _, _ in log.read()][0] == log.segments[0].base
+
+
+def test_broker_replay(tmp_path):
+    broker = Broker(port=0, log=CommitLog(str(tmp_path)))
+    port = broker.broker.getsockname()[1]
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+
+    producer = socket.create_connection(("localhost", port))
+    for value in range(10):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/log/temperature", value))
+    time.sleep(0.2)
+
+    for serializer in Serializer:
+        consumer = socket.create_connection(("localhost", port))
+        consumer.settimeout(2)
+        PubSubProtocol.sendMsg(consumer, 0, PubSubProtocol.ack(serializer.value))
+        PubSubProtocol.sendMsg(consumer, serializer, PubSubProtocol.sub("/log", offset=7))
+        assert [int(PubSubProtocol.recv_msg(consumer).value) for _ in range(3)] == [7, 8, 9]
+
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/log/temperature", 10))
+        assert int(PubSubProtocol.recv_msg(consumer).value) == 10
+        consumer.close()
+
+    producer.close()
+    broker.canceled = True
+    broker.log.flush()
+
+    restarted = Broker(port=0, log=CommitLog(str(tmp_path)))
+    assert restarted.get_topic("/log/temperature") == 10
+    assert "/log/temperature" in restarted.list_topics()
+    restarted.broker.close()
+
+
+def test_broker_replay_non_blocking(tmp_path):
+    broker = Broker(port=0, log=CommitLog(str(tmp_path)))
+    port = broker.broker.getsockname()[1]
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+
+    producer = socket.create_connection(("localhost", port))
+    for value in range(5000):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/big", f"{value}:" + "x" * 1000))
+    time.sleep(0.5)
+
+    # 5 MB to replay to a consumer that doesn't read yet
+    consumer = socket.create_connection(("localhost", port))
+    consumer.settimeout(2)
+    PubSubProtocol.sendMsg(consumer, 0, PubSubProtocol.ack(Serializer.JSON.value))
+    PubSubProtocol.sendMsg(consumer, Serializer.JSON, PubSubProtocol.sub("/big", offset=0))
+    time.sleep(0.2)
+    assert broker.replays
+
+    # the broker still serves everyone else
+    other = socket.create_connection(("localhost", port))
+    other.settimeout(2)
+    PubSubProtocol.sendMsg(other, 0, PubSubProtocol.ack(Serializer.JSON.value))
+    PubSubProtocol.sendMsg(other, Serializer.JSON, PubSubProtocol.sub("/other"))
+    PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/other", 1))
+    assert int(PubSubProtocol.recv_msg(other).value) == 1
+
+    # values published during the replay come after it, once
+    PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/big", "5000:live"))
+    values = [PubSubProtocol.recv_msg(consumer).value for _ in range(5001)]
+    assert [int(value.split(":")[0]) for value in values] == list(range(5001))
+    time.sleep(0.2)
+    assert not broker.replays
+    consumer.settimeout(0.2)
+    with pytest.raises(socket.timeout):
+        PubSubProtocol.recv_msg(consumer)
+
+    for conn in (producer, consumer, other):
+        conn.close()
+    broker.canceled = True
+
+
+def test_async_broker_replay_drained(tmp_path):
+    broker = AsyncBroker(port=5010, log=CommitLog(str(tmp_path)), buffer_limit=2**16)
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    time.sleep(0.5)
+
+    producer = socket.create_connection(("localhost", 5010))
+    for value in range(5000):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/big", f"{value}:" + "x" * 1000))
+    time.sleep(0.5)
+
+    consumer = socket.socket()
+    consumer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    consumer.connect(("localhost", 5010))
+    consumer.settimeout(2)
+    PubSubProtocol.sendMsg(consumer, 0, PubSubProtocol.ack(Serializer.JSON.value))
+    PubSubProtocol.sendMsg(consumer, Serializer.JSON, PubSubProtocol.sub("/big", offset=0))
+    time.sleep(0.5)
+    # written a batch at a time, as the consumer takes them: not 5 MB at once
+    assert broker.replays
+    assert max(broker.buffered().values()) < 2**16 + 300 * 1100
+
+    PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/big", "5000:live"))
+    values = [PubSubProtocol.recv_msg(consumer).value for _ in range(5001)]
+    assert [int(value.split(":")[0]) for value in values] == list(range(5001))
+    assert not broker.replays
+
+    for conn in (producer, consumer):
+        conn.close()
+    broker.canceled = True
+    thread.join(timeout=5)
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="counts the open file descriptors in /proc")
+def test_open_files_bounded(tmp_path):
+    log = CommitLog(str(tmp_path), max_open=8)
+    before = len(os.listdir("/proc/self/fd"))
+    for i in range(600):
+        log.append(f"/topic/{i}", i)
+        list(log.read(f"/topic/{i // 2}"))      # maps older topics too
+    log.flush()
+    assert len(os.listdir("/proc/self/fd")) - before <= 4 * 8
+
+    assert [value for _, _, value in log.read("/topic/0")] == [0]
+    assert log.last_values() == {f"/topic/{i}": i for i in range(600)}
+    assert len(os.listdir("/proc/self/fd")) - before <= 4 * 8
+    log.close()
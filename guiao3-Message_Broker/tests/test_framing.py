@@ -0,0 +1,196 @@
+"""Test incremental frame decoding."""
+import select
+import socket
+import threading
+from pathlib import Path
+
+import pytest
+
+from src.framing import FrameDecoder, frame_header, recv_exactly, send_frame, send_pending
+from src.protocol import CDProtoBadFormat, PubSubProtocol
+
+
+def frames(n):
+    return [PubSubProtocol.encode(i % 3, PubSubProtocol.pub("/weather2/temperature", i)) for i in range(n)]
+
+
+def test_coalesced_frames():
+    decoder = FrameDecoder(prefix=1, size=16)
+    decoder.feed(b"".join(frames(50)))
+
+    received = [PubSubProtocol.decode(code[0], data) for code, data in decoder.frames()]
+    assert [int(msg.value) for msg in received] == list(range(50))
+    assert len(decoder) == 0
+
+
+def test_split_frames():
+    decoder = FrameDecoder(prefix=1, size=16)
+    stream = b"".join(frames(10))
+    received = []
+    for i in range(len(stream)):
+        decoder.feed(stream[i:i + 1])
+        received += [PubSubProtocol.decode(code[0], data) for code, data in decoder.frames()]
+
+    assert [int(msg.value) for msg in received] == list(range(10))
+
+
+def test_feed_from_socket():
+    a, b = socket.socketpair()
+    b.setblocking(False)
+    decoder = FrameDecoder(prefix=1, size=8)
+
+    stream = b"".join(frames(3))
+    a.sendall(stream[:5])
+    decoder.feed_from(b)
+    assert not decoder.has_frame()
+    assert decoder.feed_from(b) == 0  # nothing available, does not block
+    assert not decoder.closed
+
+    a.sendall(stream[5:])
+    while len(decoder) < len(stream):
+        decoder.feed_from(b)
+    assert len(list(decoder.frames())) == 3
+
+    a.close()
+    decoder.feed_from(b)
+    assert decoder.closed
+    b.close()
+
+
+def test_recv_msg_partial():
+    a, b = socket.socketpair()
+    frame = PubSubProtocol.encode(0, PubSubProtocol.sub("/msg"))
+    a.sendall(frame[:2])
+    a.sendall(frame[2:] + frame)
+
+    assert PubSubProtocol.recv_msg(b).topic == "/msg"
+    assert recv_exactly(b, len(frame)) == frame
+    a.close()
+    b.close()
+
+
+def test_extended_frames():
+    value = "x" * 100000
+    frame = PubSubProtocol.encode(2, PubSubProtocol.pub("/blob", value))
+    assert PubSubProtocol.is_extended(frame)
+
+    with pytest.raises(OverflowError):
+        PubSubProtocol.encode(2, PubSubProtocol.pub("/blob", value), version=1)
+
+    decoder = FrameDecoder(prefix=1, stream_threshold=2**20)
+    decoder.feed(frame + frames(1)[0])
+    received = [PubSubProtocol.decode(code[0], data) for code, data in decoder.frames()]
+    assert received[0].value == value
+    assert int(received[1].value) == 0
+
+
+def test_max_frame():
+    a, b = socket.socketpair()
+    decoder = FrameDecoder(prefix=1, max_frame=2**16)
+    a.sendall(frames(1)[0] + b"\x00\xff\xff" + (2**32 - 1).to_bytes(4, "big") + b"x" * 1000)
+
+    assert int(PubSubProtocol.recv_msg(b, decoder).value) == 0
+    with pytest.raises(CDProtoBadFormat):
+        PubSubProtocol.recv_msg(b, decoder)
+    assert decoder.closed and decoder.rejected == 2**32 - 1
+    assert len(decoder._buffer) == 4096     # nothing allocated for the frame
+    assert not decoder.has_frame() and decoder.feed_from(b) == 0
+    a.close()
+    b.close()
+
+
+def test_streamed_payload():
+    a, b = socket.socketpair()
+    b.setblocking(False)
+    decoder = FrameDecoder(prefix=1, size=64, stream_threshold=1024)
+    value = bytes(range(256)) * 4000
+
+    sender = threading.Thread(target=PubSubProtocol.sendMsg, args=(a, 3, PubSubProtocol.pub("/blob", value)))
+    sender.start()
+    received = []
+    while not received:
+        select.select([b], [], [], 1)
+        decoder.feed_from(b)
+        received = list(decoder.frames())
+    sender.join()
+
+    (code, payload), = received
+    assert isinstance(payload, bytearray)  # received in place, not copied out of the buffer
+    assert PubSubProtocol.decode(code[0], payload).value == value
+    assert len(decoder._buffer) == 64  # the receive buffer did not grow
+
+    a.sendall(frames(1)[0])
+    select.select([b], [], [], 1)
+    decoder.feed_from(b)
+    assert len(list(decoder.frames())) == 1
+    a.close()
+    b.close()
+
+
+def test_large_message_blocking():
+    a, b = socket.socketpair()
+    value = "São lágrimas de Portugal! " * 10000
+    sender = threading.Thread(target=PubSubProtocol.sendMsg, args=(a, 0, PubSubProtocol.pub("/msg", value)))
+    sender.start()
+    assert PubSubProtocol.recv_msg(b).value == value
+    sender.join()
+    a.close()
+    b.close()
+
+
+class Trickle:
+    """Socket taking at most 3 bytes per send."""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def send(self, data):
+        self.data += bytes(data[:3])
+        return min(len(data), 3)
+
+
+@pytest.mark.parametrize("size", [10, 5000])
+def test_send_frame_partial_writes(size):
+    conn = Trickle()
+    payload = bytes(range(256)) * (size // 256 + 1)
+    assert send_frame(conn, b"\x00" + frame_header(len(payload)), payload, threshold=1024, chunk=100) == len(payload) + 3
+    assert conn.data == b"\x00" + frame_header(len(payload)) + payload
+
+
+def test_send_frame_non_blocking():
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    b.setblocking(False)
+    outgoing = bytearray()
+    value = bytes(range(256)) * 8000
+    frame = PubSubProtocol.encode(3, PubSubProtocol.pub("/blob", value))
+    sent = send_frame(a, frame[:7], frame[7:], outgoing=outgoing)
+    assert 0 < sent < len(frame)
+    assert sent + len(outgoing) == len(frame)
+
+    # queued behind the bytes still pending
+    small = frames(1)[0]
+    assert send_frame(a, small[:3], small[3:], outgoing=outgoing) == 0
+
+    decoder = FrameDecoder(prefix=1)
+    received = []
+    while len(received) < 2:
+        if outgoing:
+            send_pending(a, outgoing)
+        select.select([b], [], [], 1)
+        decoder.feed_from(b)
+        received += list(decoder.frames())
+    assert not outgoing
+    assert PubSubProtocol.decode(received[0][0][0], received[0][1]).value == value
+    assert int(PubSubProtocol.decode(received[1][0][0], received[1][1]).value) == 0
+    a.close()
+    b.close()
+
+
+def test_framing_copies_in_sync():
+    """The chat server ships the same framing module."""
+    root = Path(__file__).resolve().parents[2]
+    other = root / "guiao1-chat_server" / "src" / "framing.py"
+    if not other.exists():
+        pytest.skip("chat server isn't checked out")
+    assert (root / "guiao3-Message_Broker" / "src" / "framing.py").read_bytes() == other.read_bytes()
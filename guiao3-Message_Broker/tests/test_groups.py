@@ -0,0 +1,140 @@
+"""Test consumer groups."""
+import socket
+import threading
+import time
+
+import pytest
+
+from src.broker import Broker, Serializer
+from src.groups import LEAST_IN_FLIGHT, ConsumerGroup
+from src.protocol import PubSubProtocol
+
+
+def test_round_robin():
+    group = ConsumerGroup("g", "/t")
+    group.add("c1", prefetch=2)
+    group.add("c2", prefetch=2)
+    for i in range(5):
+        group.enqueue(i)
+
+    deliveries = group.dispatch(now=0)
+    assert [conn for conn, _, _ in deliveries] == ["c1", "c2", "c1", "c2"]
+    assert [msg for _, _, msg in deliveries] == [0, 1, 2, 3]
+    assert len(group.pending) == 1         # every prefetch window is full
+
+    assert group.ack("c2", deliveries[1][1])
+    assert not group.ack("c1", deliveries[1][1])
+    assert group.dispatch(now=0) == [("c2", 5, 4)]
+
+
+def test_least_in_flight():
+    group = ConsumerGroup("g", "/t", strategy=LEAST_IN_FLIGHT)
+    group.add("c1", prefetch=10)
+    group.add("c2", prefetch=10)
+    group.enqueue(0)
+    group.enqueue(1)
+    (_, first, _), (_, second, _) = group.dispatch(now=0)
+    group.ack("c1", first)
+
+    group.enqueue(2)
+    assert group.dispatch(now=0)[0][0] == "c1"
+
+    with pytest.raises(ValueError):
+        ConsumerGroup("g", "/t", strategy="random")
+
+
+def test_redelivery():
+    group = ConsumerGroup("g", "/t", ack_timeout=10)
+    group.add("c1")
+    group.enqueue("a")
+    group.enqueue("b")
+    assert group.dispatch(now=0) == [("c1", 1, "a")]
+
+    group.expire(now=5)
+    assert group.dispatch(now=5) == []
+    group.expire(now=11)                   # not acknowledged in time
+    assert group.dispatch(now=11) == [("c1", 1, "a")]
+
+    group.add("c2")
+    group.remove("c1")                     # left without acknowledging
+    assert group.dispatch(now=12) == [("c2", 1, "a")]
+    assert group.ack("c2", 1)
+    assert group.dispatch(now=12) == [("c2", 2, "b")]
+
+
+def test_bounded():
+    group = ConsumerGroup("g", "/t", max_pending=3)
+    for i in range(5):
+        group.enqueue(i)
+    assert [msg for _, msg in group.pending] == [2, 3, 4]
+    assert group.dropped == 2
+
+
+def test_broker_groups():
+    broker = Broker(port=0)
+    port = broker.broker.getsockname()[1]
+    threading.Thread(target=broker.run, daemon=True).start()
+
+    def connect(serializer, **sub):
+        conn = socket.create_connection(("localhost", port))
+        conn.settimeout(2)
+        PubSubProtocol.sendMsg(conn, 0, PubSubProtocol.ack(serializer.value))
+        PubSubProtocol.sendMsg(conn, serializer, PubSubProtocol.sub("/jobs", **sub))
+        return conn
+
+    members = [connect(serializer, group="workers", prefetch=2) for serializer in Serializer]
+    everyone = connect(Serializer.JSON)
+    producer = socket.create_connection(("localhost", port))
+    time.sleep(0.1)
+
+    for value in range(8):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/jobs", value))
+
+    received = {}
+    for member in members:
+        received[member] = [PubSubProtocol.recv_msg(member) for _ in range(2)]
+        assert all(msg.id is not None for msg in received[member])
+    assert sorted(int(msg.value) for msgs in received.values() for msg in msgs) == list(range(8))
+    assert [int(PubSubProtocol.recv_msg(everyone).value) for _ in range(8)] == list(range(8))
+
+    # nothing more until a delivery is acknowledged
+    PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/jobs", 8))
+    members[0].settimeout(0.2)
+    with pytest.raises(socket.timeout):
+        PubSubProtocol.recv_msg(members[0])
+
+    members[1].close()                     # its messages go to the others
+    time.sleep(0.1)
+    for member in members[2:] + members[:1]:
+        for msg in received[member]:
+            PubSubProtocol.sendMsg(member, Serializer.JSON, PubSubProtocol.ackDelivery(msg.id))
+
+    redelivered = []
+    for member in members[2:] + members[:1]:
+        member.settimeout(0.2)
+        try:
+            while True:
+                redelivered.append(int(PubSubProtocol.recv_msg(member).value))
+        except socket.timeout:
+            pass
+    assert sorted(redelivered) == sorted([int(msg.value) for msg in received[members[1]]] + [8])
+
+    broker.canceled = True
+    for conn in members + [everyone, producer]:
+        conn.close()
+
+
+def test_queue_groups(broker):
+    from src.middleware import JSONQueue, PickleQueue, MiddlewareType
+
+    workers = [JSONQueue("/queue/jobs", group="workers"), PickleQueue("/queue/jobs", group="workers")]
+    producer = JSONQueue("/queue/jobs", _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    for value in range(10):
+        producer.push(value)
+
+    # prefetch 1: each worker gets the next message once it pulls again
+    values = [workers[i % 2].pull()[1] for i in range(10)]
+    assert sorted(values) == list(range(10))
+    for queue in workers + [producer]:
+        queue.socket.close()
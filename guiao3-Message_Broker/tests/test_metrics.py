@@ -0,0 +1,115 @@
+"""Test the broker metrics."""
+import socket
+import threading
+import time
+import urllib.request
+
+from src.broker import Broker, Serializer
+from src.metrics import Histogram, Metrics, prometheus
+from src.middleware import JSONQueue, BinaryQueue, MiddlewareType
+from src.protocol import PubSubProtocol
+
+
+def test_histogram():
+    histogram = Histogram(bounds=(1, 10))
+    for value in [0.5, 1, 5, 50]:
+        histogram.observe(value)
+
+    snapshot = histogram.snapshot()
+    assert snapshot["buckets"] == {"1": 2, "10": 3, "+Inf": 4}
+    assert snapshot["count"] == 4 and snapshot["sum"] == 56.5
+
+
+def test_slow_consumers():
+    metrics = Metrics()
+    metrics.sent("c1", 0, 100, 2, 0.0001)
+    metrics.sent("c2", 0, 50, 1, 0.5)
+    metrics.sent("c2", 0, 50, 1, 0.5)
+
+    busiest = metrics.connections({"c1": 0, "c2": 10})
+    assert [(c["bytes_out"], c["slow_sends"], c["buffered"]) for c in busiest] == [(100, 0, 0), (100, 2, 10)]
+    assert metrics.messages_out[0] == 4
+
+    metrics.forget("c2")
+    assert "c2" not in metrics.slow_sends
+
+
+def test_stats_messages():
+    stats = {"topics": {"/a": {"subscribers": 1}}, "select_seconds": 0.5}
+    for serializer in Serializer:
+        frame = PubSubProtocol.encode(serializer, PubSubProtocol.statsRep(stats))
+        assert PubSubProtocol.decode(serializer.value, frame[3:]).stats == stats
+        frame = PubSubProtocol.encode(serializer, PubSubProtocol.statsReq())
+        assert PubSubProtocol.decode(serializer.value, frame[3:]).type == "StatsReq"
+
+
+def test_broker_stats(broker):
+    consumer = BinaryQueue("/metrics/temperature")
+    producer = JSONQueue("/metrics/temperature", _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    for value in range(5):
+        producer.push(value)
+    for _ in range(5):
+        consumer.pull()
+
+    received = []
+    consumer.stats(received.append)
+    stats = received[0]
+    assert stats["topics"]["/metrics/temperature"] == {"subscribers": 1, "messages": 5, "bytes": stats["topics"]["/metrics/temperature"]["bytes"]}
+    assert stats["topics"]["/metrics/temperature"]["bytes"] > 0
+    assert stats["serializers"]["json"]["messages_in"] >= 5
+    assert stats["serializers"]["binary"]["messages_out"] >= 5
+    assert stats["read_seconds"]["count"] > 0
+    assert "broker_topic_messages_total{topic=\"/metrics/temperature\"} 5" in prometheus(stats)
+
+    consumer.socket.close()
+    producer.socket.close()
+
+
+def test_prometheus_endpoint():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        metrics_port = s.getsockname()[1]
+    broker = Broker(port=0, metrics_port=metrics_port)
+    threading.Thread(target=broker.run, daemon=True).start()
+
+    broker.put_topic("/metrics/http", 1)
+    with urllib.request.urlopen(f"http://localhost:{metrics_port}/metrics", timeout=2) as response:
+        body = response.read().decode("utf-8")
+        assert response.headers["Content-Type"].startswith("text/plain")
+    assert "# TYPE broker_read_seconds histogram" in body
+    assert 'broker_topic_subscribers{topic="/metrics/http"} 0' in body
+
+    broker.canceled = True
+
+
+def test_prometheus_endpoint_non_blocking():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        metrics_port = s.getsockname()[1]
+    broker = Broker(port=0, metrics_port=metrics_port)
+    threading.Thread(target=broker.run, daemon=True).start()
+
+    # a scraper that never finishes its request doesn't hold up the broker
+    stalled = socket.create_connection(("localhost", metrics_port))
+    stalled.sendall(b"GET /metr")
+
+    # a request split over several segments is answered whole
+    split = socket.create_connection(("localhost", metrics_port))
+    split.settimeout(2)
+    for part in (b"GET /metr", b"ics HTTP/1.0\r\n", b"Host: localhost\r\n", b"\r\n"):
+        split.sendall(part)
+        time.sleep(0.05)
+    response = b""
+    while True:
+        data = split.recv(65536)
+        if not data:
+            break
+        response += data
+    assert response.startswith(b"HTTP/1.0 200 OK")
+    assert b"# TYPE broker_read_seconds histogram" in response
+    assert len(broker.scrapes) == 1     # only the stalled request is pending
+
+    stalled.close()
+    split.close()
+    broker.canceled = True
@@ -0,0 +1,153 @@
+"""Test the bounded subscriber queues."""
+import socket
+import threading
+import time
+
+import pytest
+
+from src.broker import Broker, Serializer
+from src.metrics import prometheus
+from src.outbox import CONFLATE, DISCONNECT, DROP_NEWEST, DROP_OLDEST, Outbox, Overflow
+from src.protocol import PubSubProtocol
+
+
+def queued(outbox):
+    return [frame for _, frame, _ in outbox.queue]
+
+
+def test_policies():
+    outbox = Outbox(DROP_OLDEST, max_messages=3)
+    for n in range(5):
+        outbox.put(b"%d" % n, "/a")
+    assert queued(outbox) == [b"2", b"3", b"4"] and outbox.dropped == 2
+
+    outbox = Outbox(DROP_NEWEST, max_messages=3)
+    for n in range(5):
+        outbox.put(b"%d" % n, "/a")
+    assert queued(outbox) == [b"0", b"1", b"2"] and outbox.dropped == 2
+
+    outbox = Outbox(CONFLATE, max_messages=3)
+    for n in range(5):
+        outbox.put(b"a%d" % n, "/a")
+        outbox.put(b"b%d" % n, "/b")
+    outbox.put(b"reply")
+    assert queued(outbox) == [b"a4", b"b4", b"reply"] and outbox.bytes == 9
+
+    outbox = Outbox(DISCONNECT, max_messages=2)
+    outbox.put(b"0")
+    outbox.put(b"1")
+    with pytest.raises(Overflow):
+        outbox.put(b"2")
+
+    with pytest.raises(ValueError):
+        Outbox("block")
+
+
+def test_byte_limit():
+    outbox = Outbox(DROP_OLDEST, max_bytes=10)
+    outbox.put(b"x" * 100)              # a single frame always fits
+    outbox.put(b"y" * 4)
+    assert queued(outbox) == [b"y" * 4]
+
+
+def test_take():
+    outbox = Outbox()
+    for n in range(3):
+        outbox.put(b"%d" % n, "/a")
+    data, messages = outbox.take(size=2)
+    assert bytes(data) == b"01" and messages == 2 and len(outbox) == 1
+    outbox.sent(1)
+    assert outbox.take() == (b"1", 0)   # the rest of the data taken comes first
+    outbox.sent(1)
+    assert bytes(outbox.take()[0]) == b"2"
+    outbox.sent(1)
+    assert not outbox
+
+
+def start(**options):
+    broker = Broker(port=0, **options)
+    threading.Thread(target=broker.run, daemon=True).start()
+    return broker, broker.broker.getsockname()[1]
+
+
+def subscriber(port, topic, buffer=None):
+    conn = socket.socket()
+    if buffer is not None:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer)
+    conn.connect(("localhost", port))
+    conn.settimeout(5)
+    PubSubProtocol.sendMsg(conn, 0, PubSubProtocol.ack(Serializer.JSON.value))
+    PubSubProtocol.sendMsg(conn, Serializer.JSON, PubSubProtocol.sub(topic))
+    return conn
+
+
+def test_stuck_subscriber():
+    broker, port = start(overflow=DROP_OLDEST, max_queued=100)
+    stuck = subscriber(port, "/outbox/stuck", buffer=4096)     # never reads
+    reader = subscriber(port, "/outbox/stuck")
+    producer = socket.create_connection(("localhost", port))
+    time.sleep(0.2)
+
+    value = "x" * 10000
+    received = []
+
+    def read():
+        while not received or received[-1] < 1999:
+            received.append(int(PubSubProtocol.recv_msg(reader).value.split()[0]))
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    for n in range(2000):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/outbox/stuck", f"{n} {value}"))
+    # the broker keeps delivering to the subscriber that reads
+    thread.join(10)
+    assert received[-1] == 1999 and received == sorted(received)
+
+    stuck_queue = broker.stats()["queues"][0]        # lagging the most
+    assert stuck_queue["queued"] == 100 and stuck_queue["dropped"] > 0 and stuck_queue["lag_seconds"] > 0
+    assert "broker_queue_dropped_total{peer=" in prometheus(broker.stats())
+
+    broker.canceled = True
+    for conn in [stuck, reader, producer]:
+        conn.close()
+
+
+def test_disconnect_policy():
+    broker, port = start(overflow=DISCONNECT, max_queued=10)
+    stuck = subscriber(port, "/outbox/disconnect", buffer=4096)
+    producer = socket.create_connection(("localhost", port))
+    time.sleep(0.2)
+
+    for n in range(2000):
+        PubSubProtocol.sendMsg(producer, Serializer.JSON, PubSubProtocol.pub("/outbox/disconnect", "x" * 10000))
+    time.sleep(0.5)
+    assert broker.list_subscriptions("/outbox/disconnect") == []
+    assert len(broker.outboxes) == 1        # only the producer left
+
+    broker.canceled = True
+    stuck.close()
+    producer.close()
+
+
+def test_foreign_non_blocking_socket():
+    broker = Broker(port=0, max_queued_bytes=2**30)
+    ours, theirs = socket.socketpair()
+    ours.setblocking(False)
+    broker.subscribe("/foreign", ours, Serializer.JSON)
+    for value in range(200):
+        broker.publish(PubSubProtocol.pub("/foreign", f"{value}:" + "x" * 10000))
+    assert broker.outboxes[ours]     # more than the socket took, queued
+
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(
+        PubSubProtocol.recv_msg(theirs).value for _ in range(200)))
+    reader.start()
+    while reader.is_alive() and broker.outboxes[ours]:
+        for key, mask in broker.sel.select(timeout=0.1):
+            key.data(key.fileobj, mask)
+    reader.join(5)
+    assert [int(value.split(":")[0]) for value in received] == list(range(200))
+    assert ours not in broker.sel.get_map()     # nothing left to write
+    broker.disconnect(ours)
+    theirs.close()
+    broker.broker.close()
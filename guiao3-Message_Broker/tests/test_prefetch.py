@@ -0,0 +1,93 @@
+"""Test the read ahead consumer middleware."""
+import asyncio
+import threading
+import time
+
+from src.middleware import JSONQueue, PickleQueue, MiddlewareType
+
+
+def queues(topic, queue_type=JSONQueue, **options):
+    consumer = queue_type(topic, **options)
+    producer = queue_type(topic, _type=MiddlewareType.PRODUCER)
+    time.sleep(0.1)
+    return consumer, producer
+
+
+def close(*queues):
+    for queue in queues:
+        queue.socket.close()
+
+
+def test_iterator(broker):
+    consumer, producer = queues("/prefetch/iter")
+    consumer.start(size=5)
+    for value in range(20):
+        producer.push(value)
+
+    received = []
+    for topic, value in consumer:
+        received.append(value)
+        if len(received) == 20:
+            break
+    assert received == list(range(20))
+    close(consumer, producer)
+
+
+def test_async_iterator(broker):
+    consumer, producer = queues("/prefetch/async", PickleQueue)
+    for value in range(10):
+        producer.push(value)
+
+    async def consume():
+        received = []
+        async for topic, value in consumer:
+            received.append(value)
+            if len(received) == 10:
+                return received
+
+    assert asyncio.run(consume()) == list(range(10))
+    close(consumer, producer)
+
+
+def test_consume(broker):
+    consumer, producer = queues("/prefetch/workers")
+    for value in range(20):
+        producer.push(value)
+
+    received = []
+    threads = set()
+
+    def slow(topic, value):
+        threads.add(threading.get_ident())
+        time.sleep(0.05)
+        received.append(value)
+
+    start = time.perf_counter()
+    consumer.consume(slow, workers=4, events=20)
+    elapsed = time.perf_counter() - start
+
+    assert sorted(received) == list(range(20))
+    assert len(threads) == 4
+    assert elapsed < 20 * 0.05 / 2     # ran in parallel
+    close(consumer, producer)
+
+
+def test_list_topics(broker):
+    consumer, producer = queues("/prefetch/topics")
+    producer.push(1)
+    time.sleep(0.1)
+
+    topics = []
+    consumer.list_topics(topics.extend)
+    assert "/prefetch/topics" in topics
+    assert consumer.pull() == ("/prefetch/topics", 1)   # kept while waiting for the list
+
+    listed = threading.Event()
+    consumer.start()
+    consumer.list_topics(lambda lista: listed.set())
+    assert listed.wait(2)
+
+    consumer.cancel()
+    time.sleep(0.1)
+    assert broker.list_subscriptions("/prefetch/topics") == []
+    close(consumer, producer)
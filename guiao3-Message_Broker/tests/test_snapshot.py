@@ -0,0 +1,72 @@
+"""Test topic listing pages and retained value snapshots."""
+import time
+
+from src.broker import SNAPSHOT_BATCH, Broker, Serializer
+from src.middleware import JSONQueue, XMLQueue, BinaryQueue, MiddlewareType
+from src.protocol import PubSubProtocol
+
+
+def test_topic_index():
+    broker = Broker(port=0)
+    for topic in ["/b/2", "/a/1", "/b/1", "/c", "/ba"]:
+        broker.put_topic(topic, 1)
+    broker.createTopic("/a/empty")
+
+    assert broker.list_topics() == ["/a/1", "/b/1", "/b/2", "/ba", "/c"]
+    assert broker.list_topics("/b") == ["/b/1", "/b/2", "/ba"]
+    assert broker.list_topics("/b/") == ["/b/1", "/b/2"]
+    assert broker.list_topics(limit=2) == ["/a/1", "/b/1"]
+    assert broker.list_topics(after="/b/1", limit=2) == ["/b/2", "/ba"]
+    assert broker.list_topics("/b", after="/b/2", limit=5) == ["/ba"]
+    assert broker.list_topics("/d") == []
+
+    broker.put_topic("/c", None)
+    assert "/c" not in broker.list_topics()
+    broker.broker.close()
+
+
+def test_messages():
+    for serializer in Serializer:
+        req = PubSubProtocol.topicListReq("/a", "/a/1", 10)
+        data = PubSubProtocol.decode(serializer.value, PubSubProtocol.encode(serializer, req)[3:])
+        assert (data.prefix, data.after, data.limit) == ("/a", "/a/1", 10)
+        data = PubSubProtocol.decode(serializer.value, PubSubProtocol.encode(serializer, PubSubProtocol.topicListReq())[3:])
+        assert (data.prefix, data.after, data.limit) == (None, None, None)
+
+        rep = PubSubProtocol.snapshotRep([("/a", "1"), ("/b", "2")], last=False)
+        data = PubSubProtocol.decode(serializer.value, PubSubProtocol.encode(serializer, rep)[3:])
+        assert data.pubs == [("/a", "1"), ("/b", "2")] and data.last is False
+        data = PubSubProtocol.decode(serializer.value, PubSubProtocol.encode(serializer, PubSubProtocol.snapshotRep([]))[3:])
+        assert data.pubs == [] and data.last is True
+
+
+def test_snapshot(broker):
+    producer = JSONQueue("/snapshot", _type=MiddlewareType.PRODUCER)
+    count = 2 * SNAPSHOT_BATCH + 10
+    producer.push_batch([(f"/snapshot/{n:04d}", n) for n in range(count)])
+    time.sleep(0.2)
+
+    consumer = BinaryQueue("/snapshot/0000")
+    assert consumer.pull() == ("/snapshot/0000", 0)    # last value on subscribe
+    received = []
+    consumer.snapshot(received.extend, "/snapshot")
+    assert received == [(f"/snapshot/{n:04d}", n) for n in range(count)]
+
+    pages = []
+    consumer.list_topics(pages.append, prefix="/snapshot/", limit=100)
+    consumer.list_topics(pages.append, prefix="/snapshot/", after=pages[0][-1], limit=100)
+    assert pages[0][0] == "/snapshot/0000" and pages[1][0] == "/snapshot/0100" and len(pages[1]) == 100
+
+    xml = XMLQueue("/snapshot/none")
+    empty = []
+    xml.snapshot(empty.append)
+    assert empty == [[]]
+
+    xml.start()
+    started = []
+    xml.snapshot(started.extend, "/snapshot")
+    time.sleep(0.2)
+    assert len(started) == count and started[-1] == (f"/snapshot/{count - 1:04d}", str(count - 1))
+
+    for queue in [producer, consumer, xml]:
+        queue.socket.close()
@@ -0,0 +1,105 @@
+"""Test the topic subscription trie."""
+import pytest
+
+from src.topics import TopicTrie, is_pattern, split_topic
+
+
+def test_split_topic():
+    assert split_topic("") == ()
+    assert split_topic("/weather2/temperature") == ("", "weather2", "temperature")
+    assert split_topic("abc") == ("abc",)
+
+    assert is_pattern("/weather/+/celsius")
+    assert is_pattern("/weather/#")
+    assert not is_pattern("/weather/temperature")
+
+
+def test_prefix_subscriptions():
+    trie = TopicTrie()
+    trie.subscribe("/weather2", "c1")
+    trie.subscribe("/weather2/temperature/celsius", "c2")
+    trie.subscribe("/weather", "c3")
+
+    assert trie.match("/weather2") == ["c1"]
+    assert sorted(trie.match("/weather2/temperature/celsius")) == ["c1", "c2"]
+    assert trie.match("/weather2/humidity") == ["c1"]
+    assert trie.match("/weather/humidity") == ["c3"]
+    assert trie.match("/msg") == []
+
+
+def test_wildcards():
+    trie = TopicTrie()
+    trie.subscribe("/weather2/+/celsius", "c1")
+    trie.subscribe("/weather2/temperature/#", "c2")
+
+    assert sorted(trie.match("/weather2/temperature/celsius")) == ["c1", "c2"]
+    assert trie.match("/weather2/pressure/celsius") == ["c1"]
+    assert trie.match("/weather2/temperature") == ["c2"]
+    assert trie.match("/weather2/humidity") == []
+
+    with pytest.raises(ValueError):
+        trie.subscribe("/weather2/#/celsius", "c3")
+
+
+def test_no_duplicates():
+    trie = TopicTrie()
+    trie.subscribe("/a", "c1")
+    trie.subscribe("/a/b", "c1")
+    trie.subscribe("/a/+", "c1")
+
+    assert trie.match("/a/b") == ["c1"]
+
+
+def test_unsubscribe():
+    trie = TopicTrie()
+    trie.subscribe("/a", "c1")
+    trie.subscribe("/a/b", "c1")
+    trie.subscribe("/c", "c1")
+    trie.subscribe("/a/b", "c2")
+
+    trie.unsubscribe("/a", "c1")
+    assert trie.match("/a/b") == ["c2"]
+    assert trie.match("/c") == ["c1"]
+
+    trie.unsubscribe("", "c1")
+    assert trie.match("/c") == []
+    assert trie.subscriptions("c1") == []
+    assert trie.subscriptions("c2") == ["/a/b"]
+
+
+def test_unsubscribe_subtopic():
+    trie = TopicTrie()
+    trie.subscribe("/a", "c1")
+    trie.subscribe("/a", "c2")
+
+    trie.unsubscribe("/a/b", "c1")     # /a still covers everything but /a/b
+    assert trie.match("/a") == ["c1", "c2"]
+    assert trie.match("/a/b") == ["c2"]
+    assert trie.match("/a/b/c") == ["c2"]
+    assert trie.match("/a/d") == ["c1", "c2"]
+    assert trie.subscriptions("c1") == ["/a"]
+
+    trie.subscribe("/a/b/c", "c1")
+    assert trie.match("/a/b") == ["c2"]
+    assert sorted(trie.match("/a/b/c")) == ["c1", "c2"]
+    trie.subscribe("/a/b", "c1")
+    assert sorted(trie.match("/a/b")) == ["c1", "c2"]
+
+    trie.unsubscribe("/a/b", "c1")
+    trie.unsubscribe("/a", "c1")
+    trie.subscribe("/a", "c1")     # a new subscription covers the whole subtree again
+    assert sorted(trie.match("/a/b")) == ["c1", "c2"]
+    trie.unsubscribe("", "c1")
+    trie.unsubscribe("", "c2")
+    assert trie.match("/a/b") == [] and trie._root.is_empty()
+
+
+def test_topics():
+    trie = TopicTrie()
+    for topic in ["/weather/temperature", "/weather/humidity", "/weather2/humidity", "/msg"]:
+        trie.add_topic(topic)
+
+    assert sorted(trie.topics()) == ["/msg", "/weather/humidity", "/weather/temperature", "/weather2/humidity"]
+    assert sorted(trie.topics("/weather")) == ["/weather/humidity", "/weather/temperature"]
+    assert sorted(trie.topics("/+/humidity")) == ["/weather/humidity", "/weather2/humidity"]
+    assert sorted(trie.topics("/weather2/#")) == ["/weather2/humidity"]
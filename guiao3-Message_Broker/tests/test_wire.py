@@ -20,7 +20,7 @@ def test_simple_producer_JSON(broker):
 
     producer = Producer(TOPIC, gen, JSONQueue)
 
-    with patch("socket.socket.send", MagicMock()) as send:
+    with patch("socket.socket.send", MagicMock(side_effect=len)) as send:
         producer.run(1)
 
         data_sent = send.call_args[0][0]
@@ -37,7 +37,7 @@ def test_simple_producer_XML(broker):
 
     producer = Producer(TOPIC, gen, XMLQueue)
 
-    with patch("socket.socket.send", MagicMock()) as send:
+    with patch("socket.socket.send", MagicMock(side_effect=len)) as send:
         producer.run(1)
 
         data_sent = send.call_args[0][0]